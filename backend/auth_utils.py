@@ -1,19 +1,31 @@
+import asyncio
 import hashlib
 import os
 import string
+import threading
 import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from typing import Any, Dict, Optional
 
-import jwt
 from fastapi import HTTPException, Response
-from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import memory_diag
+from .database import write_transaction
 
 
 ACCESS_TOKEN_TTL = int(os.getenv("ACCESS_TOKEN_TTL", 3600))
 REFRESH_TOKEN_TTL = int(os.getenv("REFRESH_TOKEN_TTL", 86400 * 7))
+ACCESS_TOKEN_CACHE_SIZE = int(os.getenv("ACCESS_TOKEN_CACHE_SIZE", 10000))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+# 대기 + 실행 중인 해시 작업 상한. 넘으면 즉시 429로 거절한다.
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", 32))
 TOKEN_TYPE_ACCESS = "access"
 TOKEN_TYPE_REFRESH = "refresh"
 ACCESS_COOKIE_NAME = os.getenv("ACCESS_COOKIE_NAME", "ec9db4eab1b820ebb3b5ed98b8ed9994ed9598eb8ba4eb8b88").strip()
@@ -71,22 +83,49 @@ JWT_ALG = "HS256"
 _LEGACY_HASH_LENGTH = 64
 _HEX_DIGITS = set(string.hexdigits.lower())
 
-pwd_context = CryptContext(
-    schemes=["pbkdf2_sha256", "bcrypt"],
-    deprecated="auto",
-)
+
+@lru_cache(maxsize=None)
+def _pwd_context():
+    # passlib은 로그인/가입 경로에서만 필요하므로 첫 사용 시점에 불러온다 (콜드 스타트 단축)
+    from passlib.context import CryptContext
+
+    return CryptContext(
+        schemes=["pbkdf2_sha256", "bcrypt"],
+        deprecated="auto",
+    )
+
+
+@lru_cache(maxsize=None)
+def _jwt():
+    # PyJWT 는 토큰을 처음 발급/검증할 때 불러온다: 헬스 체크(GET /)로 끝나는 콜드 스타트는 import 비용을 치르지 않는다
+    import jwt
+
+    return jwt
+
+
+# PBKDF2/bcrypt는 GIL을 놓고 계산하므로 스레드 풀로 이벤트 루프 밖에서 실행한다
+_password_executor = ThreadPoolExecutor(max_workers=max(1, PASSWORD_HASH_WORKERS), thread_name_prefix="pwhash")
+_password_jobs = 0
 
 # Refresh 토큰 회전을 위한 간단 화이트리스트 (프로세스 메모리 상)
 # In-memory whitelist is replaced by user.refresh_jti in the database
 # to support multiple server instances.
 
+# 검증이 끝난 access 토큰 캐시: token -> (user_id, jti, exp)
+# 항목은 토큰 자체의 exp를 넘어서 살아남지 않으며, LRU 순서로 크기가 제한된다.
+_access_token_cache: "OrderedDict[str, tuple[str, str, float]]" = OrderedDict()
+_access_token_cache_lock = threading.Lock()
+memory_diag.register_cache(
+    "auth.access_token_cache", lambda: memory_diag.container_report(_access_token_cache, ACCESS_TOKEN_CACHE_SIZE)
+)
+
 
 def generate_uuid() -> str:
     return str(uuid.uuid4())
 
 
 def hash_pw(pw: str) -> str:
-    return pwd_context.hash(pw)
+    return _pwd_context().hash(pw)
 
 
 def _is_legacy_hash(hashed: str | None) -> bool:
@@ -103,7 +142,7 @@ def verify_password(plain: str, hashed: str | None) -> bool:
     if _is_legacy_hash(hashed):
         return hashlib.sha256(plain.encode()).hexdigest() == hashed
     try:
-        return pwd_context.verify(plain, hashed)
+        return _pwd_context().verify(plain, hashed)
     except ValueError:
         return False
 
@@ -113,13 +152,57 @@ def password_needs_rehash(hashed: str | None) -> bool:
         return True
     if _is_legacy_hash(hashed):
         return True
-    return pwd_context.needs_update(hashed)
+    return _pwd_context().needs_update(hashed)
+
+
+async def _run_password_job(fn, *args):
+    global _password_jobs
+    if _password_jobs >= PASSWORD_HASH_QUEUE_LIMIT:
+        raise HTTPException(status_code=429, detail="Server busy. Please try again shortly.")
+    _password_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, fn, *args)
+    finally:
+        _password_jobs -= 1
+
+
+async def hash_pw_async(pw: str) -> str:
+    return await _run_password_job(hash_pw, pw)
+
+
+async def verify_password_async(plain: str, hashed: str | None) -> bool:
+    if not hashed:
+        return False
+    return await _run_password_job(verify_password, plain, hashed)
+
+
+async def rehash_password(user_id: str, plain: str, old_hash: str) -> None:
+    """
+    Upgrade a deprecated hash after a successful login (run as a background task).
+    The update only applies if the stored hash is still the one we verified against.
+    """
+    from .database import AsyncSessionLocal
+    from .models import User
+
+    try:
+        new_hash = await hash_pw_async(plain)
+    except HTTPException:
+        return  # 풀이 포화 상태면 다음 로그인 때 다시 시도한다
+    async with AsyncSessionLocal() as db, write_transaction(db):
+        await db.execute(
+            update(User)
+            .where(User.user_id == user_id, User.password == old_hash)
+            .values(password=new_hash)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
 
 
 def _encode_token(payload: Dict[str, Any], ttl: int) -> str:
     exp = datetime.now(timezone.utc) + timedelta(seconds=ttl)
     payload = {**payload, "exp": exp, "iat": datetime.now(timezone.utc)}
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALG)
+    return _jwt().encode(payload, JWT_SECRET, algorithm=JWT_ALG)
 
 
 def issue_access_token(user_id: str) -> str:
@@ -131,28 +214,65 @@ def issue_access_token(user_id: str) -> str:
     return _encode_token(payload, ACCESS_TOKEN_TTL)
 
 
-def issue_refresh_token(user: "User", db: Session) -> str:
+async def issue_refresh_token(user: "User", db: AsyncSession) -> str:
     from .models import User
     jti = generate_uuid()
-    user.refresh_jti = jti
-    db.add(user)
-    db.commit()
-    db.refresh(user)
+    # ORM flush 로 쓰면 row_version 검사/증가가 붙는다: 게임 상태가 아니므로 jti 만 직접 바꾼다
+    async with write_transaction(db):
+        await db.execute(
+            update(User)
+            .where(User.user_id == user.user_id)
+            .values(refresh_jti=jti)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+    set_committed_value(user, "refresh_jti", jti)
+    return _encode_refresh_token(user.user_id, jti)
+
+
+def _encode_refresh_token(user_id: str, jti: str) -> str:
     payload = {
-        "sub": user.user_id,
+        "sub": user_id,
         "typ": TOKEN_TYPE_REFRESH,
         "jti": jti,
     }
     return _encode_token(payload, REFRESH_TOKEN_TTL)
 
 
-def issue_token_pair(user: "User", db: Session) -> tuple[str, str]:
-    from .models import User
-    return issue_access_token(user.user_id), issue_refresh_token(user, db)
+async def issue_token_pair(user: "User", db: AsyncSession) -> tuple[str, str]:
+    return issue_access_token(user.user_id), await issue_refresh_token(user, db)
 
 
-def revoke_token(token: str, db: Session) -> None:
+async def rotate_refresh_token(token: str, db: AsyncSession) -> tuple[str, str]:
+    """
+    Swap the refresh jti in one conditional UPDATE (compare-and-swap).
+    Only the first of several concurrent refreshes with the same token wins;
+    the rest see rowcount 0 and get 401. Returns (user_id, new_refresh_token).
+    """
+    from .models import User
+
+    data = _decode_token(token, TOKEN_TYPE_REFRESH)
+    user_id = data["sub"]
+    old_jti = data.get("jti")
+    if not old_jti:
+        raise HTTPException(status_code=401, detail="Refresh token revoked or invalid")
+    new_jti = generate_uuid()
+    async with write_transaction(db):
+        result = await db.execute(
+            update(User)
+            .where(User.user_id == user_id, User.refresh_jti == old_jti)
+            .values(refresh_jti=new_jti)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+    if result.rowcount != 1:
+        raise HTTPException(status_code=401, detail="Refresh token revoked or invalid")
+    return user_id, _encode_refresh_token(user_id, new_jti)
+
+
+async def revoke_token(token: str, db: AsyncSession) -> None:
     from .models import User
+    jwt = _jwt()
     try:
         # Verify signature but not expiration, as we might need to revoke an expired token
         decoded = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG], options={"verify_exp": False})
@@ -161,28 +281,34 @@ def revoke_token(token: str, db: Session) -> None:
 
     if decoded.get("typ") == TOKEN_TYPE_REFRESH:
         user_id = decoded.get("sub")
-        if not user_id:
+        jti = decoded.get("jti")
+        if not user_id or not jti:
             return
-        user = db.query(User).filter_by(user_id=user_id).first()
         # Only revoke if the JTI matches the one in the DB
-        if user and user.refresh_jti and user.refresh_jti == decoded.get("jti"):
-            user.refresh_jti = None
-            db.add(user)
-            db.commit()
+        async with write_transaction(db):
+            await db.execute(
+                update(User)
+                .where(User.user_id == user_id, User.refresh_jti == jti)
+                .values(refresh_jti=None)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
 
 
-def revoke_user_tokens(user_id: str, db: Session) -> None:
+async def revoke_user_tokens(user_id: str, db: AsyncSession) -> None:
     from .models import User
-    user = db.query(User).filter_by(user_id=user_id).first()
-    if user:
-        user.refresh_jti = None
-        db.add(user)
-        db.commit()
-
-
-def require_user_from_token(token: str, db: Session, expected_type: str):
-    from .models import User
-
+    async with write_transaction(db):
+        await db.execute(
+            update(User)
+            .where(User.user_id == user_id)
+            .values(refresh_jti=None)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+
+
+def _decode_token(token: str, expected_type: str) -> Dict[str, Any]:
+    jwt = _jwt()
     try:
         data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
     except jwt.ExpiredSignatureError:
@@ -193,17 +319,63 @@ def require_user_from_token(token: str, db: Session, expected_type: str):
     if data.get("typ") != expected_type:
         raise HTTPException(status_code=403, detail="Invalid token type")
 
-    user_id = data.get("sub")
-    if not user_id:
+    if not data.get("sub"):
         raise HTTPException(status_code=401, detail="Invalid token subject")
+    return data
+
 
-    user = db.query(User).filter_by(user_id=user_id).first()
+def require_principal_from_token(token: str) -> str:
+    """
+    Verify an access token and return its user id without touching the database.
+    Verified tokens are cached until their own exp, so repeat requests skip the JWT decode.
+    """
+    now = time.time()
+    with _access_token_cache_lock:
+        cached = _access_token_cache.get(token)
+        if cached is not None:
+            user_id, _, exp = cached
+            if now < exp:
+                _access_token_cache.move_to_end(token)
+                return user_id
+            _access_token_cache.pop(token, None)
+
+    data = _decode_token(token, TOKEN_TYPE_ACCESS)
+    user_id = data["sub"]
+    exp = float(data.get("exp") or now)
+    with _access_token_cache_lock:
+        _access_token_cache[token] = (user_id, data.get("jti") or "", exp)
+        while len(_access_token_cache) > ACCESS_TOKEN_CACHE_SIZE:
+            _access_token_cache.popitem(last=False)
+    return user_id
+
+
+def forget_user_access_tokens(user_id: str) -> None:
+    """Drop cached access tokens of a user (e.g. after account deletion)."""
+    with _access_token_cache_lock:
+        stale = [token for token, entry in _access_token_cache.items() if entry[0] == user_id]
+        for token in stale:
+            _access_token_cache.pop(token, None)
+
+
+async def require_user_from_token(token: str, db: AsyncSession, expected_type: str):
+    from .models import User
+
+    if expected_type == TOKEN_TYPE_ACCESS:
+        user_id = require_principal_from_token(token)
+        jti = None
+    else:
+        data = _decode_token(token, expected_type)
+        user_id = data["sub"]
+        jti = data.get("jti")
+
+    user = await db.scalar(select(User).filter_by(user_id=user_id))
     if not user:
         # Even if the token is valid, if the user doesn't exist, it's an auth error.
+        # 다른 워커에서 삭제된 계정이면 이 프로세스의 토큰 캐시에 남아 있을 수 있다
+        forget_user_access_tokens(user_id)
         raise HTTPException(status_code=401, detail="User not found for token")
 
     if expected_type == TOKEN_TYPE_REFRESH:
-        jti = data.get("jti")
         if not jti or not user.refresh_jti or user.refresh_jti != jti:
             raise HTTPException(status_code=401, detail="Refresh token revoked or invalid")
 
@@ -0,0 +1,214 @@
+"""
+In-process benchmarks behind the performance numbers quoted in commit messages.
+
+    python -m backend.bench login [--logins 40]
+    python -m backend.bench load [--requests 400] [--concurrency 50] [--latency-ms 0]
+    python -m backend.bench middleware [--iterations 20000]
+
+Every scenario drives the ASGI app in-process (no sockets) against a
+throwaway SQLite file, so runs are comparable between commits on the same machine.
+
+  login  concurrent /login requests (password hashing) while GET / is probed in a loop;
+         reports probe latency, i.e. how long the event loop stalls behind hashing.
+  load   read throughput of /progress, /rebirth/info and /ranks for a user with 50
+         generators. --latency-ms sleeps before every statement to stand in for the
+         network round trip of a remote PostgreSQL.
+  middleware  per-request cost of the ASGI stack for requests that never reach the DB
+         (GET /, and a POST the origin check rejects); best of 3 runs.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# 앱을 import 하기 전에 임시 DB 로 고정한다
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="et-bench-"), "bench.db")
+os.environ.pop("DATABASE_READ_URL", None)
+os.environ.setdefault("JWT_SECRET", "bench-" + "x" * 32)
+os.environ.setdefault("DB_POOL_PREWARM", "0")
+
+import httpx  # noqa: E402
+
+from .auth_utils import hash_pw, issue_access_token  # noqa: E402
+from .database import SessionLocal  # noqa: E402
+from .main import app  # noqa: E402
+from .models import Generator, GeneratorType, MapProgress, User  # noqa: E402
+
+ORIGIN = "https://energytycoon.pages.dev"
+PASSWORD = "pass1234"
+
+
+def _percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct))]
+
+
+async def bench_login(logins: int) -> None:
+    with SessionLocal() as db:
+        hashed = hash_pw(PASSWORD)
+        for i in range(logins):
+            db.add(User(username=f"bench_login_{i}", password=hashed))
+        db.commit()
+
+    transport = httpx.ASGITransport(app=app)
+    latencies = []
+    stop = asyncio.Event()
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as probe_client:
+        async def probe():
+            while not stop.is_set():
+                started = time.perf_counter()
+                await probe_client.get("/")
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(0.002)
+
+        async def login(i: int) -> int:
+            # 사용자마다 별도 클라이언트 (쿠키 공유 없음)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                res = await client.post(
+                    "/login", json={"username": f"bench_login_{i}", "password": PASSWORD}, headers={"Origin": ORIGIN}
+                )
+                return res.status_code
+
+        prober = asyncio.create_task(probe())
+        started = time.perf_counter()
+        codes = await asyncio.gather(*[login(i) for i in range(logins)])
+        wall = time.perf_counter() - started
+        stop.set()
+        await prober
+
+    latencies.sort()
+    print(
+        f"login: {logins} concurrent logins, status {sorted(set(codes))}, wall {wall * 1000:.0f} ms\n"
+        f"probe GET /: {len(latencies)} completed, p50 {_percentile(latencies, 0.5) * 1000:.1f} ms, "
+        f"p99 {_percentile(latencies, 0.99) * 1000:.1f} ms, max {latencies[-1] * 1000 if latencies else 0:.1f} ms"
+    )
+
+
+def _simulate_statement_latency(seconds: float) -> None:
+    """Delay every statement the async engine sends (aiosqlite runs them on its own thread)."""
+    import aiosqlite
+
+    original = aiosqlite.Connection._execute
+
+    async def delayed(self, fn, *args, **kwargs):
+        if getattr(fn, "__name__", "") in ("execute", "executemany"):
+            await asyncio.sleep(seconds)
+        return await original(self, fn, *args, **kwargs)
+
+    aiosqlite.Connection._execute = delayed
+
+
+async def bench_load(requests: int, concurrency: int, latency_ms: float) -> None:
+    with SessionLocal() as db:
+        user = User(username="bench_load", password="x")
+        db.add(user)
+        db.flush()
+        gen_type = db.query(GeneratorType).first()
+        for i in range(50):
+            gen = Generator(
+                generator_type_id=gen_type.generator_type_id, owner_id=user.user_id, x_position=i, world_position=0
+            )
+            db.add(gen)
+            db.flush()
+            db.add(MapProgress(user_id=user.user_id, generator_id=gen.generator_id))
+        db.commit()
+        token = issue_access_token(user.user_id)
+
+    if latency_ms:
+        _simulate_statement_latency(latency_ms / 1000)
+
+    transport = httpx.ASGITransport(app=app)
+    headers = {"Authorization": f"Bearer {token}"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", headers=headers) as client:
+        for path in ("/progress", "/rebirth/info", "/ranks"):
+            await client.get(path)
+            sem = asyncio.Semaphore(concurrency)
+
+            async def one() -> None:
+                async with sem:
+                    res = await client.get(path)
+                    if res.status_code != 200:
+                        raise RuntimeError(f"{path}: {res.status_code} {res.text}")
+
+            started = time.perf_counter()
+            await asyncio.gather(*[one() for _ in range(requests)])
+            elapsed = time.perf_counter() - started
+            print(f"{path}: {requests} requests, concurrency {concurrency}, latency {latency_ms:g} ms: {requests / elapsed:.0f} req/s")
+
+
+async def _call_asgi(method: str, path: str, headers) -> int:
+    # httpx 를 거치지 않고 scope 를 직접 넘겨 미들웨어 스택 비용만 잰다
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "root_path": "", "headers": headers, "client": ("127.0.0.1", 1), "server": ("bench", 80),
+    }
+    messages = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]["status"]
+
+
+async def bench_middleware(iterations: int) -> None:
+    cases = {
+        "GET / without Origin": ("GET", "/", []),
+        "GET / with allowed Origin": ("GET", "/", [(b"origin", ORIGIN.encode())]),
+        "POST with blocked Origin": ("POST", "/nope", [(b"origin", b"https://evil.example")]),
+    }
+    for name, (method, path, headers) in cases.items():
+        for _ in range(500):
+            await _call_asgi(method, path, headers)
+        runs = []
+        for _ in range(3):
+            started = time.perf_counter()
+            for _ in range(iterations):
+                status = await _call_asgi(method, path, headers)
+            runs.append((time.perf_counter() - started) / iterations * 1e6)
+        print(f"{name}: {min(runs):.1f} us/request (status {status})")
+
+
+async def _run(args) -> None:
+    await app.router.startup()
+    try:
+        if args.scenario == "login":
+            await bench_login(args.logins)
+        elif args.scenario == "load":
+            await bench_load(args.requests, args.concurrency, args.latency_ms)
+        elif args.scenario == "middleware":
+            await bench_middleware(args.iterations)
+    finally:
+        await app.router.shutdown()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m backend.bench")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+    login = sub.add_parser("login", help="event-loop stall while logins hash passwords")
+    login.add_argument("--logins", type=int, default=40)
+    load = sub.add_parser("load", help="read throughput of the main GET endpoints")
+    load.add_argument("--requests", type=int, default=400)
+    load.add_argument("--concurrency", type=int, default=50)
+    load.add_argument("--latency-ms", type=float, default=0)
+    middleware = sub.add_parser("middleware", help="per-request overhead of the middleware stack")
+    middleware.add_argument("--iterations", type=int, default=20000)
+    asyncio.run(_run(parser.parse_args(argv)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -245,28 +245,6 @@ def set_user_sold_energy_value(user, value: BigValue):
   user.sold_energy_high = normalized.high
 
 
-def ensure_user_big_values(user, db=None):
-  changed = False
-  if getattr(user, "money_data", None) is None or getattr(user, "money_high", None) is None:
-    user.money_data = 0
-    user.money_high = 0
-    changed = True
-  
-  if getattr(user, "energy_data", None) is None or getattr(user, "energy_high", None) is None:
-    user.energy_data = 0
-    user.energy_high = 0
-    changed = True
-    
-  if getattr(user, "sold_energy_data", None) is None or getattr(user, "sold_energy_high", None) is None:
-    user.sold_energy_data = 0
-    user.sold_energy_high = 0
-    changed = True
-    
-  if changed and db is not None:
-    db.add(user)
-    db.commit()
-
-
 def _max_bv(left: BigValue, right: BigValue) -> BigValue:
     """Returns the larger of two BigValue objects."""
     if compare(left, right) >= 0: # if left >= right
@@ -1,10 +1,22 @@
 import os
 import sys
 import pathlib
-from sqlalchemy import create_engine
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from sqlalchemy import create_engine, event, inspect, select, text, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool, StaticPool
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import _sessions as _live_sessions
 from dotenv import load_dotenv
 
+from . import memory_diag, metrics
+
 PROJECT_ROOT = pathlib.Path(__file__).resolve().parent.parent
 
 # Load .env file
@@ -29,25 +41,352 @@ def _ensure_sqlite_dir(database_url: str):
         print(f"경고: 데이터베이스 디렉터리 생성 실패: {parent} -> {e}", file=sys.stderr)
 
 
+def _async_database_url(database_url: str):
+    """
+    Map DATABASE_URL to its async driver: sqlite -> aiosqlite, postgresql -> asyncpg.
+    asyncpg does not understand libpq query options (sslmode, channel_binding),
+    so sslmode is passed through connect_args instead.
+    """
+    url = make_url(database_url)
+    connect_args = {}
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    elif backend in ("postgresql", "postgres"):
+        query = dict(url.query)
+        sslmode = query.pop("sslmode", None)
+        query.pop("channel_binding", None)
+        url = url.set(drivername="postgresql+asyncpg", query=query)
+        if sslmode:
+            connect_args["ssl"] = sslmode
+    return url, connect_args
+
+
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data/energy_tycoon.db")
 _ensure_sqlite_dir(DATABASE_URL)
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {},
+# 기동 시 미리 열어둘 비동기 풀 연결 수 (0이면 끔)
+DB_POOL_PREWARM = int(os.getenv("DB_POOL_PREWARM", 2))
+
+_POOL_OPTIONS = dict(
     pool_size=20,              # Increased from default 5
     max_overflow=40,           # Increased from default 10
     pool_timeout=60,           # Increased from default 30 seconds
     pool_recycle=3600,         # Recycle connections after 1 hour
     pool_pre_ping=True,        # Check connection health before using
 )
+
+def _is_sqlite_url(database_url: str) -> bool:
+    return make_url(database_url).get_backend_name() == "sqlite"
+
+
+IS_SQLITE = _is_sqlite_url(DATABASE_URL)
+# SQLite 운영 프로필 (connect 이벤트로 매 연결에 적용)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 65536))  # 64MB page cache per connection
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))  # 256MB
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", 8))
+# Connection execution option: open the transaction with BEGIN IMMEDIATE (SQLite write lock up front)
+SQLITE_BEGIN_IMMEDIATE = "sqlite_begin_immediate"
+
+
+class _TimedPoolMixin:
+    """Pool checkout time (queue wait + connect if needed) feeds metrics."""
+
+    _metrics_name = "db"
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            metrics.record_pool_wait(self._metrics_name, time.perf_counter() - started)
+
+    def recreate(self):
+        # engine.dispose()는 풀을 새로 만든다: 이름과 게이지 등록을 이어받는다
+        pool = super().recreate()
+        pool._metrics_name = self._metrics_name
+        metrics.register_pool(self._metrics_name, pool)
+        return pool
+
+
+class _TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class _TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _is_sqlite_memory(database_url: str) -> bool:
+    database = make_url(database_url).database
+    return not database or database == ":memory:" or "mode=memory" in database_url
+
+
+def _pool_options(database_url: str, poolclass):
+    if not _is_sqlite_url(database_url):
+        return dict(poolclass=poolclass, **_POOL_OPTIONS)
+    if _is_sqlite_memory(database_url):
+        # 메모리 DB는 연결마다 별개의 DB이므로 하나의 연결을 공유해야 한다
+        return dict(poolclass=StaticPool)
+    # 파일 DB: 네트워크가 없으니 pre_ping/recycle은 불필요하고, 쓰기는 어차피 한 번에 하나다.
+    # WAL에서 동시 읽기를 받을 만큼만 연결을 둔다.
+    return dict(poolclass=poolclass, pool_size=SQLITE_POOL_SIZE, max_overflow=0, pool_timeout=60)
+
+
+def _sqlite_on_connect(dbapi_connection, connection_record):
+    # 드라이버의 암묵적 BEGIN을 끄고 begin 이벤트에서 직접 BEGIN / BEGIN IMMEDIATE를 낸다
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def _sqlite_on_begin(conn):
+    if conn.get_execution_options().get(SQLITE_BEGIN_IMMEDIATE):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    else:
+        conn.exec_driver_sql("BEGIN")
+
+
+def _sqlite_on_connect_read_only(dbapi_connection, connection_record):
+    _sqlite_on_connect(dbapi_connection, connection_record)
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+def _install_query_metrics(sync_engine, name: str):
+    """Statement count / DB time per request and slow-query log, plus pool gauges for /metrics."""
+    sync_engine.pool._metrics_name = name
+    metrics.register_pool(name, sync_engine.pool)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_start"].pop()
+        metrics.record_statement(name, statement, time.perf_counter() - started)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start"):
+            conn.info["query_start"].pop()
+
+
+def _install_sqlite_profile(sync_engine, read_only: bool = False):
+    event.listen(sync_engine, "connect", _sqlite_on_connect_read_only if read_only else _sqlite_on_connect)
+    event.listen(sync_engine, "begin", _sqlite_on_begin)
+
+
+# 동기 엔진: 기동 시 스키마 보정/시딩과 오프라인 스크립트 전용
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False} if IS_SQLITE else {},
+    **_pool_options(DATABASE_URL, _TimedQueuePool),
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# 비동기 엔진: 모든 요청 처리 경로에서 사용
+_async_url, _async_connect_args = _async_database_url(DATABASE_URL)
+# aiosqlite는 기본이 NullPool이라 동기 엔진과 같은 큐 풀을 명시한다
+async_engine = create_async_engine(
+    _async_url,
+    connect_args=_async_connect_args,
+    **_pool_options(DATABASE_URL, _TimedAsyncQueuePool),
+)
+if IS_SQLITE:
+    _install_sqlite_profile(engine)
+    _install_sqlite_profile(async_engine.sync_engine)
+_install_query_metrics(engine, "sync")
+_install_query_metrics(async_engine.sync_engine, "primary")
+# expire_on_commit=False: commit 이후 속성 접근이 암묵적인 (비동기 불가) 재조회를 일으키지 않도록
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# 읽기 전용 엔진 (선택): 랭킹/카탈로그/조회성 엔드포인트를 복제본으로 보낸다.
+# 로컬에서는 두 번째 SQLite 파일이나 다른 PostgreSQL 인스턴스를 복제본 대신 쓸 수 있다.
+DATABASE_READ_URL = (os.getenv("DATABASE_READ_URL") or "").strip() or None
+# 쓰기 직후 이 시간(초) 동안은 해당 사용자의 읽기를 primary로 보낸다 (복제 지연 대비 read-your-writes)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+READ_YOUR_WRITES_MAX_USERS = int(os.getenv("READ_YOUR_WRITES_MAX_USERS", 10000))
+
+if DATABASE_READ_URL:
+    _ensure_sqlite_dir(DATABASE_READ_URL)
+    _read_url, _read_connect_args = _async_database_url(DATABASE_READ_URL)
+    read_async_engine = create_async_engine(
+        _read_url,
+        connect_args=_read_connect_args,
+        **_pool_options(DATABASE_READ_URL, _TimedAsyncQueuePool),
+    )
+    if _is_sqlite_url(DATABASE_READ_URL):
+        _install_sqlite_profile(read_async_engine.sync_engine, read_only=True)
+    _install_query_metrics(read_async_engine.sync_engine, "read")
+    ReadSessionLocal = async_sessionmaker(
+        read_async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+    )
+else:
+    read_async_engine = async_engine
+    ReadSessionLocal = AsyncSessionLocal
+
 Base = declarative_base()
 
+# user_id -> 이 시각(monotonic)까지 primary에서 읽는다. LRU로 크기 제한.
+_recent_writers: "OrderedDict[str, float]" = OrderedDict()
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+def mark_user_write(user_id: str | None):
+    """Record that user_id just wrote, so their reads stay on the primary for READ_YOUR_WRITES_SECONDS."""
+    if not user_id or read_async_engine is async_engine or READ_YOUR_WRITES_SECONDS <= 0:
+        return
+    _recent_writers[user_id] = time.monotonic() + READ_YOUR_WRITES_SECONDS
+    _recent_writers.move_to_end(user_id)
+    while len(_recent_writers) > READ_YOUR_WRITES_MAX_USERS:
+        _recent_writers.popitem(last=False)
+
+
+def read_session_for(user_id: str | None = None) -> AsyncSession:
+    """Replica session, or a primary session while user_id is inside its read-your-writes window."""
+    if user_id:
+        until = _recent_writers.get(user_id)
+        if until is not None:
+            if time.monotonic() < until:
+                return AsyncSessionLocal()
+            _recent_writers.pop(user_id, None)
+    return ReadSessionLocal()
+
+
+def _identity_map_report() -> dict:
+    # 요청이 끝난 세션은 닫히며 identity map 이 비워진다. 여기서 커지면 닫히지 않은 세션이 있다는 뜻
+    sessions = list(_live_sessions.values())
+    states = [vars(obj) for sess in sessions for obj in sess.identity_map.values()]
+    return {"entries": len(states), "bytes": memory_diag.estimate_bytes(states), "sessions": len(sessions)}
+
+
+def _compiled_cache_report(sync_engine) -> dict:
+    cache = sync_engine._compiled_cache
+    if cache is None:
+        return {"entries": 0, "bytes": 0, "capacity": 0}
+    return memory_diag.container_report(cache, getattr(cache, "capacity", None))
+
+
+memory_diag.register_cache("database.recent_writers", lambda: memory_diag.container_report(_recent_writers, READ_YOUR_WRITES_MAX_USERS))
+memory_diag.register_cache("sqlalchemy.identity_maps", _identity_map_report)
+memory_diag.register_cache("sqlalchemy.compiled_cache.sync", lambda: _compiled_cache_report(engine))
+memory_diag.register_cache("sqlalchemy.compiled_cache.primary", lambda: _compiled_cache_report(async_engine.sync_engine))
+if read_async_engine is not async_engine:
+    memory_diag.register_cache("sqlalchemy.compiled_cache.read", lambda: _compiled_cache_report(read_async_engine.sync_engine))
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_read_db():
+    """Session on the read engine (falls back to the primary when DATABASE_READ_URL is unset)."""
+    async with ReadSessionLocal() as db:
+        yield db
+
+
+async def prewarm_pool(connections: int = DB_POOL_PREWARM):
+    """Open `connections` pooled connections at startup so the first requests skip the connect/TLS handshake."""
+    if connections <= 0:
+        return
+
+    async def _touch():
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(_touch() for _ in range(connections)))
+
+
+# SQLite는 쓰기 트랜잭션이 한 번에 하나뿐이므로 프로세스 안의 쓰기 구간을 줄 세운다.
+# 락 경합을 busy_timeout 재시도로 푸는 대신 이벤트 루프에서 순서대로 기다린다.
+_sqlite_write_lock = asyncio.Lock()
+_WRITER_KEY = "sqlite_writer"
+
+
+@asynccontextmanager
+async def write_transaction(db: AsyncSession):
+    """
+    Commit section of a write path: make the changes and commit inside the block.
+
+    On SQLite the block ends the session's read transaction (expire_on_commit=False keeps
+    the loaded objects, and the pooled connection goes back while the block waits), waits
+    its turn on an in-process lock and opens a new transaction with BEGIN IMMEDIATE, so the
+    write lock is taken up front instead of upgrading a stale read snapshot (SQLITE_BUSY).
+    Only the block holds the lock: authentication, password
+    hashing and other CPU work belong before it. Conflicts with writes that happened since
+    the rows were read are caught by the User version column (dependencies.commit_optimistic).
+    Nested blocks on the same session reuse the outer one. No-op on other databases.
+    """
+    if not IS_SQLITE or db.info.get(_WRITER_KEY):
         yield db
-    finally:
-        db.close()
+        return
+    if db.in_transaction():
+        # 락을 기다리는 동안 커넥션을 쥐고 있으면 풀이 바닥나 락 보유자가 커넥션을 못 얻는다
+        await db.commit()
+    async with _sqlite_write_lock:
+        await db.connection(execution_options={SQLITE_BEGIN_IMMEDIATE: True})
+        db.info[_WRITER_KEY] = True
+        try:
+            yield db
+        finally:
+            db.info.pop(_WRITER_KEY, None)
+            # 커밋하지 않은 채 끝난 경우에도 다음 writer 전에 쓰기 락을 놓는다
+            if db.in_transaction():
+                await db.rollback()
+
+
+# User.row_version 충돌 시 다시 읽고 재시도하는 횟수 (초과하면 409)
+OPTIMISTIC_RETRIES = int(os.getenv("OPTIMISTIC_RETRIES", 3))
+
+
+async def atomic_update(db: AsyncSession, entity, key, values: dict, *, guard=(), returning=(), sync=None):
+    """
+    `UPDATE entity SET values WHERE key AND guard RETURNING returning` in one round trip.
+
+    `values` may use column expressions (`{User.supercoin: User.supercoin + 1}`), so
+    counters change inside the database with no read-modify-write race; `guard` holds the
+    preconditions (`User.supercoin >= 1`). Returns the RETURNING row (the matched row count
+    when nothing is returned), or None when no row matched (missing row or failed guard). A mapper version_id_col is bumped as well, so
+    concurrent optimistic writers still notice the change.
+
+    On dialects without UPDATE ... RETURNING (SQLite < 3.35) the row is re-selected by
+    `key` alone, inside the same transaction. When `sync` (the ORM instance of that row in
+    this session) is given, the returned values are copied into it as committed state,
+    which replaces the usual `db.refresh()`.
+    """
+    mapper = inspect(entity)
+    values = dict(values)
+    returning = tuple(returning)
+    version_col = mapper.version_id_col
+    if version_col is not None:
+        version_attr = getattr(entity, mapper.get_property_by_column(version_col).key)
+        values.setdefault(version_attr, version_attr + 1)
+        if sync is not None and version_attr not in returning:
+            returning += (version_attr,)
+    stmt = update(entity).where(*key, *guard).values(values).execution_options(synchronize_session=False)
+
+    if returning and db.get_bind().dialect.update_returning:
+        row = (await db.execute(stmt.returning(*returning))).first()
+    else:
+        result = await db.execute(stmt)
+        if not result.rowcount:
+            row = None
+        elif returning:
+            row = (await db.execute(select(*returning).where(*key))).first()
+        else:
+            row = result.rowcount
+    if row is not None and sync is not None and returning:
+        for attr, value in zip(returning, row):
+            set_committed_value(sync, attr.key, value)
+    return row
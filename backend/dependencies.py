@@ -1,12 +1,24 @@
-from typing import Optional
+import inspect
+from typing import Any, Awaitable, Callable, Optional, TypeVar, Union
 
-from fastapi import Cookie, Depends, Header, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import Cookie, Depends, Header, HTTPException, Request
+from sqlalchemy import select
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.exc import StaleDataError
 
-from .auth_utils import TOKEN_TYPE_ACCESS, TOKEN_TYPE_REFRESH, require_user_from_token
-from .database import get_db
+from . import metrics
+
+from .auth_utils import (
+    TOKEN_TYPE_ACCESS,
+    TOKEN_TYPE_REFRESH,
+    require_principal_from_token,
+    require_user_from_token,
+)
+from .database import OPTIMISTIC_RETRIES, get_db, mark_user_write, read_session_for, write_transaction
 from .models import User
-from .bigvalue import ensure_user_big_values
+
+T = TypeVar("T")
 
 
 def _extract_auth_token(header_val: Optional[str], cookie_val: Optional[str]) -> str:
@@ -19,26 +31,121 @@ def _extract_auth_token(header_val: Optional[str], cookie_val: Optional[str]) ->
     raise HTTPException(status_code=401, detail="Authorization token missing")
 
 
-def get_token_from_header(
+async def get_token_from_header(
     authorization: Optional[str] = Header(None),
     access_token: Optional[str] = Cookie(None, alias="ec9db4eab1b820ebb3b5ed98b8ed9994ed9598eb8ba4eb8b88"),
 ) -> str:
     return _extract_auth_token(authorization, access_token)
 
 
-def get_user_and_db(token: str = Depends(get_token_from_header), db: Session = Depends(get_db)):
-    user = require_user_from_token(token, db, expected_type=TOKEN_TYPE_ACCESS)
-    ensure_user_big_values(user, db)
-    return user, db, token
+_READ_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+
+async def get_user_and_db(
+    request: Request, token: str = Depends(get_token_from_header), db: AsyncSession = Depends(get_db)
+):
+    if request.method in _READ_METHODS:
+        user = await require_user_from_token(token, db, expected_type=TOKEN_TYPE_ACCESS)
+        yield user, db, token
+        return
+    user_id = None
+    try:
+        # 쓰기 락은 여기서 잡지 않는다: 각 경로가 커밋 구간만 database.write_transaction 으로 감싼다
+        user = await require_user_from_token(token, db, expected_type=TOKEN_TYPE_ACCESS)
+        user_id = user.user_id
+        yield user, db, token
+    finally:
+        # 이후 잠시 동안 이 사용자의 조회는 복제본 대신 primary로 간다
+        mark_user_write(user_id)
+
+
+async def get_principal(token: str = Depends(get_token_from_header)) -> str:
+    """Verified user id of the access token; the user row is not loaded."""
+    return require_principal_from_token(token)
+
+
+async def get_principal_and_db(user_id: str = Depends(get_principal), db: AsyncSession = Depends(get_db)):
+    return user_id, db
+
+
+async def get_principal_and_read_db(user_id: str = Depends(get_principal)):
+    """Like get_principal_and_db, but on the read replica (primary during the user's read-your-writes window)."""
+    async with read_session_for(user_id) as db:
+        yield user_id, db
+
+
+async def get_user_and_read_db(token: str = Depends(get_token_from_header)):
+    """Like get_user_and_db for read-only endpoints: the user row and session come from the read replica."""
+    user_id = require_principal_from_token(token)
+    async with read_session_for(user_id) as db:
+        user = await require_user_from_token(token, db, expected_type=TOKEN_TYPE_ACCESS)
+        yield user, db, token
+
+
+async def load_user_columns(db: AsyncSession, user_id: str, *columns):
+    """
+    Load only the given User columns as a row (attribute access works like on User).
+    Raises 401 like get_user_and_db when the token's user no longer exists.
+    """
+    row = (await db.execute(select(*columns).where(User.user_id == user_id))).first()
+    if row is None:
+        raise HTTPException(status_code=401, detail="User not found for token")
+    return row
+
+
+async def commit_optimistic(
+    db: AsyncSession,
+    mutate: Callable[[], Union[T, Awaitable[T]]],
+    *instances,
+    retries: Optional[int] = None,
+) -> T:
+    """
+    Run `mutate()` (validate against the loaded rows, then change them) and commit.
+
+    No row lock is held: the User version column turns the UPDATE into
+    `... WHERE row_version = :read`, so a concurrent writer makes the flush raise
+    StaleDataError. The transaction is then rolled back, `instances` (the user and
+    any other rows mutate reads) reloaded and `mutate` run again so its checks see
+    the new state, up to `retries` times before a 409. The rollback expires every
+    row in the session, so `instances` must also cover the rows the handler reads
+    after commit_optimistic returns (None entries are skipped); anything else would
+    be lazy-loaded outside the async context. Rows mutate adds are discarded by the
+    rollback and simply added again. Returns mutate's result.
+    """
+    retries = OPTIMISTIC_RETRIES if retries is None else retries
+    attempt = 0
+    while True:
+        try:
+            # 쓰기 구간은 검증/변경과 커밋만 감싼다 (재시도 전 refresh 는 락 밖에서)
+            async with write_transaction(db):
+                result: Any = mutate()
+                if inspect.isawaitable(result):
+                    result = await result
+                await db.commit()
+            return result
+        except StaleDataError:
+            await db.rollback()
+            exhausted = attempt >= retries
+            metrics.record_optimistic_conflict(exhausted)
+            if exhausted:
+                raise HTTPException(status_code=409, detail="Concurrent update, please retry")
+            attempt += 1
+            try:
+                for instance in instances:
+                    if instance is not None:
+                        await db.refresh(instance)
+            except InvalidRequestError:
+                # 다른 요청이 행을 지웠다
+                raise HTTPException(status_code=409, detail="Concurrent update, please retry")
 
 
-def get_refresh_token(
+async def get_refresh_token(
     authorization: Optional[str] = Header(None),
     refresh_token: Optional[str] = Cookie(None, alias="yeCuXMndsYC3kMnAPw__"),
 ) -> str:
     return _extract_auth_token(authorization, refresh_token)
 
 
-def get_refresh_user_and_db(token: str = Depends(get_refresh_token), db: Session = Depends(get_db)):
-    user = require_user_from_token(token, db, expected_type=TOKEN_TYPE_REFRESH)
+async def get_refresh_user_and_db(token: str = Depends(get_refresh_token), db: AsyncSession = Depends(get_db)):
+    user = await require_user_from_token(token, db, expected_type=TOKEN_TYPE_REFRESH)
     return user, db, token
@@ -0,0 +1,86 @@
+"""
+Weak ETags for per-user state endpoints (/progress, /rebirth/info, /change/rate, /tutorial/status).
+
+The tag is built from users.row_version, which every mutation of the player's state bumps
+(ORM updates through the version_id_col, atomic_update, and touch_user for generator-only
+changes). A conditional GET is therefore answered with 304 after reading that one column,
+before any serialization or generator query.
+
+/progress also changes with time alone: a build finishes when its deadline passes. Its tag
+embeds the earliest pending build deadline, and a tag whose deadline has passed no longer
+validates, so no generator query is needed to decide. Alternative representations of the
+same state (the compact /progress format) carry a variant suffix so a tag only validates
+the representation it was issued for.
+"""
+import time
+from typing import Optional
+
+from fastapi import Request, Response
+
+# 브라우저 캐시는 저장하되 매번 재검증하게 한다 (사용자별 응답이므로 공유 캐시 금지)
+CACHE_CONTROL = "private, no-cache"
+
+
+def user_etag(user_id: str, version: int, deadline: Optional[int] = None, variant: Optional[str] = None) -> str:
+    # 같은 브라우저에서 계정을 바꿔도 다른 사용자의 태그와 겹치지 않도록 user_id 를 넣는다
+    tag = f"{user_id}.{int(version or 0)}"
+    if deadline:
+        tag += f".{int(deadline)}"
+    if variant:
+        tag += f"-{variant}"
+    return f'W/"{tag}"'
+
+
+def _parse_tag(raw: str):
+    raw = raw.strip()
+    if raw.startswith("W/"):
+        raw = raw[2:]
+    raw = raw.strip('"')
+    # user_id(uuid) 에도 '-' 가 있으므로 마지막 '.' 뒤에서만 variant 를 찾는다
+    head, dot, tail = raw.rpartition(".")
+    variant = None
+    if dot and "-" in tail:
+        tail, variant = tail.split("-", 1)
+        raw = f"{head}.{tail}"
+    parts = raw.split(".")
+    if len(parts) not in (2, 3):
+        return None
+    try:
+        version = int(parts[1])
+        deadline = int(parts[2]) if len(parts) == 3 else None
+    except ValueError:
+        return None
+    return parts[0], version, deadline, variant
+
+
+def matching_etag(request: Request, user_id: str, version: int, variant: Optional[str] = None) -> Optional[str]:
+    """
+    The If-None-Match tag that is still valid for this user's current version (its deadline,
+    if any, still ahead), or None. The 304 echoes it back unchanged.
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    now = int(time.time())
+    for raw in header.split(","):
+        parsed = _parse_tag(raw)
+        if parsed is None:
+            continue
+        tag_user, tag_version, deadline, tag_variant = parsed
+        if (
+            tag_user == user_id
+            and tag_version == int(version or 0)
+            and tag_variant == variant
+            and (deadline is None or deadline > now)
+        ):
+            return user_etag(tag_user, tag_version, deadline, variant)
+    return None
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+
+
+def set_etag(response: Response, etag: str) -> None:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
@@ -1,21 +1,34 @@
 import math
+import time
+from contextlib import nullcontext
 from typing import Optional
 
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from .models import User
+from . import metrics
+from .database import OPTIMISTIC_RETRIES, atomic_update, write_transaction
+from .catalog import get_build_time_by_name
+from .models import Generator, GeneratorType, MapProgress, User
 from .bigvalue import (
     BigValue,
+    get_user_energy_value,
+    set_user_energy_value,
     get_user_money_value,
     set_user_money_value,
     get_user_sold_energy_value,
+    set_user_sold_energy_value,
+    compare,
     compare_plain,
     subtract_plain,
+    subtract_values,
     to_plain,
     from_plain,
     normalize,
     add_values,
+    divide_by_2,
+    multiply_by_float,
+    to_payload,
 )
 
 UPGRADE_CONFIG = {
@@ -34,6 +47,16 @@ REBIRTH_UPGRADE_CONFIG = {
     "rebirth_start_money": {"field": "rebirth_start_money_upgrade", "base_cost": 3, "price_growth": 3.0, "cost_offset": 0},
 }
 
+MAX_GENERATOR_BASE = 10
+MAX_GENERATOR_STEP = 1
+DEMOLISH_COST_RATE = 0.5
+
+GENERATOR_UPGRADE_CONFIG = {
+    "production": {"field": "production_upgrade", "base_cost_multiplier": 1, "price_growth": 1.25},
+    "heat_reduction": {"field": "heat_reduction_upgrade", "base_cost_multiplier": 0.8, "price_growth": 1.2},
+    "tolerance": {"field": "tolerance_upgrade", "base_cost_multiplier": 0.9, "price_growth": 1.2},
+}
+
 # 누적 교환량 E에 따라 증가 단계 k = floor(log_3(E)), 증가율은 2k%
 # BigValue 지원을 위해 로그 계산 로직 내부로 통합
 
@@ -197,9 +220,9 @@ def get_upgrade_batch_limit(user: User) -> int:
     return 1 + (getattr(user, "upgrade_batch_upgrade", 0) or 0)
 
 
-def calculate_upgrade_cost(user: User, key: str, amount: int = 1) -> int:
+def calculate_upgrade_cost(user: User, key: str, amount: int = 1, level: Optional[int] = None) -> int:
     meta = get_upgrade_meta(key)
-    current_level = getattr(user, meta["field"], 0)
+    current_level = getattr(user, meta["field"], 0) if level is None else level
     base_cost = float(meta["base_cost"])
     growth = float(meta["price_growth"])
     offset = float(meta.get("cost_offset", 1))
@@ -229,40 +252,309 @@ def calculate_rebirth_upgrade_cost(user: User, key: str, amount: int = 1) -> int
     return int(total_cost)
 
 
-def apply_upgrade(user: User, db: Session, key: str, amount: int, *, commit: bool = True) -> User:
+def touch_user(user: User) -> None:
+    """
+    Bump row_version (the state version behind the ETags in etag.py) when only generator
+    rows changed. The next flush writes the new value with the usual
+    `WHERE row_version = :read` guard, so a concurrent write still raises StaleDataError.
+    """
+    # 명시적으로 넣은 값은 ORM 이 버전 생성 대신 그대로 쓰고, WHERE 에는 읽었던 값이 들어간다
+    user.row_version = user.row_version + 1
+
+
+async def _update_user_values(db: AsyncSession, user: User, compute, *, commit: bool) -> None:
+    """
+    Write compute()'s `{User column: value or expression}` with a single
+    `UPDATE ... WHERE row_version = :read RETURNING` and copy the result into `user`
+    (no refresh round trip). compute() validates against `user`; if another request
+    changed the row since it was read, the row is reloaded and compute() runs again.
+    """
+    for attempt in range(OPTIMISTIC_RETRIES + 1):
+        values = compute()
+        # commit=False 면 호출자가 write_transaction 구간과 커밋을 맡는다
+        async with write_transaction(db) if commit else nullcontext():
+            row = await atomic_update(
+                db, User, [User.user_id == user.user_id], values,
+                guard=[User.row_version == user.row_version], returning=tuple(values), sync=user,
+            )
+            if row is not None and commit:
+                await db.commit()
+        if row is not None:
+            return
+        exhausted = attempt >= OPTIMISTIC_RETRIES
+        metrics.record_optimistic_conflict(exhausted)
+        if exhausted:
+            break
+        await db.refresh(user)
+    raise HTTPException(status_code=409, detail="Concurrent update, please retry")
+
+
+async def apply_upgrade(user: User, db: AsyncSession, key: str, amount: int, *, commit: bool = True) -> User:
     meta = get_upgrade_meta(key)
     if amount <= 0:
         raise HTTPException(status_code=400, detail="Increase amount must be at least 1")
-    max_amount = get_upgrade_batch_limit(user)
-    if amount > max_amount:
-        raise HTTPException(status_code=400, detail=f"한 번에 {max_amount}회까지만 업그레이드할 수 있습니다.")
-    cost = calculate_upgrade_cost(user, key, amount)
-    money_value = get_user_money_value(user)
-    if compare_plain(money_value, cost) < 0:
-        raise HTTPException(status_code=400, detail="Not enough money")
-    set_user_money_value(user, subtract_plain(money_value, cost))
-    setattr(user, meta["field"], getattr(user, meta["field"], 0) + amount)
-    if commit:
-        db.commit()
-        db.refresh(user)
-    else:
-        db.flush()
+
+    level_col = getattr(User, meta["field"])
+
+    def upgrade():
+        max_amount = get_upgrade_batch_limit(user)
+        if amount > max_amount:
+            raise HTTPException(status_code=400, detail=f"한 번에 {max_amount}회까지만 업그레이드할 수 있습니다.")
+        cost = calculate_upgrade_cost(user, key, amount)
+        money_value = get_user_money_value(user)
+        if compare_plain(money_value, cost) < 0:
+            raise HTTPException(status_code=400, detail="Not enough money")
+        money_after = normalize(subtract_plain(money_value, cost))
+        return {
+            level_col: level_col + amount,
+            User.money_data: money_after.data,
+            User.money_high: money_after.high,
+        }
+
+    await _update_user_values(db, user, upgrade, commit=commit)
     return user
 
 
-def apply_rebirth_upgrade(user: User, db: Session, key: str, amount: int, *, commit: bool = True) -> User:
+async def apply_rebirth_upgrade(user: User, db: AsyncSession, key: str, amount: int, *, commit: bool = True) -> User:
     meta = get_rebirth_upgrade_meta(key)
     if amount <= 0:
         raise HTTPException(status_code=400, detail="Increase amount must be at least 1")
-    cost = calculate_rebirth_upgrade_cost(user, key, amount)
-    rebirths = getattr(user, "rebirth_count", 0) or 0
-    if rebirths < cost:
-        raise HTTPException(status_code=400, detail="환생이 부족합니다.")
-    setattr(user, "rebirth_count", rebirths - cost)
-    setattr(user, meta["field"], getattr(user, meta["field"], 0) + amount)
-    if commit:
-        db.commit()
-        db.refresh(user)
-    else:
-        db.flush()
+
+    level_col = getattr(User, meta["field"])
+
+    def upgrade():
+        cost = calculate_rebirth_upgrade_cost(user, key, amount)
+        rebirths = getattr(user, "rebirth_count", 0) or 0
+        if rebirths < cost:
+            raise HTTPException(status_code=400, detail="환생이 부족합니다.")
+        return {level_col: level_col + amount, User.rebirth_count: User.rebirth_count - cost}
+
+    await _update_user_values(db, user, upgrade, commit=commit)
     return user
+
+
+def apply_exchange(user: User, amount_bv: BigValue) -> tuple[BigValue, float]:
+    """
+    Sell `amount_bv` energy at the progressive rate: energy -> money, sold_energy grows.
+    Mutates the user in place and returns (gained money, average rate).
+    """
+    energy_value = get_user_energy_value(user)
+    if compare(energy_value, amount_bv) < 0:
+        raise HTTPException(status_code=400, detail="Not enough energy")
+    gained_bv, avg_rate = calculate_progressive_exchange(user, amount_bv)
+    set_user_energy_value(user, subtract_values(energy_value, amount_bv))
+    set_user_money_value(user, add_values(get_user_money_value(user), gained_bv))
+    set_user_sold_energy_value(user, add_values(get_user_sold_energy_value(user), amount_bv))
+    return gained_bv, avg_rate
+
+
+def auto_exchange_amount(user: User) -> Optional[BigValue]:
+    """Energy the user's auto-exchange policy sells now: percent% of the energy above threshold."""
+    percent = getattr(user, "auto_exchange_percent", 0) or 0
+    if percent <= 0:
+        return None
+    energy_value = get_user_energy_value(user)
+    threshold = normalize(BigValue(user.auto_exchange_threshold_data or 0, user.auto_exchange_threshold_high or 0))
+    if compare(energy_value, threshold) <= 0:
+        return None
+    excess = subtract_values(energy_value, threshold)
+    amount_bv = excess if percent >= 100 else multiply_by_float(excess, percent / 100)
+    if amount_bv.data <= 0:
+        return None
+    return amount_bv
+
+
+def apply_auto_exchange(user: User) -> Optional[dict]:
+    """
+    Run the auto-exchange policy inside the caller's transaction (autosave, /sync) with
+    the same pricing and sold-energy bookkeeping as /change/energy2money.
+    Returns the exchange summary, or None when nothing was sold.
+    """
+    amount_bv = auto_exchange_amount(user)
+    if amount_bv is None:
+        return None
+    gained_bv, avg_rate = apply_exchange(user, amount_bv)
+    amount_payload = to_payload(amount_bv)
+    gained_payload = to_payload(gained_bv)
+    return {
+        "amount_data": amount_payload["data"],
+        "amount_high": amount_payload["high"],
+        "gained_data": gained_payload["data"],
+        "gained_high": gained_payload["high"],
+        "rate": avg_rate,
+    }
+
+
+# --- 발전기 규칙: progress_routes 의 개별 엔드포인트와 /sync 명령 배치가 함께 쓴다 ---
+
+
+def max_generators_allowed(user: User) -> int:
+    bonus = getattr(user, "max_generators_bonus", 0) or 0
+    return MAX_GENERATOR_BASE + bonus * MAX_GENERATOR_STEP
+
+
+def demolish_cost(generator_type: GeneratorType) -> BigValue:
+    """Calculate demolish cost as 50% of generator cost."""
+    cost_val = BigValue(generator_type.cost_data, generator_type.cost_high)
+    # Calculate 50% by dividing by 2 (O(1) using BigValue)
+    return divide_by_2(cost_val)
+
+
+def build_duration(generator_type: Optional[GeneratorType] = None, level: Optional[int] = None, user: Optional[User] = None) -> int:
+    base_duration = 2  # Default: 2 seconds if no build time in data
+    if generator_type and getattr(generator_type, "name", None):
+        seconds = get_build_time_by_name(generator_type.name)
+        if seconds:
+            base_duration = max(1, int(seconds))
+    
+    # Apply build speed reduction from special upgrades
+    if user:
+        build_speed_reduction = getattr(user, "build_speed_reduction", 0) or 0
+        # 10% reduction per level, max 90% reduction (level 9)
+        reduction_rate = min(build_speed_reduction * 0.1, 0.9)
+        base_duration = int(base_duration * (1 - reduction_rate))
+    
+    return max(1, base_duration)  # Minimum 1 second
+
+
+def maybe_complete_build(generator: Generator, now: Optional[int] = None) -> bool:
+    if not generator.isdeveloping:
+        return False
+    now = now or int(time.time())
+    if generator.build_complete_ts and generator.build_complete_ts <= now:
+        generator.isdeveloping = False
+        generator.build_complete_ts = None
+        generator.running = True
+        return True
+    return False
+
+
+def get_generator_upgrade_meta(key: str):
+    meta = GENERATOR_UPGRADE_CONFIG.get(key)
+    if not meta:
+        raise HTTPException(status_code=404, detail="Unknown upgrade")
+    return meta
+
+
+def calculate_generator_upgrade_cost(gt: GeneratorType, mp: MapProgress, key: str, amount: int) -> BigValue:
+    """Calculate upgrade cost using BigValue operations (O(1) per level, no 10^high computation)"""
+    meta = get_generator_upgrade_meta(key)
+    # Use BigValue cost from cost_data and cost_high
+    cost_val = BigValue(gt.cost_data, gt.cost_high)
+    current_level = getattr(mp, meta["field"], 0) or 0
+
+    # Calculate total cost by summing each level's cost using BigValue
+    total_cost = BigValue(0, 0)
+    for i in range(amount):
+        level = current_level + i + 1
+        # Calculate: base_cost * base_cost_multiplier * (price_growth ^ level)
+        level_multiplier = meta["base_cost_multiplier"] * (meta["price_growth"] ** level)
+        level_cost = multiply_by_float(cost_val, level_multiplier)
+        total_cost = add_values(total_cost, level_cost)
+
+    return total_cost
+
+
+def calculate_skip_build_cost(gt: GeneratorType, generator: Generator, user: User, remaining: int) -> BigValue:
+    """Proportional cost of finishing a build now: remaining / total duration of the full cost, divided by 10."""
+    total_duration = max(1, build_duration(gt, generator.level, user))
+    full_cost_val = BigValue(gt.cost_data, gt.cost_high)
+    # Proportional cost based on remaining time: (remaining / total_duration) * full_cost / 10
+    cost_val = multiply_by_float(full_cost_val, remaining / total_duration)
+    # Reduce cost by 10x
+    cost_val = multiply_by_float(cost_val, 0.1)
+    # Ensure at least cost of 1
+    if cost_val.data == 0:
+        cost_val = from_plain(1)
+    return cost_val
+
+
+def serialize_generator(
+    g: Generator,
+    type_name: Optional[str] = None,
+    cost_data: Optional[int] = None,
+    cost_high: Optional[int] = None,
+    mp: Optional[MapProgress] = None,
+):
+    """Serialize generator with BigValue cost."""
+    # Get cost_data and cost_high from generator_type if not provided
+    if cost_data is None:
+        cost_data = getattr(getattr(g, "generator_type", None), "cost_data", 0)
+    if cost_high is None:
+        cost_high = getattr(getattr(g, "generator_type", None), "cost_high", 0)
+    
+    return {
+        "generator_id": g.generator_id,
+        "generator_type_id": g.generator_type_id,
+        "type": type_name,
+        "cost_data": cost_data,
+        "cost_high": cost_high,
+        "x_position": g.x_position,
+        "world_position": g.world_position,
+        "level": g.level,
+        "isdeveloping": g.isdeveloping,
+        "build_complete_ts": g.build_complete_ts,
+        "heat": g.heat,
+        "running": getattr(g, "running", True),
+        "upgrades": {
+            "production": getattr(mp, "production_upgrade", 0) if mp else 0,
+            "heat_reduction": getattr(mp, "heat_reduction_upgrade", 0) if mp else 0,
+            "tolerance": getattr(mp, "tolerance_upgrade", 0) if mp else 0,
+        },
+    }
+
+
+# serialize_generators_compact 의 flags 비트
+GEN_FLAG_RUNNING = 1
+GEN_FLAG_DEVELOPING = 2
+
+
+def serialize_generators_compact(rows) -> dict:
+    """
+    Struct-of-arrays form of serialize_generator for (Generator, MapProgress) rows: one list
+    per field, index i of every list is generator i. Type name / cost appear once in `types`
+    and generators point at them through `type_idx`; running / isdeveloping are packed into
+    `flags` (GEN_FLAG_*).
+    """
+    types = []
+    type_index = {}
+    ids, type_idx, xs, worlds, levels, heats, build_ts, flags = [], [], [], [], [], [], [], []
+    production, heat_reduction, tolerance = [], [], []
+    for g, mp in rows:
+        idx = type_index.get(g.generator_type_id)
+        if idx is None:
+            gt = g.generator_type
+            idx = type_index[g.generator_type_id] = len(types)
+            types.append({
+                "generator_type_id": g.generator_type_id,
+                "type": getattr(gt, "name", None),
+                "cost_data": getattr(gt, "cost_data", 0),
+                "cost_high": getattr(gt, "cost_high", 0),
+            })
+        ids.append(g.generator_id)
+        type_idx.append(idx)
+        xs.append(g.x_position)
+        worlds.append(g.world_position)
+        levels.append(g.level)
+        heats.append(g.heat)
+        build_ts.append(g.build_complete_ts)
+        flags.append(
+            (GEN_FLAG_RUNNING if getattr(g, "running", True) else 0)
+            | (GEN_FLAG_DEVELOPING if g.isdeveloping else 0)
+        )
+        production.append(getattr(mp, "production_upgrade", 0) if mp else 0)
+        heat_reduction.append(getattr(mp, "heat_reduction_upgrade", 0) if mp else 0)
+        tolerance.append(getattr(mp, "tolerance_upgrade", 0) if mp else 0)
+    return {
+        "count": len(ids),
+        "types": types,
+        "ids": ids,
+        "type_idx": type_idx,
+        "x": xs,
+        "world": worlds,
+        "level": levels,
+        "heat": heats,
+        "build_complete_ts": build_ts,
+        "flags": flags,
+        "upgrades": {"production": production, "heat_reduction": heat_reduction, "tolerance": tolerance},
+    }
@@ -1,25 +1,35 @@
+import hmac
 import os
+import re
 import sys
+import time
 import pathlib
+from functools import lru_cache
 from urllib.parse import urlparse
 
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi import Request, HTTPException, Header
-from fastapi.responses import JSONResponse
-
 # Ensure package imports work even when run as a script (python backend/main.py)
 ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
 if str(ROOT_DIR) not in sys.path:
     sys.path.append(str(ROOT_DIR))
 
-from backend import models  # noqa: F401 - ensure models are registered
-from backend.database import Base, SessionLocal, engine
-from backend.init_db import ensure_user_upgrade_columns, ensure_big_value_columns, ensure_generator_columns, ensure_map_progress_columns, ensure_play_time_column, sync_generator_types, ensure_generator_type_columns, ensure_refresh_jti_column
-from backend.routes import auth_routes, change_routes, generator_routes, progress_routes, rank_routes, upgrade_routes, rebirth_routes, tutorial_routes, inquiry_routes, special_routes, sync_routes
+# 다른 무거운 import보다 먼저 불러와야 STARTUP_PROFILE=1 일 때 import 시간이 잡힌다
+from backend import startup_profile
+
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi import Request, HTTPException, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
+from sqlalchemy.orm.exc import StaleDataError
+from starlette.requests import cookie_parser
+
+from backend import memory_diag, metrics, models, request_profiler  # noqa: F401 - ensure models are registered
+from backend.database import prewarm_pool
+from backend.init_db import run_migrations
+from backend.responses import FastJSONResponse
+from backend.routes import auth_routes, change_routes, generator_routes, progress_routes, rank_routes, upgrade_routes, rebirth_routes, tutorial_routes, inquiry_routes, special_routes, sync_routes, admin_routes
 from backend.auth_utils import CSRF_COOKIE_NAME, CSRF_HEADER_NAME
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 
 _deploy_frontend = os.getenv("DEPLOY_FRONTEND_URL", "https://energytycoon.pages.dev").rstrip("/")
 # Allow preview/stage Cloudflare Pages domains by default (overridable via FRONTEND_ORIGIN_REGEX)
@@ -51,7 +61,6 @@ else:
 
 _origin_regex = None
 _origin_regex_env = os.getenv("FRONTEND_ORIGIN_REGEX")
-import re
 
 if _origin_regex_env:
     try:
@@ -74,97 +83,180 @@ app.add_middleware(
 )
 
 # Origin check middleware for state-changing requests (basic CSRF guard)
-SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+SAFE_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
 # Authentication endpoints that can bypass CSRF token requirement
-auth_bypass_paths = ["/login", "/signup", "/register", "/refresh/access", "/csrf-token", "/csrf"]
+auth_bypass_paths = frozenset({"/login", "/signup", "/register", "/refresh/access", "/csrf-token", "/csrf"})
+_allowed_origins = frozenset(origins)
+_EXPOSE_HEADERS = b"access-control-expose-headers"
+_CSRF_HEADER_KEY = CSRF_HEADER_NAME.lower().encode("latin-1")
 
 
+@lru_cache(maxsize=512)
 def _is_origin_allowed(origin: str) -> bool:
     """Check if origin is in the allowed list or matches the regex pattern."""
     if not origin:
         return False
-    if origin in origins:
+    if origin in _allowed_origins:
         return True
     if _origin_regex and _origin_regex.match(origin):
         return True
     return False
 
 
-@app.middleware("http")
-async def enforce_origin(request: Request, call_next):
-    origin = request.headers.get("origin")
-    referer = request.headers.get("referer")
-    
-    # Extract origin from referer if origin header is not present
-    referer_origin = None
-    if referer:
+# lru_cache 는 내용을 노출하지 않아 항목 수와 용량만 보고한다
+memory_diag.register_cache(
+    "main.origin_allowed_cache",
+    lambda: {"entries": _is_origin_allowed.cache_info().currsize, "bytes": None, "capacity": _is_origin_allowed.cache_info().maxsize},
+)
+
+
+def _referer_origin(referer: str) -> str:
+    """scheme://netloc of a Referer, same result as urlparse for absolute URLs."""
+    scheme, sep, rest = referer.partition("://")
+    if not sep:
         parsed = urlparse(referer)
-        referer_origin = f"{parsed.scheme}://{parsed.netloc}"
-    
-    # Determine the actual origin to validate
-    request_origin = origin or referer_origin
-    
-    # Debug logging
-    import sys
-    # print(f"🔍 CORS Debug - Origin: {origin}, Referer: {referer}, Request Origin: {request_origin}", file=sys.stderr)
-    
-    # Validate origin against whitelist for CSRF protection
-    # Note: We don't set CORS headers here anymore, CORSMiddleware handles that.
-    # We just check if the origin is allowed for security purposes.
-    is_allowed = False
-    if request_origin and _is_origin_allowed(request_origin):
-        is_allowed = True
-    
-    # CSRF protection for state-changing requests
-    if request.method not in SAFE_METHODS:
-        # Skip CSRF check for authentication endpoints
-        if request.url.path not in auth_bypass_paths:
+        return f"{parsed.scheme}://{parsed.netloc}"
+    for delim in "/?#":
+        idx = rest.find(delim)
+        if idx != -1:
+            rest = rest[:idx]
+    return f"{scheme.lower()}://{rest}"
+
+
+def _forbidden(detail: str) -> JSONResponse:
+    return JSONResponse(status_code=403, content={"detail": detail})
+
+
+class OriginCSRFMiddleware:
+    """
+    Pure ASGI origin/CSRF guard. Avoids BaseHTTPMiddleware's per-request task and
+    body stream wrapping; only the response start message is touched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # 중복 헤더는 Request.headers.get과 같이 첫 값만 쓴다
+        origin = referer = cookie = csrf_header = None
+        for key, value in scope["headers"]:
+            if key == b"origin":
+                if origin is None:
+                    origin = value.decode("latin-1")
+            elif key == b"referer":
+                if referer is None:
+                    referer = value.decode("latin-1")
+            elif key == b"cookie":
+                if cookie is None:
+                    cookie = value.decode("latin-1")
+            elif key == _CSRF_HEADER_KEY:
+                if csrf_header is None:
+                    csrf_header = value.decode("latin-1")
+
+        # Determine the actual origin to validate (referer fallback when Origin is absent)
+        request_origin = origin or (_referer_origin(referer) if referer else None)
+
+        # Validate origin against whitelist for CSRF protection
+        # Note: CORSMiddleware sets the CORS headers; this only decides whether the origin is trusted.
+        is_allowed = bool(request_origin) and _is_origin_allowed(request_origin)
+
+        # CSRF protection for state-changing requests
+        path = scope.get("root_path", "") + scope["path"]
+        if scope["method"] not in SAFE_METHODS and path not in auth_bypass_paths:
             # If origin is not allowed, block state-changing requests
             if not is_allowed:
-                 return JSONResponse(
-                    status_code=403,
-                    content={"detail": "Origin not allowed for state-changing request"}
-                )
-
-            csrf_cookie = request.cookies.get(CSRF_COOKIE_NAME)
-            csrf_header = request.headers.get(CSRF_HEADER_NAME)
-            
+                await _forbidden("Origin not allowed for state-changing request")(scope, receive, send)
+                return
+
+            csrf_cookie = cookie_parser(cookie).get(CSRF_COOKIE_NAME) if cookie else None
             # Require at least one of cookie or header to be present
             if not csrf_cookie and not csrf_header:
-                return JSONResponse(
-                    status_code=403,
-                    content={"detail": "CSRF token missing"}
-                )
-            
+                await _forbidden("CSRF token missing")(scope, receive, send)
+                return
             # If both are present, they should match
             if csrf_cookie and csrf_header and csrf_cookie != csrf_header:
-                return JSONResponse(
-                    status_code=403,
-                    content={"detail": "CSRF token mismatch"}
-                )
-
-    response = await call_next(request)
-    
-    # We rely on CORSMiddleware for Access-Control headers
-    # But we ensure CSRF header is exposed
-    if is_allowed:
-        response.headers.setdefault("Access-Control-Expose-Headers", CSRF_HEADER_NAME)
-        
-    return response
+                await _forbidden("CSRF token mismatch")(scope, receive, send)
+                return
+
+        if not is_allowed:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_expose(message):
+            # We rely on CORSMiddleware for Access-Control headers, but ensure the CSRF header
+            # (and ETag, for conditional GETs from fetch) is exposed
+            if message["type"] == "http.response.start":
+                headers = message.setdefault("headers", [])
+                if not any(key.lower() == _EXPOSE_HEADERS for key, _ in headers):
+                    headers.append((_EXPOSE_HEADERS, f"{CSRF_HEADER_NAME}, ETag".encode("latin-1")))
+            await send(message)
+
+        await self.app(scope, receive, send_with_expose)
+
+
+app.add_middleware(OriginCSRFMiddleware)
+
+
+class MetricsMiddleware:
+    """
+    Outermost ASGI layer: opens the per-request DB stats context that the engine
+    hooks in database.py fill in, then records latency under the route template.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = metrics.RequestStats(scope)
+        token = metrics.current_request.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.current_request.reset(token)
+            metrics.record_request(stats, scope["method"], status, time.perf_counter() - started)
+
+
+# 샘플링/관리자 헤더로 선택된 요청만 cProfile 로 실행 (설정이 없으면 미들웨어 자체를 올리지 않는다)
+if request_profiler.ENABLED:
+    app.add_middleware(request_profiler.RequestProfilerMiddleware)
+app.add_middleware(MetricsMiddleware)
+if startup_profile.STARTUP_PROFILE:
+    app.add_middleware(startup_profile.FirstByteTimer)
 
 @app.on_event("startup")
 async def startup_event():
     # DB setup and seeding (moved to startup to avoid blocking import/health checks)
-    Base.metadata.create_all(bind=engine)
-    ensure_user_upgrade_columns()
-    ensure_big_value_columns()
-    ensure_generator_columns()
-    ensure_map_progress_columns()
-    ensure_generator_type_columns()
-    ensure_play_time_column()
-    ensure_refresh_jti_column()
-    with SessionLocal() as db:
-        sync_generator_types(db)
+    # 이미 최신인 DB는 schema_version 조회 한 번으로 끝난다
+    with startup_profile.phase("migrations"):
+        run_migrations()
+    # 첫 요청이 연결 수립 비용을 치르지 않도록 풀을 미리 채운다
+    with startup_profile.phase("pool prewarm"):
+        await prewarm_pool()
+    memory_diag.start_rss_sampler()
+    if startup_profile.STARTUP_PROFILE:
+        startup_profile.report()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    memory_diag.stop_rss_sampler()
 
 
 # Routers
@@ -179,6 +271,25 @@ app.include_router(tutorial_routes.router, prefix="/tutorial", tags=["tutorial"]
 app.include_router(special_routes.router)
 app.include_router(inquiry_routes.router)
 app.include_router(sync_routes.router)
+app.include_router(admin_routes.router)
+
+
+@app.exception_handler(StaleDataError)
+async def stale_data_handler(request: Request, exc: StaleDataError):
+    # commit_optimistic 을 거치지 않은 커밋이 User.row_version 충돌을 만나면 500 대신 재시도 가능한 409
+    metrics.record_optimistic_conflict(exhausted=True)
+    return JSONResponse(status_code=409, content={"detail": "Concurrent update, please retry"})
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(request: Request):
+    # 내부 수집용: METRICS_TOKEN이 없으면 엔드포인트 자체를 숨기고, 있으면 Bearer 토큰이 일치해야 한다
+    if not metrics.METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    auth = request.headers.get("authorization", "")
+    if not hmac.compare_digest(auth.encode(), f"Bearer {metrics.METRICS_TOKEN}".encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/")
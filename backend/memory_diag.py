@@ -0,0 +1,221 @@
+"""
+Process memory diagnostics for the admin endpoints.
+
+  - cache registry: modules that keep in-process maps register a reporter that
+    returns their entry count, estimated bytes and capacity
+  - tracemalloc top allocators, and a diff against the snapshot taken by the previous call
+  - RSS samples kept in a small ring by a background task started in main.py
+
+tracemalloc slows allocation noticeably, so it only runs when MEMORY_TRACEMALLOC=1
+at boot or after an admin turns it on.
+"""
+import asyncio
+import gc
+import itertools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from typing import Callable, Dict, Optional
+
+MEMORY_TRACEMALLOC = os.getenv("MEMORY_TRACEMALLOC", "").strip().lower() in ("1", "true", "yes")
+MEMORY_TRACEMALLOC_FRAMES = int(os.getenv("MEMORY_TRACEMALLOC_FRAMES", 1))
+MEMORY_RSS_INTERVAL = int(os.getenv("MEMORY_RSS_INTERVAL", 60))
+MEMORY_RSS_SAMPLES = int(os.getenv("MEMORY_RSS_SAMPLES", 180))
+
+# 바이트 추정 시 전체를 훑지 않고 일부 항목만 재서 평균을 낸다
+_SIZE_SAMPLE = 64
+
+_caches: Dict[str, Callable[[], dict]] = {}
+_rss_samples: "deque[tuple[int, int]]" = deque(maxlen=max(1, MEMORY_RSS_SAMPLES))
+_snapshot_lock = threading.Lock()
+_last_snapshot: Optional[tracemalloc.Snapshot] = None
+_last_snapshot_at: Optional[float] = None
+_sampler_task: Optional[asyncio.Task] = None
+
+if MEMORY_TRACEMALLOC:
+    tracemalloc.start(MEMORY_TRACEMALLOC_FRAMES)
+
+
+def register_cache(name: str, reporter: Callable[[], dict]) -> None:
+    """Register `reporter() -> {"entries", "bytes", "capacity"?}` under `name` (re-registering replaces it)."""
+    _caches[name] = reporter
+
+
+def _deep_size(obj, depth: int = 2) -> int:
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        return size + sum(_deep_size(k, depth - 1) + _deep_size(v, depth - 1) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset, deque)):
+        return size + sum(_deep_size(v, depth - 1) for v in obj)
+    return size
+
+
+def estimate_bytes(container) -> int:
+    """Container overhead plus the sampled mean size of its items times its length."""
+    total = sys.getsizeof(container)
+    count = len(container)
+    if not count:
+        return total
+    if isinstance(container, dict):
+        sample = [sys.getsizeof(k) + _deep_size(v) for k, v in itertools.islice(container.items(), _SIZE_SAMPLE)]
+    else:
+        sample = [_deep_size(v) for v in itertools.islice(container, _SIZE_SAMPLE)]
+    return total + int(sum(sample) / len(sample) * count)
+
+
+def container_report(container, capacity: Optional[int] = None) -> dict:
+    """Reporter body for a plain dict/list/deque cache."""
+    # 다른 스레드가 동시에 수정하면 순회가 실패할 수 있어 복사본을 잰다
+    snapshot = container.copy() if hasattr(container, "copy") else list(container)
+    return {"entries": len(snapshot), "bytes": estimate_bytes(snapshot), "capacity": capacity}
+
+
+def cache_report() -> Dict[str, dict]:
+    out = {}
+    for name, reporter in sorted(_caches.items()):
+        try:
+            out[name] = reporter()
+        except Exception as exc:  # 진단 도구가 진단 대상 때문에 죽지 않도록
+            out[name] = {"error": f"{type(exc).__name__}: {exc}"}
+    return out
+
+
+def current_rss() -> Optional[int]:
+    """Resident set size in bytes (Linux /proc), else peak RSS from getrusage."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def sample_rss() -> Optional[int]:
+    rss = current_rss()
+    if rss is not None:
+        _rss_samples.append((int(time.time()), rss))
+    return rss
+
+
+def rss_trend() -> dict:
+    samples = list(_rss_samples)
+    out = {"interval_seconds": MEMORY_RSS_INTERVAL, "samples": [{"ts": ts, "rss_bytes": rss} for ts, rss in samples]}
+    if len(samples) >= 2:
+        (t0, r0), (t1, r1) = samples[0], samples[-1]
+        out["delta_bytes"] = r1 - r0
+        out["bytes_per_hour"] = int((r1 - r0) / (t1 - t0) * 3600) if t1 > t0 else 0
+    return out
+
+
+async def _rss_sampler():
+    while True:
+        sample_rss()
+        await asyncio.sleep(MEMORY_RSS_INTERVAL)
+
+
+def start_rss_sampler() -> None:
+    global _sampler_task
+    if MEMORY_RSS_INTERVAL <= 0 or (_sampler_task is not None and not _sampler_task.done()):
+        return
+    _sampler_task = asyncio.get_running_loop().create_task(_rss_sampler())
+
+
+def stop_rss_sampler() -> None:
+    global _sampler_task
+    if _sampler_task is not None:
+        _sampler_task.cancel()
+        _sampler_task = None
+
+
+def set_tracing(enabled: bool) -> bool:
+    """Start/stop tracemalloc; stopping also drops the stored diff baseline."""
+    global _last_snapshot, _last_snapshot_at
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_TRACEMALLOC_FRAMES)
+    elif not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+        with _snapshot_lock:
+            _last_snapshot = _last_snapshot_at = None
+    return tracemalloc.is_tracing()
+
+
+def _take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+
+
+def _fmt_frame(trace) -> str:
+    frame = trace.traceback[0]
+    return f"{frame.filename}:{frame.lineno}"
+
+
+def top_allocators(limit: int = 25, key_type: str = "lineno") -> list:
+    snapshot = _take_snapshot()
+    return [
+        {"where": _fmt_frame(stat), "bytes": stat.size, "count": stat.count}
+        for stat in snapshot.statistics(key_type)[:limit]
+    ]
+
+
+def snapshot_diff(limit: int = 25, key_type: str = "lineno") -> dict:
+    """Growth since the previous call's snapshot; the first call only records a baseline."""
+    global _last_snapshot, _last_snapshot_at
+    snapshot = _take_snapshot()
+    now = time.time()
+    with _snapshot_lock:
+        previous, previous_at = _last_snapshot, _last_snapshot_at
+        _last_snapshot, _last_snapshot_at = snapshot, now
+    if previous is None:
+        return {"baseline": True, "since": None, "diff": []}
+    stats = snapshot.compare_to(previous, key_type)
+    return {
+        "baseline": False,
+        "since": previous_at,
+        "elapsed_seconds": round(now - previous_at, 3),
+        "total_delta_bytes": sum(s.size_diff for s in stats),
+        "diff": [
+            {
+                "where": _fmt_frame(s),
+                "delta_bytes": s.size_diff,
+                "delta_count": s.count_diff,
+                "bytes": s.size,
+                "count": s.count,
+            }
+            for s in stats[:limit]
+        ],
+    }
+
+
+def report(limit: int = 25) -> dict:
+    tracing = tracemalloc.is_tracing()
+    out = {
+        "rss_bytes": current_rss(),
+        "rss_trend": rss_trend(),
+        "caches": cache_report(),
+        "gc": {"counts": gc.get_count(), "objects": len(gc.get_objects())},
+        "tracemalloc": {"tracing": tracing},
+    }
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        out["tracemalloc"].update({
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "overhead_bytes": tracemalloc.get_tracemalloc_memory(),
+            "top": top_allocators(limit),
+        })
+    return out
@@ -0,0 +1,265 @@
+"""
+In-process request / database metrics rendered in Prometheus text format.
+
+database.py feeds statement timings and pool checkout waits, the middleware in
+main.py opens a per-request context and records route latency. No external
+client library: a handful of counters and fixed-bucket histograms keyed by labels.
+"""
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from . import memory_diag
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))
+METRICS_TOKEN = (os.getenv("METRICS_TOKEN") or "").strip() or None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+slow_query_logger = logging.getLogger("backend.slow_query")
+_lock = threading.Lock()
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+    def __init__(self, name: str, help_text: str, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., +Inf count, sum]
+        self.series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        with _lock:
+            row = self.series.get(labels)
+            if row is None:
+                row = [0] * (len(self.buckets) + 1) + [0.0]
+                self.series[labels] = row
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[len(self.buckets)] += 1
+            row[-1] += value
+
+    def render(self, out: list):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} histogram")
+        for labels, row in sorted(self.series.items()):
+            for i, bound in enumerate(self.buckets):
+                out.append(f"{self.name}_bucket{_fmt_labels(labels + (('le', _fmt_num(bound)),))} {row[i]}")
+            count = row[len(self.buckets)]
+            out.append(f"{self.name}_bucket{_fmt_labels(labels + (('le', '+Inf'),))} {count}")
+            out.append(f"{self.name}_sum{_fmt_labels(labels)} {_fmt_num(row[-1])}")
+            out.append(f"{self.name}_count{_fmt_labels(labels)} {count}")
+
+
+class _Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.series: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        with _lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self, out: list):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} counter")
+        for labels, value in sorted(self.series.items()):
+            out.append(f"{self.name}{_fmt_labels(labels)} {_fmt_num(value)}")
+
+
+def _fmt_num(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels) + "}"
+
+
+http_request_duration = _Histogram(
+    "http_request_duration_seconds", "Request latency by route template.", LATENCY_BUCKETS
+)
+http_requests = _Counter("http_requests_total", "Requests by route template and status.")
+request_db_statements = _Histogram(
+    "http_request_db_statements", "SQL statements executed per request.", STATEMENT_BUCKETS
+)
+request_db_time = _Histogram(
+    "http_request_db_seconds", "Total time spent in SQL per request.", LATENCY_BUCKETS
+)
+request_pool_wait = _Histogram(
+    "http_request_db_pool_wait_seconds", "Total pool checkout wait per request.", POOL_WAIT_BUCKETS
+)
+db_statements = _Counter("db_statements_total", "SQL statements executed, by engine.")
+db_statement_seconds = _Counter("db_statement_seconds_total", "Time spent executing SQL, by engine.")
+db_slow_statements = _Counter("db_slow_statements_total", "Statements slower than SLOW_QUERY_MS, by route.")
+db_pool_checkout_wait = _Histogram(
+    "db_pool_checkout_wait_seconds", "Time to obtain a pooled connection, by engine.", POOL_WAIT_BUCKETS
+)
+sync_tolerance_checks = _Counter(
+    "sync_tolerance_checks_total", "/sync client value checks by field and result (accepted/rejected)."
+)
+sync_tolerance_rescued = _Counter(
+    "sync_tolerance_rescued_total",
+    "Client values accepted only because tolerance is compared across highs (409s avoided), by field.",
+)
+optimistic_conflicts = _Counter(
+    "db_optimistic_conflicts_total",
+    "User row version conflicts (StaleDataError) by route and outcome (retried/exhausted).",
+)
+
+# name -> pool, registered by database.py for saturation gauges at scrape time
+_pools: Dict[str, object] = {}
+
+
+def _series_report() -> dict:
+    # 라벨 조합 수는 라우트 템플릿/엔진/상태 코드로 제한되지만, 새 라벨이 늘어나는지 여기서 확인할 수 있다
+    all_series = [metric.series for metric in (
+        http_request_duration, http_requests, request_db_statements, request_db_time, request_pool_wait,
+        db_statements, db_statement_seconds, db_slow_statements, db_pool_checkout_wait,
+        sync_tolerance_checks, sync_tolerance_rescued, optimistic_conflicts,
+    )]
+    return {
+        "entries": sum(len(series) for series in all_series),
+        "bytes": sum(memory_diag.estimate_bytes(dict(series)) for series in all_series),
+    }
+
+
+memory_diag.register_cache("metrics.series", _series_report)
+
+
+class RequestStats:
+    __slots__ = ("scope", "statements", "db_seconds", "pool_wait_seconds")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+
+    @property
+    def route(self) -> str:
+        return route_label(self.scope)
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def route_label(scope) -> str:
+    """Route template (bounded cardinality); unmatched paths collapse to one label."""
+    route = scope.get("route") if scope else None
+    path = getattr(route, "path", None)
+    return path or "<unmatched>"
+
+
+def register_pool(name: str, pool) -> None:
+    _pools[name] = pool
+
+
+def record_pool_wait(engine_name: str, seconds: float) -> None:
+    db_pool_checkout_wait.observe(seconds, (("engine", engine_name),))
+    stats = current_request.get()
+    if stats is not None:
+        stats.pool_wait_seconds += seconds
+
+
+def record_statement(engine_name: str, statement: str, seconds: float) -> None:
+    db_statements.inc((("engine", engine_name),))
+    db_statement_seconds.inc((("engine", engine_name),), seconds)
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += seconds
+    elapsed_ms = seconds * 1000
+    if elapsed_ms >= SLOW_QUERY_MS:
+        route = stats.route if stats is not None else "<background>"
+        db_slow_statements.inc((("route", route),))
+        slow_query_logger.warning(
+            "slow query %.1f ms on %s [%s]: %s", elapsed_ms, engine_name, route, " ".join(statement.split())[:500]
+        )
+
+
+def record_request(stats: RequestStats, method: str, status: int, seconds: float) -> None:
+    route = (("route", stats.route),)
+    http_request_duration.observe(seconds, route + (("method", method),))
+    http_requests.inc(route + (("method", method), ("status", str(status))))
+    request_db_statements.observe(stats.statements, route)
+    request_db_time.observe(stats.db_seconds, route)
+    request_pool_wait.observe(stats.pool_wait_seconds, route)
+
+
+def record_sync_tolerance(field: str, accepted: bool, legacy_accepted: bool) -> None:
+    sync_tolerance_checks.inc((("field", field), ("result", "accepted" if accepted else "rejected")))
+    if accepted and not legacy_accepted:
+        sync_tolerance_rescued.inc((("field", field),))
+
+
+def record_optimistic_conflict(exhausted: bool) -> None:
+    stats = current_request.get()
+    route = stats.route if stats is not None else "<background>"
+    optimistic_conflicts.inc((("route", route), ("outcome", "exhausted" if exhausted else "retried")))
+
+
+def _render_pools(out: list):
+    gauges = (
+        ("db_pool_size", "Configured pool size."),
+        ("db_pool_checked_out", "Connections currently checked out."),
+        ("db_pool_overflow", "Overflow connections currently open."),
+        ("db_pool_saturation", "Checked-out connections / (pool_size + max_overflow)."),
+    )
+    rows = {name: [] for name, _ in gauges}
+    for engine_name, pool in sorted(_pools.items()):
+        label = _fmt_labels((("engine", engine_name),))
+        size = pool.size() if hasattr(pool, "size") else 1
+        checked_out = pool.checkedout() if hasattr(pool, "checkedout") else 0
+        overflow = max(0, pool.overflow()) if hasattr(pool, "overflow") else 0
+        capacity = size + max(0, getattr(pool, "_max_overflow", 0) or 0)
+        rows["db_pool_size"].append(f"db_pool_size{label} {size}")
+        rows["db_pool_checked_out"].append(f"db_pool_checked_out{label} {checked_out}")
+        rows["db_pool_overflow"].append(f"db_pool_overflow{label} {overflow}")
+        rows["db_pool_saturation"].append(f"db_pool_saturation{label} {_fmt_num(checked_out / capacity if capacity else 0.0)}")
+    for name, help_text in gauges:
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} gauge")
+        out.extend(rows[name])
+
+
+def render() -> str:
+    out: list = []
+    for metric in (
+        http_request_duration,
+        http_requests,
+        request_db_statements,
+        request_db_time,
+        request_pool_wait,
+        db_statements,
+        db_statement_seconds,
+        db_slow_statements,
+        db_pool_checkout_wait,
+        sync_tolerance_checks,
+        sync_tolerance_rescued,
+        optimistic_conflicts,
+    ):
+        metric.render(out)
+    _render_pools(out)
+    out.append("# TYPE process_uptime_seconds gauge")
+    out.append(f"process_uptime_seconds {_fmt_num(round(time.monotonic() - _STARTED, 3))}")
+    return "\n".join(out) + "\n"
+
+
+_STARTED = time.monotonic()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Boolean, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Boolean, Float, Text, UniqueConstraint
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -38,10 +38,20 @@ class User(Base):
     build_speed_reduction = Column(Integer, default=0, server_default="0", nullable=False)
     energy_multiplier = Column(Integer, default=0, server_default="0", nullable=False)
     exchange_rate_multiplier = Column(Integer, default=0, server_default="0", nullable=False)
+    # /sync 로 적용된 마지막 action seq (high-water mark). 이 값 이하의 seq 는 재전송으로 보고 건너뛴다
+    sync_seq = Column(BigInteger, default=0, server_default="0", nullable=False)
+    # 자동 환전 정책: autosave / sync 트랜잭션 안에서 threshold 초과 에너지의 percent% 를 판다 (0 = 끔)
+    auto_exchange_percent = Column(Integer, default=0, server_default="0", nullable=False)
+    auto_exchange_threshold_data = Column(BigInteger, default=0, server_default="0", nullable=False)
+    auto_exchange_threshold_high = Column(BigInteger, default=0, server_default="0", nullable=False)
+    # 낙관적 동시성: ORM UPDATE 마다 1씩 오르고 WHERE row_version = :읽은값 으로 검사된다 (충돌 시 StaleDataError)
+    row_version = Column(Integer, default=0, server_default="0", nullable=False)
 
     generators = relationship("Generator", back_populates="owner", cascade=CASCADE_OPTION)
     map_progresses = relationship("MapProgress", back_populates="user", cascade=CASCADE_OPTION)
 
+    __mapper_args__ = {"version_id_col": row_version}
+
 
 class GeneratorType(Base):
     __tablename__ = "generator_types"
@@ -100,3 +110,26 @@ class Inquiry(Base):
     created_at = Column(BigInteger, nullable=False)  # timestamp in milliseconds
 
     user = relationship("User")
+
+
+class RateLimitBucket(Base):
+    """Shared sliding-window counters (RATE_LIMIT_BACKEND=database, PostgreSQL only)."""
+    __tablename__ = "rate_limits"
+
+    key = Column(String, primary_key=True)
+    window_index = Column(BigInteger, default=0, nullable=False)
+    hits = Column(Integer, default=0, nullable=False)
+    prev_hits = Column(Integer, default=0, nullable=False)
+    allowed = Column(Integer, default=1, nullable=False)
+    updated_at = Column(Float, default=0, nullable=False, index=True)
+
+
+class SyncBatch(Base):
+    """Stored /sync response per (user, idempotency key), replayed verbatim on retries."""
+    __tablename__ = "sync_batches"
+
+    user_id = Column(String, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    idempotency_key = Column(String(128), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(BigInteger, nullable=False, index=True)  # timestamp in milliseconds
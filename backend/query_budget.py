@@ -0,0 +1,193 @@
+"""
+Per-endpoint SQL statement budgets (N+1 guard).
+
+    python -m backend.query_budget [--verbose]
+
+Seeds an in-memory SQLite database with a player that owns many generators, many
+inquiries from distinct users and many ranked users, calls every endpoint through the
+ASGI app and counts the SQL statements each request executes (BEGIN/COMMIT excluded).
+Each endpoint is exercised at two seed scales; the run fails (exit 1) when a count
+exceeds its budget or changes with the row count, i.e. when a loop issues a query per row.
+"""
+import os
+import sys
+
+# 앱을 import 하기 전에 공유 in-memory DB 로 고정 (sync 엔진의 마이그레이션과 async 엔진이 같은 DB 를 본다)
+os.environ["DATABASE_URL"] = "sqlite:///file:query_budget?mode=memory&cache=shared&uri=true"
+os.environ.pop("DATABASE_READ_URL", None)
+os.environ.setdefault("JWT_SECRET", "query-budget-" + "x" * 32)
+os.environ.setdefault("DB_POOL_PREWARM", "0")
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import delete, event, select  # noqa: E402
+
+from .auth_utils import CSRF_HEADER_NAME, issue_access_token  # noqa: E402
+from .database import SessionLocal, async_engine  # noqa: E402
+from .main import app  # noqa: E402
+from .models import Generator, GeneratorType, Inquiry, MapProgress, RateLimitBucket, User  # noqa: E402
+from .routes.inquiry_routes import ADMIN_USER_ID  # noqa: E402
+
+ORIGIN = "https://energytycoon.pages.dev"
+SCALES = (4, 12)
+USERS_PER_SCALE = 25
+INQUIRIES_PER_SCALE = 10
+
+# (method, path, body, max statements). path/body 는 seed 결과(ctx)를 받는 함수일 수 있다.
+# 쓰기 요청은 payload 도 seed 크기에 맞춰 커지므로(autosave, bulk-upgrade) 행 단위 쿼리가 있으면 두 scale 의 수가 달라진다.
+BUDGETS = [
+    ("GET", "/progress", None, 2),
+    ("GET", "/inquiries", None, 2),
+    ("GET", "/rank", None, 1),
+    ("GET", "/ranks?criteria=money", None, 2),
+    ("GET", "/generator_types", None, 1),
+    ("GET", "/rebirth/info", None, 1),
+    ("GET", "/change/rate", None, 1),
+    ("GET", "/tutorial/status", None, 1),
+    ("POST", "/progress", lambda ctx: {
+        "user_id": ctx["user_id"], "generator_type_id": ctx["type_id"],
+        "x_position": 10_000, "world_position": 0,
+    }, 7),
+    ("POST", lambda ctx: f"/progress/{ctx['generator_ids'][0]}/state", {"running": False}, 6),
+    ("POST", lambda ctx: f"/progress/{ctx['generator_ids'][0]}/upgrade", {"upgrade": "production", "amount": 1}, 8),
+    ("POST", lambda ctx: f"/progress/{ctx['generator_ids'][0]}/build/skip", None, 7),
+    ("DELETE", lambda ctx: f"/progress/{ctx['generator_ids'][0]}", None, 8),
+    ("POST", "/progress/autosave", lambda ctx: {
+        "play_time_ms": 1000,
+        "generators": [{"generator_id": gid, "heat": 1, "running": True} for gid in ctx["generator_ids"]],
+    }, 5),
+    ("POST", "/generators/bulk-upgrade", lambda ctx: {
+        "upgrades": [{"generator_id": gid, "key": "tolerance", "amount": 1} for gid in ctx["generator_ids"]],
+    }, 7),
+    ("POST", "/upgrade/production", {"amount": 1}, 2),
+    ("POST", "/upgrade/bulk", {"upgrades": [
+        {"endpoint": "production", "amount": 1}, {"endpoint": "demand", "amount": 1},
+    ]}, 3),
+    ("POST", "/change/energy2money", {"amount_data": 1000, "amount_high": 0}, 3),
+    ("POST", "/sync", lambda ctx: {"actions": [], "clientState": ctx["client_state"]}, 1),
+    ("POST", "/sync", lambda ctx: {
+        "actions": [
+            {"type": "generator_state", "payload": {"generator_id": gid, "running": False}} for gid in ctx["generator_ids"]
+        ],
+        "clientState": ctx["client_state"],
+    }, 4),
+    ("POST", "/tutorial/progress", {"step": 5}, 2),
+    ("POST", "/special/award_supercoin", None, 2),
+    ("POST", "/inquiries", {"type": "bug", "content": "budget"}, 3),
+    ("POST", lambda ctx: f"/inquiries/{ctx['inquiry_ids'][0]}/accept", None, 4),
+    ("POST", lambda ctx: f"/inquiries/{ctx['inquiry_ids'][0]}/reject", None, 3),
+]
+
+
+def seed(scale: int) -> dict:
+    """Replace all player rows with a fresh data set sized by `scale`."""
+    with SessionLocal() as db:
+        for model in (Inquiry, MapProgress, Generator, User, RateLimitBucket):
+            db.execute(delete(model))
+        type_id = db.scalar(select(GeneratorType.generator_type_id).order_by(GeneratorType.cost_high, GeneratorType.cost_data))
+
+        player = User(
+            user_id=ADMIN_USER_ID, username="budget_admin", password="x",
+            money_data=500_000, money_high=30, energy_data=500_000, energy_high=30,
+            max_generators_bonus=scale * 10, supercoin=10,
+        )
+        db.add(player)
+        generator_ids = []
+        for i in range(scale * 10):
+            g = Generator(
+                generator_type_id=type_id, owner_id=ADMIN_USER_ID,
+                x_position=i, world_position=0, isdeveloping=(i == 0), build_complete_ts=4_000_000_000 if i == 0 else None,
+            )
+            db.add(g)
+            db.flush()
+            db.add(MapProgress(user_id=ADMIN_USER_ID, generator_id=g.generator_id))
+            generator_ids.append(g.generator_id)
+
+        inquiry_ids = []
+        for i in range(scale * USERS_PER_SCALE):
+            u = User(username=f"budget_{scale}_{i}", password="x", money_data=i, money_high=i % 7, energy_data=i)
+            db.add(u)
+            if i < scale * INQUIRIES_PER_SCALE:
+                db.flush()
+                inq = Inquiry(user_id=u.user_id, type="bug", content=f"#{i}", created_at=i)
+                db.add(inq)
+                db.flush()
+                inquiry_ids.append(inq.inquiry_id)
+        db.commit()
+
+    return {
+        "user_id": ADMIN_USER_ID,
+        "type_id": type_id,
+        "generator_ids": generator_ids,
+        "inquiry_ids": inquiry_ids,
+        "client_state": {
+            "money": {"data": 500_000, "high": 30},
+            "energy": {"data": 500_000, "high": 30},
+            "timestamp": 1,
+        },
+    }
+
+
+class _StatementCounter:
+    def __init__(self, sync_engine):
+        self.count = 0
+        self.statements = []
+        event.listen(sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        head = statement.lstrip()[:8].upper()
+        if head.startswith(("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")):
+            return
+        self.count += 1
+        self.statements.append(" ".join(statement.split())[:160])
+
+    def reset(self):
+        self.count = 0
+        self.statements = []
+
+
+def _resolve(value, ctx):
+    return value(ctx) if callable(value) else value
+
+
+def run(verbose: bool = False) -> int:
+    counter = _StatementCounter(async_engine.sync_engine)
+    failures = []
+    with TestClient(app) as client:
+        for method, path, body, budget in BUDGETS:
+            counts = []
+            label = f"{method} {path if isinstance(path, str) else path({'generator_ids': ['{id}'], 'inquiry_ids': ['{id}']})}"
+            for scale in SCALES:
+                ctx = seed(scale)
+                headers = {
+                    "Origin": ORIGIN,
+                    "Authorization": f"Bearer {issue_access_token(ADMIN_USER_ID)}",
+                    CSRF_HEADER_NAME: "query-budget",
+                }
+                counter.reset()
+                res = client.request(method, _resolve(path, ctx), json=_resolve(body, ctx), headers=headers)
+                if res.status_code >= 400:
+                    failures.append(f"{label}: HTTP {res.status_code} at scale {scale}: {res.text[:200]}")
+                counts.append(counter.count)
+                if verbose:
+                    for stmt in counter.statements:
+                        print(f"    [{scale}] {stmt}")
+            verdict = "ok"
+            if max(counts) > budget:
+                verdict = "OVER BUDGET"
+                failures.append(f"{label}: {max(counts)} statements > budget {budget}")
+            if len(set(counts)) > 1:
+                verdict = "GROWS WITH ROWS"
+                failures.append(f"{label}: statement count changes with seed size {dict(zip(SCALES, counts))}")
+            print(f"{label:<48} {'/'.join(map(str, counts)):>7}  (budget {budget})  {verdict}")
+
+    if failures:
+        print("\nquery budget violations:", file=sys.stderr)
+        for line in failures:
+            print(f"  - {line}", file=sys.stderr)
+        return 1
+    print("\nall endpoints within query budget")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run(verbose="--verbose" in sys.argv[1:]))
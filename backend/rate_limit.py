@@ -0,0 +1,204 @@
+"""
+Rate limiting with sliding-window counters.
+
+Each key keeps two counters: hits in the current fixed window and hits in the
+previous one. The estimate is ``prev * (1 - elapsed / window) + cur``, so every
+check is O(1) regardless of how many attempts were made.
+
+Storage is pluggable (RATE_LIMIT_BACKEND):
+  - "memory"   : per-process OrderedDict, LRU-evicted at RATE_LIMIT_MAX_KEYS
+  - "database" : shared ``rate_limits`` table, one atomic upsert per check,
+                 so limits hold across uvicorn workers / Cloud Run instances.
+                 PostgreSQL only: on SQLite these writes would contend with the
+                 in-process writer lock (database.write_transaction), so the
+                 store refuses to start there; use "memory" instead.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from sqlalchemy import text
+
+from . import memory_diag
+from .database import async_engine
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").strip().lower()
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 10000))
+# database 백엔드에서 오래된 행을 지우는 주기 / 보존 기간 (초)
+RATE_LIMIT_PRUNE_INTERVAL = int(os.getenv("RATE_LIMIT_PRUNE_INTERVAL", 300))
+RATE_LIMIT_RETENTION = int(os.getenv("RATE_LIMIT_RETENTION", 3600))
+
+
+def _window_state(window: int, hits: int, prev_hits: int, current: int) -> Tuple[int, int]:
+    """Roll stored counters forward to the current window index."""
+    if window == current:
+        return hits, prev_hits
+    if window == current - 1:
+        return 0, hits
+    return 0, 0
+
+
+def _retry_after(now: float, window_seconds: float) -> float:
+    return window_seconds - (now % window_seconds)
+
+
+class MemoryRateLimitStore:
+    """Per-process store. Bounded by LRU eviction instead of periodic rescans."""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        # key -> [window, hits, prev_hits, updated_at]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+
+    def _touch(self, key: str) -> list:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = [0, 0, 0, 0.0]
+            self._entries[key] = entry
+            if len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return entry
+
+    async def hit(self, key: str, limit: int, window_seconds: float, now: float) -> Optional[float]:
+        current = int(now // window_seconds)
+        weight = 1.0 - (now % window_seconds) / window_seconds
+        entry = self._touch(key)
+        hits, prev_hits = _window_state(entry[0], entry[1], entry[2], current)
+        allowed = prev_hits * weight + hits < limit
+        if allowed:
+            hits += 1
+        entry[0], entry[1], entry[2], entry[3] = current, hits, prev_hits, now
+        return None if allowed else _retry_after(now, window_seconds)
+
+    async def record_failure(self, key: str, now: float) -> None:
+        entry = self._touch(key)
+        entry[1] += 1
+        entry[3] = now
+
+    async def failures(self, key: str) -> Optional[Tuple[int, float]]:
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= 0:
+            return None
+        return entry[1], entry[3]
+
+    async def reset(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+
+# 현재 창 기준으로 굴린 값. 갱신 SET 절은 모두 기존 행 값을 참조한다 (SQLite/PostgreSQL 공통).
+_ROLLED_HITS = (
+    "CASE WHEN rate_limits.window_index = :current THEN rate_limits.hits ELSE 0 END"
+)
+_ROLLED_PREV = (
+    "CASE WHEN rate_limits.window_index = :current THEN rate_limits.prev_hits"
+    " WHEN rate_limits.window_index = :current - 1 THEN rate_limits.hits ELSE 0 END"
+)
+# asyncpg는 파라미터 타입을 문맥으로 추론하므로 가중치를 실수로 명시한다
+_ALLOWED = f"({_ROLLED_PREV}) * CAST(:weight AS DOUBLE PRECISION) + ({_ROLLED_HITS}) < :limit"
+
+_HIT_SQL = text(
+    f"""
+    INSERT INTO rate_limits (key, window_index, hits, prev_hits, allowed, updated_at)
+    VALUES (:key, :current, 1, 0, 1, :now)
+    ON CONFLICT (key) DO UPDATE SET
+        window_index = :current,
+        hits = CASE WHEN {_ALLOWED} THEN ({_ROLLED_HITS}) + 1 ELSE ({_ROLLED_HITS}) END,
+        prev_hits = {_ROLLED_PREV},
+        allowed = CASE WHEN {_ALLOWED} THEN 1 ELSE 0 END,
+        updated_at = :now
+    RETURNING allowed
+    """
+)
+_FAILURE_SQL = text(
+    """
+    INSERT INTO rate_limits (key, window_index, hits, prev_hits, allowed, updated_at)
+    VALUES (:key, 0, 1, 0, 1, :now)
+    ON CONFLICT (key) DO UPDATE SET hits = rate_limits.hits + 1, updated_at = :now
+    """
+)
+_FAILURES_SQL = text("SELECT hits, updated_at FROM rate_limits WHERE key = :key")
+_RESET_SQL = text("DELETE FROM rate_limits WHERE key = :key")
+_PRUNE_SQL = text("DELETE FROM rate_limits WHERE updated_at < :cutoff")
+
+
+class DatabaseRateLimitStore:
+    """Shared store on the ``rate_limits`` table. Every check is one upsert round trip."""
+
+    def __init__(self, engine=async_engine, retention: int = RATE_LIMIT_RETENTION):
+        if engine.dialect.name == "sqlite":
+            # 로그인 경로는 요청 세션의 커넥션을 쥔 채 한도를 검사한다: 여기서 SQLite 쓰기 락을 기다리면 풀이 막힌다
+            raise RuntimeError("RATE_LIMIT_BACKEND=database requires PostgreSQL; use RATE_LIMIT_BACKEND=memory on SQLite")
+        self.engine = engine
+        self.retention = retention
+        self._next_prune = 0.0
+
+    async def _maybe_prune(self, conn, now: float):
+        if now < self._next_prune:
+            return
+        self._next_prune = now + RATE_LIMIT_PRUNE_INTERVAL
+        await conn.execute(_PRUNE_SQL, {"cutoff": now - self.retention})
+
+    async def hit(self, key: str, limit: int, window_seconds: float, now: float) -> Optional[float]:
+        params = {
+            "key": key,
+            "current": int(now // window_seconds),
+            "weight": 1.0 - (now % window_seconds) / window_seconds,
+            "limit": limit,
+            "now": now,
+        }
+        async with self.engine.begin() as conn:
+            allowed = (await conn.execute(_HIT_SQL, params)).scalar_one()
+            await self._maybe_prune(conn, now)
+        return None if allowed else _retry_after(now, window_seconds)
+
+    async def record_failure(self, key: str, now: float) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(_FAILURE_SQL, {"key": key, "now": now})
+
+    async def failures(self, key: str) -> Optional[Tuple[int, float]]:
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(_FAILURES_SQL, {"key": key})).first()
+        if row is None or row[0] <= 0:
+            return None
+        return int(row[0]), float(row[1])
+
+    async def reset(self, key: str) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(_RESET_SQL, {"key": key})
+
+
+def _build_store():
+    if RATE_LIMIT_BACKEND in ("database", "db", "sql"):
+        return DatabaseRateLimitStore()
+    return MemoryRateLimitStore()
+
+
+store = _build_store()
+if isinstance(store, MemoryRateLimitStore):
+    memory_diag.register_cache("rate_limit.memory_store", lambda: memory_diag.container_report(store._entries, store.max_keys))
+
+
+async def check_rate(key: str, limit: int, window_seconds: float) -> Optional[float]:
+    """Count one attempt for ``key``. Returns None if allowed, else seconds until the window rolls."""
+    return await store.hit(key, limit, window_seconds, time.time())
+
+
+async def backoff_remaining(key: str, base_seconds: float, max_seconds: float) -> float:
+    """Seconds left on the exponential backoff (base * 2^failures) for ``key``, 0 if none."""
+    state = await store.failures(key)
+    if state is None:
+        return 0.0
+    count, last_fail = state
+    cooldown = min(base_seconds * (2 ** min(count, 32)), max_seconds)
+    return max(0.0, cooldown - (time.time() - last_fail))
+
+
+async def record_failure(key: str) -> None:
+    await store.record_failure(key, time.time())
+
+
+async def reset(key: str) -> None:
+    await store.reset(key)
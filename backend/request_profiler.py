@@ -0,0 +1,169 @@
+"""
+Opt-in per-request profiling for production traffic.
+
+A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>` or when the
+PROFILE_SAMPLE_RATE coin flip selects it. The handler runs under cProfile and the
+stats are written (pstats format) into PROFILE_DIR, a ring of at most PROFILE_MAX_FILES
+files tagged with method, route template and latency. admin_routes lists and serves them.
+
+Unprofiled requests pay one header scan (only when PROFILE_TOKEN is set) and one
+random() call (only when sampling is on). With neither configured main.py does not
+install the middleware at all.
+"""
+import asyncio
+import hmac
+import io
+import os
+import random
+import re
+import secrets
+import tempfile
+import threading
+import time
+from typing import List, Optional
+
+from . import metrics
+
+PROFILE_TOKEN = (os.getenv("PROFILE_TOKEN") or "").strip() or None
+PROFILE_SAMPLE_RATE = min(1.0, max(0.0, float(os.getenv("PROFILE_SAMPLE_RATE", 0))))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 50))
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "energytycoon-profiles")
+PROFILE_HEADER = "x-profile"
+
+ENABLED = bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+_HEADER_KEY = PROFILE_HEADER.encode("latin-1")
+_ID_HEADER = b"x-profile-id"
+_SUFFIX = ".prof"
+# <id>__<METHOD>__<route slug>__<ms>.prof
+_NAME_RE = re.compile(r"^(?P<id>\d+-[0-9a-f]+)__(?P<method>[A-Z]+)__(?P<route>[\w.-]*)__(?P<ms>\d+)\.prof$")
+_ID_RE = re.compile(r"^\d+-[0-9a-f]+$")
+
+# cProfile 은 스레드당 하나만 켤 수 있다: 프로파일 중인 요청이 있으면 다른 요청은 건너뛴다
+_active_lock = threading.Lock()
+_ring_lock = threading.Lock()
+
+
+def _route_slug(route: str) -> str:
+    return re.sub(r"[^\w.-]+", "_", route.strip("/")) or "root"
+
+
+def _header_requested(scope) -> bool:
+    for key, value in scope.get("headers") or ():
+        if key == _HEADER_KEY:
+            return hmac.compare_digest(value, PROFILE_TOKEN.encode("latin-1"))
+    return False
+
+
+def _should_profile(scope) -> bool:
+    if PROFILE_TOKEN and _header_requested(scope):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _write_profile(profiler, name: str) -> None:
+    with _ring_lock:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        tmp_path = os.path.join(PROFILE_DIR, name + ".tmp")
+        profiler.dump_stats(tmp_path)
+        os.replace(tmp_path, os.path.join(PROFILE_DIR, name))
+        # 가장 오래된 파일부터 지워 링 크기를 유지한다 (id 가 ms 타임스탬프로 시작하므로 이름순 = 시간순)
+        names = sorted(n for n in os.listdir(PROFILE_DIR) if n.endswith(_SUFFIX))
+        for stale in names[: max(0, len(names) - PROFILE_MAX_FILES)]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, stale))
+            except OSError:
+                pass
+
+
+def list_profiles() -> List[dict]:
+    """Newest first: id, method, route, latency and size of every profile in the ring."""
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    out = []
+    for name in sorted(names, reverse=True):
+        match = _NAME_RE.match(name)
+        if not match:
+            continue
+        try:
+            size = os.path.getsize(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            continue
+        out.append({
+            "id": match["id"],
+            "method": match["method"],
+            "route": match["route"],
+            "latency_ms": int(match["ms"]),
+            "created_at": int(match["id"].split("-", 1)[0]),
+            "bytes": size,
+            "file": name,
+        })
+    return out
+
+
+def profile_path(profile_id: str) -> Optional[str]:
+    """Path of the ring file for `profile_id`, or None if it was rotated out / never existed."""
+    if not _ID_RE.match(profile_id or ""):
+        return None
+    for entry in list_profiles():
+        if entry["id"] == profile_id:
+            return os.path.join(PROFILE_DIR, entry["file"])
+    return None
+
+
+def render_text(path: str, sort: str = "cumulative", limit: int = 60) -> str:
+    """Human-readable pstats report for a stored profile."""
+    import pstats
+
+    buf = io.StringIO()
+    stats = pstats.Stats(path, stream=buf)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return buf.getvalue()
+
+
+class RequestProfilerMiddleware:
+    """
+    Runs selected requests under cProfile. Note the event loop is shared: while a
+    profiled request awaits, frames from concurrent requests on the same worker are
+    recorded too, so read samples taken under load with that in mind.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        if not _active_lock.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = f"{int(time.time() * 1000)}-{secrets.token_hex(3)}"
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", []).append((_ID_HEADER, profile_id.encode("latin-1")))
+            await send(message)
+
+        # cProfile/pstats 는 실제로 프로파일할 때만 불러온다 (꺼져 있으면 import 비용 없음)
+        import cProfile
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send_with_id)
+            finally:
+                profiler.disable()
+        finally:
+            _active_lock.release()
+            elapsed_ms = int((time.perf_counter() - started) * 1000)
+            name = f"{profile_id}__{scope['method']}__{_route_slug(metrics.route_label(scope))}__{elapsed_ms}{_SUFFIX}"
+            try:
+                await asyncio.to_thread(_write_profile, profiler, name)
+            except OSError:
+                pass
@@ -0,0 +1,119 @@
+"""
+Direct-to-bytes JSON responses (orjson).
+
+FastAPI runs every returned dict through jsonable_encoder (a recursive Python walk that
+rebuilds each nested dict) before the response class encodes it. For /progress with
+hundreds of generators that walk costs more than the DB query. Endpoints on the hot path
+therefore return FastJSONResponse themselves: FastAPI passes a returned Response through
+untouched and orjson encodes the dicts and Pydantic models in one pass.
+
+FastJSONResponse is also the app's default_response_class, so the remaining endpoints are
+at least encoded by orjson after jsonable_encoder.
+
+GET /progress can also answer in a compact columnar form (game_logic.serialize_generators_compact),
+chosen with ?format=compact or `Accept: application/vnd.energytycoon.compact+json`. JSON with one
+object per generator stays the default.
+
+The busiest endpoints (/progress, /progress/autosave, /sync, /generators/bulk-upgrade) also
+speak MessagePack: a request body sent as `Content-Type: application/msgpack` is decoded by
+MsgPackRoute straight into the dict FastAPI validates against the Pydantic model, and
+`Accept: application/msgpack` makes negotiate() encode the response with msgpack instead of
+JSON. JSON stays the default in both directions.
+"""
+import json
+from typing import Any, Optional
+
+import msgpack
+import orjson
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+
+_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+COMPACT_MEDIA_TYPE = "application/vnd.energytycoon.compact+json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+_MSGPACK_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack")
+
+
+def _default(obj: Any):
+    # UserOut 같은 모델은 pydantic-core 의 컴파일된 serializer 로 바로 dict 로 만든다
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    raise TypeError
+
+
+def dumps(content: Any) -> bytes:
+    try:
+        return orjson.dumps(content, default=_default, option=_OPTIONS)
+    except TypeError:
+        # orjson 은 64-bit 를 넘는 int 등을 거부한다: 기존 인코더 경로로 처리
+        return json.dumps(
+            jsonable_encoder(content), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class CompactJSONResponse(FastJSONResponse):
+    media_type = COMPACT_MEDIA_TYPE
+
+
+def wants_compact(request: Request, fmt: Optional[str]) -> bool:
+    """?format= wins over the Accept header; anything but an explicit compact request gets plain JSON."""
+    if fmt is not None:
+        return fmt == "compact"
+    return COMPACT_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+class MsgPackResponse(Response):
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, default=_default, use_bin_type=True)
+
+
+def wants_msgpack(request: Request) -> bool:
+    accept = request.headers.get("accept", "")
+    return any(media_type in accept for media_type in _MSGPACK_TYPES)
+
+
+def negotiate(request: Request, content: Any, json_class: type = FastJSONResponse, headers: Optional[dict] = None) -> Response:
+    """Encode `content` as msgpack when the client accepts it, otherwise with `json_class`."""
+    if wants_msgpack(request):
+        try:
+            return MsgPackResponse(content, headers=headers)
+        except OverflowError:
+            # msgpack 은 64-bit 를 넘는 int 를 표현할 수 없다: 이 응답만 JSON 으로 보낸다
+            pass
+    return json_class(content, headers=headers)
+
+
+class MsgPackRequest(Request):
+    async def body(self):
+        # FastAPI 는 JSON 이 아닌 content-type 이면 body() 결과를 그대로 모델 검증에 넘긴다.
+        # 그래서 bytes 대신 디코딩한 dict 를 돌려주면 JSON 과 같은 검증 경로를 탄다 (깨진 본문은 FastAPI 가 400 처리)
+        if not hasattr(self, "_decoded_body"):
+            raw = await super().body()
+            self._decoded_body = msgpack.unpackb(raw, raw=False) if raw else raw
+        return self._decoded_body
+
+
+class MsgPackRoute(APIRoute):
+    """Route class that accepts `Content-Type: application/msgpack` request bodies."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            content_type = request.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+            if content_type in _MSGPACK_TYPES:
+                request = MsgPackRequest(request.scope, request.receive)
+            return await handler(request)
+
+        return route_handler
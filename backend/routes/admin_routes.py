@@ -0,0 +1,64 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse
+
+from .. import memory_diag, request_profiler
+from ..dependencies import get_user_and_db, get_user_and_read_db
+from .inquiry_routes import check_admin
+
+router = APIRouter(prefix="/admin", include_in_schema=False)
+
+
+@router.get("/profiles")
+async def list_profiles(auth=Depends(get_user_and_read_db)):
+    """Profiles currently in the on-disk ring, newest first."""
+    user, _, _ = auth
+    check_admin(user)
+    return {
+        "enabled": request_profiler.ENABLED,
+        "sample_rate": request_profiler.PROFILE_SAMPLE_RATE,
+        "max_files": request_profiler.PROFILE_MAX_FILES,
+        "profiles": request_profiler.list_profiles(),
+    }
+
+
+@router.get("/profiles/{profile_id}")
+async def download_profile(profile_id: str, format: str = "pstats", sort: str = "cumulative", auth=Depends(get_user_and_read_db)):
+    """Raw pstats file (load with `python -m pstats`), or `?format=text` for a sorted report."""
+    user, _, _ = auth
+    check_admin(user)
+    path = request_profiler.profile_path(profile_id)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "text":
+        if sort not in ("cumulative", "tottime", "calls", "ncalls", "time"):
+            raise HTTPException(status_code=422, detail="Invalid sort key")
+        return PlainTextResponse(request_profiler.render_text(path, sort=sort))
+    if format != "pstats":
+        raise HTTPException(status_code=422, detail="format must be pstats or text")
+    return FileResponse(path, media_type="application/octet-stream", filename=path.rsplit("/", 1)[-1])
+
+
+@router.get("/memory")
+async def memory_report(limit: int = 25, auth=Depends(get_user_and_read_db)):
+    """RSS and its trend, registered cache sizes, gc counts and (if tracing) tracemalloc top allocators."""
+    user, _, _ = auth
+    check_admin(user)
+    return memory_diag.report(max(1, min(limit, 200)))
+
+
+@router.get("/memory/diff")
+async def memory_diff(limit: int = 25, auth=Depends(get_user_and_read_db)):
+    """tracemalloc growth since the previous call to this endpoint (the first call records the baseline)."""
+    user, _, _ = auth
+    check_admin(user)
+    if not memory_diag.tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracemalloc is not running")
+    return memory_diag.snapshot_diff(max(1, min(limit, 200)))
+
+
+@router.post("/memory/tracemalloc")
+async def memory_tracing(enabled: bool = True, auth=Depends(get_user_and_db)):
+    """Turn tracemalloc on or off at runtime (it slows allocation while on)."""
+    user, _, _ = auth
+    check_admin(user)
+    return {"tracing": memory_diag.set_tracing(enabled)}
@@ -1,28 +1,29 @@
 import os
-import time
-from collections import defaultdict
 
-from fastapi import APIRouter, Depends, HTTPException, Response, Request
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Response, Request
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from .. import schemas
+from .. import rate_limit, schemas
 from ..auth_utils import (
     clear_auth_cookies,
-    hash_pw,
+    forget_user_access_tokens,
+    hash_pw_async,
     issue_access_token,
-    issue_refresh_token,
     issue_token_pair,
     password_needs_rehash,
-    revoke_token,
+    rehash_password,
+    rotate_refresh_token,
     revoke_user_tokens,
     set_auth_cookies,
     set_csrf_cookie,
     set_trap_cookie,
-    verify_password,
+    verify_password_async,
 )
-from ..dependencies import get_db, get_refresh_user_and_db, get_user_and_db
-from ..models import User
-from ..bigvalue import from_plain, set_user_money_value, set_user_energy_value, ensure_user_big_values
+from ..database import mark_user_write, write_transaction
+from ..dependencies import get_db, get_refresh_token, get_refresh_user_and_db, get_user_and_db
+from ..models import SyncBatch, User
+from ..bigvalue import from_plain, set_user_money_value, set_user_energy_value
 
 router = APIRouter()
 
@@ -30,37 +31,8 @@ LOGIN_COOLDOWN_SECONDS = float(os.getenv("LOGIN_COOLDOWN_SECONDS", "1.0"))
 MAX_BACKOFF_SECONDS = float(os.getenv("MAX_BACKOFF_SECONDS", "300"))  # 5 minutes max
 MIN_PASSWORD_LENGTH = 8
 MAX_PASSWORD_LENGTH = 128
-_login_backoff: dict[str, float] = {}
-_login_failure_count: dict[str, int] = {}  # Track consecutive failures for exponential backoff
-_ip_buckets = defaultdict(list)
 IP_MAX_ATTEMPTS = int(os.getenv("IP_MAX_ATTEMPTS", "100"))
 IP_WINDOW_SECONDS = int(os.getenv("IP_WINDOW_SECONDS", "60"))
-MAX_BACKOFF_ENTRIES = 10000  # Prevent unbounded memory growth
-MAX_IP_ENTRIES = 10000
-
-
-def _cleanup_old_entries():
-    """Remove old entries from rate limiting dicts to prevent memory exhaustion."""
-    now = time.time()
-    
-    # Clean up login backoff entries older than cooldown period
-    if len(_login_backoff) > MAX_BACKOFF_ENTRIES:
-        to_remove = [
-            username for username, timestamp in _login_backoff.items()
-            if now - timestamp > LOGIN_COOLDOWN_SECONDS * 2
-        ]
-        for username in to_remove[:len(_login_backoff) // 2]:  # Remove half if over limit
-            _login_backoff.pop(username, None)
-            _login_failure_count.pop(username, None)
-    
-    # Clean up IP bucket entries
-    if len(_ip_buckets) > MAX_IP_ENTRIES:
-        to_remove = [
-            ip for ip, timestamps in _ip_buckets.items()
-            if not timestamps or all(ts < now - IP_WINDOW_SECONDS * 2 for ts in timestamps)
-        ]
-        for ip in to_remove[:len(_ip_buckets) // 2]:  # Remove half if over limit
-            _ip_buckets.pop(ip, None)
 
 
 def _validate_password_strength(pw: str):
@@ -74,51 +46,36 @@ def _validate_password_strength(pw: str):
         raise HTTPException(status_code=400, detail="Password must include letters and digits.")
 
 
-def _enforce_login_cooldown(username: str | None):
+async def _enforce_login_cooldown(username: str | None):
     """Enforce exponential backoff based on consecutive failed login attempts."""
     if not username:
         return
-    last_fail = _login_backoff.get(username)
-    if last_fail is None:
-        return
-    
-    # Calculate exponential backoff: base_cooldown * (2 ^ failure_count)
-    failure_count = _login_failure_count.get(username, 0)
-    cooldown = min(LOGIN_COOLDOWN_SECONDS * (2 ** failure_count), MAX_BACKOFF_SECONDS)
-    
-    elapsed = time.time() - last_fail
-    if elapsed < cooldown:
-        wait_time = int(cooldown - elapsed)
+    remaining = await rate_limit.backoff_remaining(
+        f"login:{username}", LOGIN_COOLDOWN_SECONDS, MAX_BACKOFF_SECONDS
+    )
+    if remaining > 0:
         raise HTTPException(
             status_code=429, 
-            detail=f"Too many failed attempts. Please wait {wait_time} seconds."
+            detail=f"Too many failed attempts. Please wait {int(remaining)} seconds."
         )
 
 
-def _mark_login_failure(username: str | None):
+async def _mark_login_failure(username: str | None):
     """Mark a failed login attempt and increment failure count for exponential backoff."""
     if username:
-        _login_backoff[username] = time.time()
-        _login_failure_count[username] = _login_failure_count.get(username, 0) + 1
-        _cleanup_old_entries()
+        await rate_limit.record_failure(f"login:{username}")
 
 
-def _clear_login_failure(username: str | None):
+async def _clear_login_failure(username: str | None):
     """Clear failed login tracking on successful authentication."""
     if username:
-        _login_backoff.pop(username, None)
-        _login_failure_count.pop(username, None)
+        await rate_limit.reset(f"login:{username}")
 
 
-def _check_ip_rate(request: Request):
+async def _check_ip_rate(request: Request):
     ip = request.client.host if request and request.client else "unknown"
-    now = time.time()
-    recent = [ts for ts in _ip_buckets[ip] if ts > now - IP_WINDOW_SECONDS]
-    if len(recent) >= IP_MAX_ATTEMPTS:
+    if await rate_limit.check_rate(f"ip:{ip}", IP_MAX_ATTEMPTS, IP_WINDOW_SECONDS) is not None:
         raise HTTPException(status_code=429, detail="Too many attempts. Please wait.")
-    recent.append(now)
-    _ip_buckets[ip] = recent
-    _cleanup_old_entries()
 
 
 def _validate_username(username: str):
@@ -136,27 +93,30 @@ def _validate_username(username: str):
 
 @router.post("/signup")
 async def signup(
-    request: Request, response: Response, payload: schemas.UserCreate, db: Session = Depends(get_db)
+    request: Request, response: Response, payload: schemas.UserCreate, db: AsyncSession = Depends(get_db)
 ):
-    _check_ip_rate(request)
+    await _check_ip_rate(request)
     _validate_username(payload.username)
     _validate_password_strength(payload.password)
-    if db.query(User).filter_by(username=payload.username).first():
+    if await db.scalar(select(User).filter_by(username=payload.username)):
         raise HTTPException(status_code=400, detail="Username already exists")
-    u = User(
-        username=payload.username, 
-        password=hash_pw(payload.password), 
-        rebirth_count=0,
-        energy_data=0,
-        energy_high=0,
-        money_data=10000,
-        money_high=0
-    )
-    db.add(u)
-    db.commit()
-    db.refresh(u)
-    # ensure_user_big_values(u, db)  # Redundant as we initialize them above
-    access_token, refresh_token = issue_token_pair(u, db)
+    # 해시(CPU)는 쓰기 구간 밖에서 끝낸다
+    hashed = await hash_pw_async(payload.password)
+    async with write_transaction(db):
+        u = User(
+            username=payload.username, 
+            password=hashed, 
+            rebirth_count=0,
+            energy_data=0,
+            energy_high=0,
+            money_data=10000,
+            money_high=0
+        )
+        db.add(u)
+        await db.commit()
+    await db.refresh(u)
+    mark_user_write(u.user_id)
+    access_token, refresh_token = await issue_token_pair(u, db)
     if response:
         clear_auth_cookies(response)
         set_auth_cookies(response, access_token, refresh_token)
@@ -169,24 +129,26 @@ async def signup(
 
 @router.post("/login")
 async def login(
-    request: Request, response: Response, payload: schemas.LoginIn, db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    payload: schemas.LoginIn,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db),
 ):
-    _check_ip_rate(request)
-    _enforce_login_cooldown(payload.username)
-    user = db.query(User).filter_by(username=payload.username).first()
+    await _check_ip_rate(request)
+    await _enforce_login_cooldown(payload.username)
+    user = await db.scalar(select(User).filter_by(username=payload.username))
     if not user:
-        _mark_login_failure(payload.username)
+        await _mark_login_failure(payload.username)
         raise HTTPException(status_code=404, detail="User not found")
-    if not verify_password(payload.password, user.password):
-        _mark_login_failure(payload.username)
+    if not await verify_password_async(payload.password, user.password):
+        await _mark_login_failure(payload.username)
         raise HTTPException(status_code=400, detail="Invalid password")
-    _clear_login_failure(payload.username)
+    await _clear_login_failure(payload.username)
     if password_needs_rehash(user.password):
-        user.password = hash_pw(payload.password)
-        db.commit()
-        db.refresh(user)
-    ensure_user_big_values(user, db)
-    access_token, refresh_token = issue_token_pair(user, db)
+        # 재해시는 응답 이후로 미룬다
+        background_tasks.add_task(rehash_password, user.user_id, payload.password, user.password)
+    access_token, refresh_token = await issue_token_pair(user, db)
     if response:
         clear_auth_cookies(response)
         set_auth_cookies(response, access_token, refresh_token)
@@ -214,19 +176,20 @@ async def get_csrf_token_alias(response: Response):
 @router.post("/logout")
 async def logout(response: Response, auth=Depends(get_refresh_user_and_db)):
     user, db, _ = auth
-    revoke_user_tokens(user.user_id, db)
+    await revoke_user_tokens(user.user_id, db)
     if response:
         clear_auth_cookies(response)
     return {"detail": "Logout successful"}
 
 
 @router.post("/refresh/access")
-async def refresh_access(response: Response, auth=Depends(get_refresh_user_and_db)):
-    user, db, refresh_token_used = auth
-    access_token = issue_access_token(user.user_id)
-    new_refresh = issue_refresh_token(user, db)
+async def refresh_access(
+    response: Response, token: str = Depends(get_refresh_token), db: AsyncSession = Depends(get_db)
+):
+    # 회전은 조건부 UPDATE 한 번: 같은 토큰으로 동시에 들어온 요청은 하나만 성공한다
+    user_id, new_refresh = await rotate_refresh_token(token, db)
+    access_token = issue_access_token(user_id)
     if response:
-        revoke_token(refresh_token_used, db)
         clear_auth_cookies(response, keep_trap=True)
         set_auth_cookies(response, access_token, new_refresh)
         set_csrf_cookie(response)
@@ -234,11 +197,11 @@ async def refresh_access(response: Response, auth=Depends(get_refresh_user_and_d
 
 
 @router.post("/refresh/refresh")
-async def refresh_refresh(response: Response, auth=Depends(get_refresh_user_and_db)):
-    user, db, token = auth
-    revoke_token(token, db)
-    access_token = issue_access_token(user.user_id)
-    refresh_token = issue_refresh_token(user, db)
+async def refresh_refresh(
+    response: Response, token: str = Depends(get_refresh_token), db: AsyncSession = Depends(get_db)
+):
+    user_id, refresh_token = await rotate_refresh_token(token, db)
+    access_token = issue_access_token(user_id)
     if response:
         clear_auth_cookies(response, keep_trap=True)
         set_auth_cookies(response, access_token, refresh_token)
@@ -249,10 +212,18 @@ async def refresh_refresh(response: Response, auth=Depends(get_refresh_user_and_
 @router.post("/delete_account")
 async def delete_account(payload: schemas.DeleteAccountIn, response: Response, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    if not verify_password(payload.password, user.password):
+    # 비밀번호 검증(CPU)은 쓰기 구간 밖에서 한다
+    if not await verify_password_async(payload.password, user.password):
         raise HTTPException(status_code=400, detail="Invalid password")
-    revoke_user_tokens(user.user_id, db)
-    db.delete(user)
-    db.commit()
+    await revoke_user_tokens(user.user_id, db)
+    try:
+        async with write_transaction(db):
+            # SQLite 는 FK cascade 가 꺼져 있으므로 저장된 /sync 결과를 직접 지운다
+            await db.execute(delete(SyncBatch).where(SyncBatch.user_id == user.user_id))
+            await db.delete(user)
+            await db.commit()
+    finally:
+        # 캐시된 access 토큰은 삭제 결과와 상관없이 버린다 (다시 쓰이면 DB 조회로 재검증된다)
+        forget_user_access_tokens(user.user_id)
     clear_auth_cookies(response)
     return {"detail": "Account deleted"}
\ No newline at end of file
@@ -1,22 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 
-from ..dependencies import get_user_and_db
-from ..game_logic import current_market_rate, calculate_progressive_exchange
-from ..schemas import ExchangeIn, UserOut
+from ..database import write_transaction
+from ..dependencies import commit_optimistic, get_principal_and_db, get_user_and_db, load_user_columns
+from ..etag import matching_etag, not_modified, set_etag, user_etag
+from ..game_logic import apply_exchange, current_market_rate
+from ..schemas import AutoExchangeIn, ExchangeIn, UserOut
 from ..models import User
 from ..bigvalue import (
     BigValue,
-    get_user_energy_value,
-    set_user_energy_value,
-    get_user_money_value,
-    set_user_money_value,
-    get_user_sold_energy_value,
-    set_user_sold_energy_value,
-    compare,
-    subtract_values,
-    add_values,
-    from_plain,
     normalize,
     to_payload,
     normalize_value,
@@ -24,6 +15,20 @@ from ..bigvalue import (
 
 router = APIRouter()
 
+RATE_COLUMNS = (
+    User.sold_energy_data,
+    User.sold_energy_high,
+    User.demand_bonus,
+    User.rebirth_count,
+    User.exchange_rate_multiplier,
+    User.row_version,
+)
+AUTO_EXCHANGE_COLUMNS = (
+    User.auto_exchange_percent,
+    User.auto_exchange_threshold_data,
+    User.auto_exchange_threshold_high,
+)
+
 
 def _ensure_same_user(user: User, target_user_id: str | None):
     if target_user_id and user.user_id != target_user_id:
@@ -44,33 +49,14 @@ async def energy2money(payload: ExchangeIn, auth=Depends(get_user_and_db)):
     if amount_bv.data <= 0 and amount_bv.high <= 0:
          raise HTTPException(status_code=400, detail="Invalid amount")
 
-    energy_value = get_user_energy_value(user)
-    
-    # 잔액 확인
-    # compare(left, right) -> 1, 0, -1
-    if compare(energy_value, amount_bv) < 0:
-        raise HTTPException(status_code=400, detail="Not enough energy")
-
-    # 점진적 환율 적용하여 실제 획득량 계산 (BigValue 반환)
-    gained_bv, avg_rate = calculate_progressive_exchange(user, amount_bv)
+    # 잔액 확인 후 점진적 환율로 에너지 -> 돈 교환, 누적 판매량 갱신 (BigValue)
+    # 충돌하면(User.row_version) 새 잔액/판매량으로 다시 계산한다
+    gained_bv, avg_rate = await commit_optimistic(db, lambda: apply_exchange(user, amount_bv), user)
     # avg_rate is float, convert to BigValue (multiply by 1000 for DATA_SCALE)
     rate_bv = normalize_value(BigValue(int(max(avg_rate, 0) * 1000), 0))
     rate_payload = to_payload(rate_bv)
 
-    # BigValue 연산으로 차감 및 지급
-    energy_value = subtract_values(energy_value, amount_bv)
-    money_value = add_values(get_user_money_value(user), gained_bv)
-
-    set_user_energy_value(user, energy_value)
-    set_user_money_value(user, money_value)
-
-    # Update user's sold_energy (BigValue)
-    sold_energy_value = get_user_sold_energy_value(user)
-    new_sold_energy_value = add_values(sold_energy_value, amount_bv)
-    set_user_sold_energy_value(user, new_sold_energy_value)
-
-    db.commit()
-    db.refresh(user)
+    await db.refresh(user)
     gained_payload = to_payload(gained_bv)
     return {
         "energy_data": user.energy_data,
@@ -87,10 +73,45 @@ async def energy2money(payload: ExchangeIn, auth=Depends(get_user_and_db)):
 
 
 @router.get("/change/rate")
-async def get_exchange_rate(auth=Depends(get_user_and_db)):
-    user, _, _ = auth
+async def get_exchange_rate(request: Request, response: Response, auth=Depends(get_principal_and_db)):
+    user_id, db = auth
+    # 환율 계산에 필요한 컬럼만 읽는다 (row_version 은 ETag 용)
+    user = await load_user_columns(db, user_id, *RATE_COLUMNS)
+    cached = matching_etag(request, user_id, user.row_version)
+    if cached:
+        return not_modified(cached)
+    set_etag(response, user_etag(user_id, user.row_version))
     rate = current_market_rate(user)
     # rate is float, convert to BigValue (multiply by 1000 for DATA_SCALE)
     rate_bv = normalize_value(BigValue(int(max(rate, 0) * 1000), 0))
     rate_payload = to_payload(rate_bv)
     return {"rate": rate, "rate_data": rate_payload["data"], "rate_high": rate_payload["high"]}
+
+
+def _auto_exchange_policy(user: User) -> dict:
+    return {
+        "enabled": (user.auto_exchange_percent or 0) > 0,
+        "percent": user.auto_exchange_percent or 0,
+        "threshold_data": user.auto_exchange_threshold_data or 0,
+        "threshold_high": user.auto_exchange_threshold_high or 0,
+    }
+
+
+@router.get("/change/auto")
+async def get_auto_exchange(auth=Depends(get_principal_and_db)):
+    user_id, db = auth
+    user = await load_user_columns(db, user_id, *AUTO_EXCHANGE_COLUMNS)
+    return _auto_exchange_policy(user)
+
+
+@router.post("/change/auto")
+async def set_auto_exchange(payload: AutoExchangeIn, auth=Depends(get_user_and_db)):
+    # 정책만 저장한다. 실제 환전은 다음 autosave / sync 트랜잭션에서 일어난다
+    user, db, _ = auth
+    threshold = normalize(BigValue(payload.threshold_data, payload.threshold_high))
+    async with write_transaction(db):
+        user.auto_exchange_percent = payload.percent
+        user.auto_exchange_threshold_data = threshold.data
+        user.auto_exchange_threshold_high = threshold.high
+        await db.commit()
+    return _auto_exchange_policy(user)
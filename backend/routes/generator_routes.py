@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..database import get_db
+from ..database import get_read_db
 from ..models import GeneratorType
-from ..init_db import DEFAULT_GENERATOR_NAME_TO_INDEX, DEFAULT_GENERATOR_TYPES
+from ..catalog import DEFAULT_GENERATOR_NAME_TO_INDEX, DEFAULT_GENERATOR_TYPES
 
 DEFAULT_GENERATOR_SPEC_BY_NAME = {g["이름"]: g for g in DEFAULT_GENERATOR_TYPES}
 
@@ -11,9 +12,9 @@ router = APIRouter()
 
 
 @router.get("/generator_types")
-async def generator_types(db: Session = Depends(get_db)):
+async def generator_types(db: AsyncSession = Depends(get_read_db)):
     try:
-        types = db.query(GeneratorType).all()
+        types = (await db.execute(select(GeneratorType))).scalars().all()
         payload = []
         for t in types:
             idx = DEFAULT_GENERATOR_NAME_TO_INDEX.get(t.name)
@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
 import time
 from typing import List
 
-from ..dependencies import get_user_and_db
+from ..database import atomic_update, write_transaction
+from ..dependencies import get_user_and_db, get_user_and_read_db
 from ..models import User, Inquiry
 from ..schemas import InquiryCreate, InquiryOut
 
@@ -35,9 +36,10 @@ async def create_inquiry(inquiry: InquiryCreate, auth=Depends(get_user_and_db)):
         content=inquiry.content,
         created_at=int(time.time() * 1000)
     )
-    db.add(new_inquiry)
-    db.commit()
-    db.refresh(new_inquiry)
+    async with write_transaction(db):
+        db.add(new_inquiry)
+        await db.commit()
+    await db.refresh(new_inquiry)
     
     # Return with username
     result = InquiryOut(
@@ -53,25 +55,28 @@ async def create_inquiry(inquiry: InquiryCreate, auth=Depends(get_user_and_db)):
 
 
 @router.get("/inquiries", response_model=List[InquiryOut])
-async def get_inquiries(auth=Depends(get_user_and_db)):
+async def get_inquiries(auth=Depends(get_user_and_read_db)):
     """Get all inquiries (for admin page)."""
     user, db, _ = auth
     
     # Check if user is admin
     check_admin(user)
     
-    inquiries = db.query(Inquiry).order_by(Inquiry.created_at.desc()).all()
-    
-    # Join with User to get username
+    # 문의마다 User 를 따로 조회하지 않도록 한 번의 outer join 으로 username 을 가져온다
+    rows = (
+        await db.execute(
+            select(Inquiry, User.username)
+            .outerjoin(User, User.user_id == Inquiry.user_id)
+            .order_by(Inquiry.created_at.desc())
+        )
+    ).all()
+
     result = []
-    for inquiry in inquiries:
-        u = db.query(User).filter(User.user_id == inquiry.user_id).first()
-        username = u.username if u else "Unknown"
-        
+    for inquiry, username in rows:
         i_out = InquiryOut(
             inquiry_id=inquiry.inquiry_id,
             user_id=inquiry.user_id,
-            username=username,
+            username=username or "Unknown",
             type=inquiry.type,
             content=inquiry.content,
             created_at=inquiry.created_at
@@ -89,19 +94,17 @@ async def accept_inquiry(inquiry_id: str, auth=Depends(get_user_and_db)):
     # Check if user is admin
     check_admin(user)
     
-    inquiry = db.query(Inquiry).filter(Inquiry.inquiry_id == inquiry_id).first()
+    inquiry = await db.scalar(select(Inquiry).filter(Inquiry.inquiry_id == inquiry_id))
     if not inquiry:
         raise HTTPException(status_code=404, detail="Inquiry not found")
     
-    # Give supercoin to user
-    submitter = db.query(User).filter(User.user_id == inquiry.user_id).first()
-    if submitter:
-        submitter.supercoin += 1
-        db.add(submitter)
-    
-    # Delete inquiry
-    db.delete(inquiry)
-    db.commit()
+    async with write_transaction(db):
+        # Give supercoin to user (제출자 행을 읽지 않고 DB 안에서 +1; 탈퇴한 사용자면 0행)
+        await atomic_update(db, User, [User.user_id == inquiry.user_id], {User.supercoin: User.supercoin + 1})
+        
+        # Delete inquiry
+        await db.delete(inquiry)
+        await db.commit()
     
     return {"status": "accepted", "user_id": inquiry.user_id}
 
@@ -114,13 +117,14 @@ async def reject_inquiry(inquiry_id: str, auth=Depends(get_user_and_db)):
     # Check if user is admin
     check_admin(user)
     
-    inquiry = db.query(Inquiry).filter(Inquiry.inquiry_id == inquiry_id).first()
+    inquiry = await db.scalar(select(Inquiry).filter(Inquiry.inquiry_id == inquiry_id))
     if not inquiry:
         raise HTTPException(status_code=404, detail="Inquiry not found")
     
     # Just delete inquiry
     user_id = inquiry.user_id
-    db.delete(inquiry)
-    db.commit()
+    async with write_transaction(db):
+        await db.delete(inquiry)
+        await db.commit()
     
     return {"status": "rejected", "user_id": user_id}
@@ -2,10 +2,14 @@ import math
 import time
 from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-
-from ..dependencies import get_user_and_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+
+from ..database import write_transaction
+from ..dependencies import commit_optimistic, get_user_and_db
+from ..etag import matching_etag, not_modified, set_etag, user_etag
 from ..models import Generator, GeneratorType, MapProgress, User
 from ..bigvalue import (
     get_user_money_value,
@@ -18,13 +22,25 @@ from ..bigvalue import (
     BigValue,
     compare,
     subtract_values,
-    divide_by_2,
     multiply_plain,
     multiply_by_float,
     add_values,
     _max_bv,
 )
-from ..init_db import get_build_time_by_name
+from ..game_logic import (
+    apply_auto_exchange,
+    build_duration,
+    calculate_generator_upgrade_cost,
+    calculate_skip_build_cost,
+    demolish_cost,
+    get_generator_upgrade_meta,
+    max_generators_allowed,
+    maybe_complete_build,
+    serialize_generator,
+    serialize_generators_compact,
+    touch_user,
+)
+from ..responses import CompactJSONResponse, MsgPackRoute, negotiate, wants_compact, wants_msgpack
 from ..schemas import (
     ProgressAutoSaveIn,
     ProgressSaveIn,
@@ -34,17 +50,8 @@ from ..schemas import (
     BulkGeneratorUpgradeRequest,
 )
 
-router = APIRouter()
-
-MAX_GENERATOR_BASE = 10
-MAX_GENERATOR_STEP = 1
-DEMOLISH_COST_RATE = 0.5
-
-GENERATOR_UPGRADE_CONFIG = {
-    "production": {"field": "production_upgrade", "base_cost_multiplier": 1, "price_growth": 1.25},
-    "heat_reduction": {"field": "heat_reduction_upgrade", "base_cost_multiplier": 0.8, "price_growth": 1.2},
-    "tolerance": {"field": "tolerance_upgrade", "base_cost_multiplier": 0.9, "price_growth": 1.2},
-}
+# application/msgpack 요청 본문도 받는다 (responses.MsgPackRoute)
+router = APIRouter(route_class=MsgPackRoute)
 
 
 def _ensure_same_user(user: User, target_user_id: Optional[str]):
@@ -52,108 +59,64 @@ def _ensure_same_user(user: User, target_user_id: Optional[str]):
         raise HTTPException(status_code=403, detail="User mismatch")
 
 
-def _max_generators_allowed(user: User) -> int:
-    bonus = getattr(user, "max_generators_bonus", 0) or 0
-    return MAX_GENERATOR_BASE + bonus * MAX_GENERATOR_STEP
-
-
-def _demolish_cost(generator_type: GeneratorType) -> BigValue:
-    """Calculate demolish cost as 50% of generator cost."""
-    cost_val = BigValue(generator_type.cost_data, generator_type.cost_high)
-    # Calculate 50% by dividing by 2 (O(1) using BigValue)
-    return divide_by_2(cost_val)
-
-
-def _build_duration(generator_type: Optional[GeneratorType] = None, level: Optional[int] = None, user: Optional[User] = None) -> int:
-    base_duration = 2  # Default: 2 seconds if no build time in data
-    if generator_type and getattr(generator_type, "name", None):
-        seconds = get_build_time_by_name(generator_type.name)
-        if seconds:
-            base_duration = max(1, int(seconds))
-    
-    # Apply build speed reduction from special upgrades
-    if user:
-        build_speed_reduction = getattr(user, "build_speed_reduction", 0) or 0
-        # 10% reduction per level, max 90% reduction (level 9)
-        reduction_rate = min(build_speed_reduction * 0.1, 0.9)
-        base_duration = int(base_duration * (1 - reduction_rate))
-    
-    return max(1, base_duration)  # Minimum 1 second
-
-
-def _maybe_complete_build(generator: Generator, now: Optional[int] = None) -> bool:
-    if not generator.isdeveloping:
-        return False
-    now = now or int(time.time())
-    if generator.build_complete_ts and generator.build_complete_ts <= now:
-        generator.isdeveloping = False
-        generator.build_complete_ts = None
-        generator.running = True
-        return True
-    return False
-
-
-def _serialize_generator(
-    g: Generator,
-    type_name: Optional[str] = None,
-    cost_data: Optional[int] = None,
-    cost_high: Optional[int] = None,
-    mp: Optional[MapProgress] = None,
-):
-    """Serialize generator with BigValue cost."""
-    # Get cost_data and cost_high from generator_type if not provided
-    if cost_data is None:
-        cost_data = getattr(getattr(g, "generator_type", None), "cost_data", 0)
-    if cost_high is None:
-        cost_high = getattr(getattr(g, "generator_type", None), "cost_high", 0)
-    
-    return {
-        "generator_id": g.generator_id,
-        "generator_type_id": g.generator_type_id,
-        "type": type_name,
-        "cost_data": cost_data,
-        "cost_high": cost_high,
-        "x_position": g.x_position,
-        "world_position": g.world_position,
-        "level": g.level,
-        "isdeveloping": g.isdeveloping,
-        "build_complete_ts": g.build_complete_ts,
-        "heat": g.heat,
-        "running": getattr(g, "running", True),
-        "upgrades": {
-            "production": getattr(mp, "production_upgrade", 0) if mp else 0,
-            "heat_reduction": getattr(mp, "heat_reduction_upgrade", 0) if mp else 0,
-            "tolerance": getattr(mp, "tolerance_upgrade", 0) if mp else 0,
-        },
-    }
-
-
 @router.get("/progress")
-async def load_progress(user_id: Optional[str] = None, auth=Depends(get_user_and_db)):
+async def load_progress(
+    request: Request,
+    user_id: Optional[str] = None,
+    format: Optional[str] = Query(None, pattern="^(json|compact)$"),
+    auth=Depends(get_user_and_db),
+):
     user, db, _ = auth
     _ensure_same_user(user, user_id)
+    compact = wants_compact(request, format)
+    # 표현(압축 형식 / msgpack)마다 태그를 구분한다
+    variant = ("c" if compact else "") + ("m" if wants_msgpack(request) else "") or None
+    # 버전이 같고 태그에 든 건설 마감 시각이 아직 지나지 않았으면 발전기 조회 없이 304
+    cached = matching_etag(request, user.user_id, user.row_version, variant)
+    if cached:
+        res = not_modified(cached)
+        res.headers["Vary"] = "Accept"
+        return res
     gens = (
-        db.query(Generator, MapProgress)
-        .join(MapProgress, MapProgress.generator_id == Generator.generator_id)
-        .filter(MapProgress.user_id == user.user_id)
-        .all()
-    )
+        await db.execute(
+            select(Generator, MapProgress)
+            .join(MapProgress, MapProgress.generator_id == Generator.generator_id)
+            .options(joinedload(Generator.generator_type))
+            .filter(MapProgress.user_id == user.user_id)
+        )
+    ).all()
     now = int(time.time())
-    updated = False
     def _max_bv(a: BigValue, b: BigValue) -> BigValue:
         return a if compare(a, b) >= 0 else b
-    for g, mp in gens:
-        if _maybe_complete_build(g, now):
-            updated = True
-    if updated:
-        db.commit()
-    out = []
-    for g, mp in gens:
-        type_name = getattr(g.generator_type, "name", None)
-        cost_data = getattr(g.generator_type, "cost_data", 0)
-        cost_high = getattr(g.generator_type, "cost_high", 0)
-        out.append(_serialize_generator(g, type_name, cost_data, cost_high, mp))
-    return {"user_id": user.user_id, "generators": out, "user": UserOut.model_validate(user)}
+    if any(g.isdeveloping and g.build_complete_ts and g.build_complete_ts <= now for g, _ in gens):
+        # 건설 완료 반영은 GET 안의 쓰기: 이 부분만 쓰기 구간에서 커밋한다
+        async with write_transaction(db):
+            for g, _ in gens:
+                maybe_complete_build(g, now)
+            await db.commit()
+    pending = [g.build_complete_ts for g, _ in gens if g.isdeveloping and g.build_complete_ts]
+    etag = user_etag(user.user_id, user.row_version, min(pending) if pending else None, variant)
+    if compact:
+        # 열 단위 배열 + 타입 카탈로그 인덱스 (키/타입 정보 반복 없음)
+        res = negotiate(request, {
+            "user_id": user.user_id,
+            "format": "compact",
+            "generators": serialize_generators_compact(gens),
+            "user": UserOut.model_validate(user),
+        }, CompactJSONResponse)
+    else:
+        out = []
+        for g, mp in gens:
+            type_name = getattr(g.generator_type, "name", None)
+            cost_data = getattr(g.generator_type, "cost_data", 0)
+            cost_high = getattr(g.generator_type, "cost_high", 0)
+            out.append(serialize_generator(g, type_name, cost_data, cost_high, mp))
+        # 발전기 목록이 커서 jsonable_encoder 를 거치지 않고 바로 bytes 로 인코딩한다 (responses.py)
+        res = negotiate(request, {"user_id": user.user_id, "generators": out, "user": UserOut.model_validate(user)})
+    set_etag(res, etag)
+    # Accept 로 형식이 바뀌므로 캐시는 Accept 별로 구분해야 한다
+    res.headers["Vary"] = "Accept"
+    return res
 
 
 @router.post("/progress")
@@ -161,63 +124,62 @@ async def save_progress(payload: ProgressSaveIn, auth=Depends(get_user_and_db)):
     user, db, _ = auth
     _ensure_same_user(user, payload.user_id)
     
-    gt = db.query(GeneratorType).filter_by(generator_type_id=payload.generator_type_id).first()
+    gt = await db.scalar(select(GeneratorType).filter_by(generator_type_id=payload.generator_type_id))
     if not gt:
         raise HTTPException(status_code=404, detail="Generator type not found")
-    
-    # Use FOR UPDATE to lock the user row and prevent race conditions
-    user = db.query(User).filter_by(user_id=user.user_id).with_for_update().first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    current_count = db.query(MapProgress).filter_by(user_id=user.user_id).count()
-    if current_count >= _max_generators_allowed(user):
-        raise HTTPException(status_code=400, detail="Generator limit reached")
-    
-    existing = (
-        db.query(Generator)
-        .join(MapProgress, MapProgress.generator_id == Generator.generator_id)
-        .filter(
-            MapProgress.user_id == user.user_id,
-            Generator.world_position == payload.world_position,
-            Generator.x_position == payload.x_position,
+
+    # 행 잠금 대신 User.row_version 으로 충돌을 검사한다: 동시 요청이 먼저 커밋했으면 다시 읽고 재시도
+    async def build():
+        current_count = await db.scalar(
+            select(func.count()).select_from(MapProgress).filter_by(user_id=user.user_id)
         )
-        .first()
-    )
-    if existing:
-        raise HTTPException(status_code=400, detail="Generator already exists in this position")
-    
-    money_value = get_user_money_value(user)
-    
-    # Use BigValue cost from cost_data and cost_high for accurate deduction
-    cost_val = BigValue(gt.cost_data, gt.cost_high)
-    
-    if compare(money_value, cost_val) < 0:
-        raise HTTPException(status_code=400, detail="Not enough money")
-    
-    g = Generator(
-        generator_type_id=gt.generator_type_id,
-        owner_id=user.user_id,
-        x_position=payload.x_position,
-        world_position=payload.world_position,
-        isdeveloping=False,
-        heat=0,
-        running=True,
-    )
-    db.add(g)
-    set_user_money_value(user, subtract_values(money_value, cost_val))
-    build_duration = _build_duration(gt, g.level, user)
-    g.isdeveloping = True
-    g.build_complete_ts = int(time.time() + build_duration)
-    db.commit()
-    db.refresh(g)
-    mp = MapProgress(user_id=user.user_id, generator_id=g.generator_id)
-    db.add(mp)
-    db.commit()
-    db.refresh(user)
+        if current_count >= max_generators_allowed(user):
+            raise HTTPException(status_code=400, detail="Generator limit reached")
+
+        existing = await db.scalar(
+            select(Generator)
+            .join(MapProgress, MapProgress.generator_id == Generator.generator_id)
+            .filter(
+                MapProgress.user_id == user.user_id,
+                Generator.world_position == payload.world_position,
+                Generator.x_position == payload.x_position,
+            )
+        )
+        if existing:
+            raise HTTPException(status_code=400, detail="Generator already exists in this position")
+
+        money_value = get_user_money_value(user)
+
+        # Use BigValue cost from cost_data and cost_high for accurate deduction
+        cost_val = BigValue(gt.cost_data, gt.cost_high)
+
+        if compare(money_value, cost_val) < 0:
+            raise HTTPException(status_code=400, detail="Not enough money")
+
+        g = Generator(
+            generator_type_id=gt.generator_type_id,
+            owner_id=user.user_id,
+            x_position=payload.x_position,
+            world_position=payload.world_position,
+            isdeveloping=False,
+            heat=0,
+            running=True,
+        )
+        db.add(g)
+        set_user_money_value(user, subtract_values(money_value, cost_val))
+        duration = build_duration(gt, g.level, user)
+        g.isdeveloping = True
+        g.build_complete_ts = int(time.time() + duration)
+        await db.flush()
+        mp = MapProgress(user_id=user.user_id, generator_id=g.generator_id)
+        db.add(mp)
+        return g, mp
+
+    g, mp = await commit_optimistic(db, build, user, gt)
+    await db.refresh(user)
     return {
         "ok": True,
-        "generator": _serialize_generator(g, gt.name, gt.cost_data, gt.cost_high, mp),
+        "generator": serialize_generator(g, gt.name, gt.cost_data, gt.cost_high, mp),
         "user": UserOut.model_validate(user),
     }
 
@@ -225,28 +187,29 @@ async def save_progress(payload: ProgressSaveIn, auth=Depends(get_user_and_db)):
 @router.delete("/progress/{generator_id}")
 async def remove_generator(generator_id: str, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    gen = (
-        db.query(Generator)
+    gen = await db.scalar(
+        select(Generator)
         .filter(Generator.generator_id == generator_id, Generator.owner_id == user.user_id)
-        .first()
     )
     if not gen:
         raise HTTPException(status_code=404, detail="Generator not found")
-    gt = db.query(GeneratorType).filter_by(generator_type_id=gen.generator_type_id).first()
-    mp = db.query(MapProgress).filter_by(generator_id=generator_id, user_id=user.user_id).first()
+    gt = await db.scalar(select(GeneratorType).filter_by(generator_type_id=gen.generator_type_id))
     if not gt:
         raise HTTPException(status_code=404, detail="Generator type not found")
-    cost_val = _demolish_cost(gt)
-    money_value = get_user_money_value(user)
-    if compare(money_value, cost_val) < 0:
-        raise HTTPException(status_code=400, detail="Not enough money to demolish")
-    mp = db.query(MapProgress).filter_by(user_id=user.user_id, generator_id=generator_id).first()
-    if mp:
-        db.delete(mp)
-    db.delete(gen)
-    set_user_money_value(user, subtract_values(money_value, cost_val))
-    db.commit()
-    db.refresh(user)
+    cost_val = demolish_cost(gt)
+
+    async def demolish():
+        money_value = get_user_money_value(user)
+        if compare(money_value, cost_val) < 0:
+            raise HTTPException(status_code=400, detail="Not enough money to demolish")
+        mp = await db.scalar(select(MapProgress).filter_by(user_id=user.user_id, generator_id=generator_id))
+        if mp:
+            await db.delete(mp)
+        await db.delete(gen)
+        set_user_money_value(user, subtract_values(money_value, cost_val))
+
+    await commit_optimistic(db, demolish, user, gen)
+    await db.refresh(user)
     # Return cost as BigValue components
     cost_payload = to_payload(cost_val)
     return {
@@ -262,117 +225,97 @@ async def remove_generator(generator_id: str, auth=Depends(get_user_and_db)):
 @router.post("/progress/{generator_id}/state")
 async def update_generator_state(generator_id: str, payload: GeneratorStateUpdate, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    gen = (
-        db.query(Generator)
+    gen = await db.scalar(
+        select(Generator)
+        .options(joinedload(Generator.generator_type))
         .filter(Generator.generator_id == generator_id, Generator.owner_id == user.user_id)
-        .first()
     )
     if not gen:
         raise HTTPException(status_code=404, detail="Generator not found")
-    mp = db.query(MapProgress).filter_by(generator_id=generator_id, user_id=user.user_id).first()
-    changed = False
+    gt = gen.generator_type
+    mp = await db.scalar(select(MapProgress).filter_by(generator_id=generator_id, user_id=user.user_id))
+    # 발전기만 바뀌어도 사용자 상태 버전(ETag)을 올린다. 그 UPDATE 가 충돌하면 다시 읽어 재적용
+    def apply():
+        changed = False
     
-    if payload.heat is not None:
-        new_heat = max(0, int(payload.heat))
-        current_heat = gen.heat or 0
+        if payload.heat is not None:
+            new_heat = max(0, int(payload.heat))
+            current_heat = gen.heat or 0
         
-        # Prevent suspicious heat resets (only allow gradual decreases)
-        # Heat can only decrease by a reasonable amount per update (max 50 points)
-        if new_heat < current_heat:
-            max_heat_decrease = 50
-            if current_heat - new_heat > max_heat_decrease:
-                raise HTTPException(status_code=400, detail="Heat decrease too large")
+            # Prevent suspicious heat resets (only allow gradual decreases)
+            # Heat can only decrease by a reasonable amount per update (max 50 points)
+            if new_heat < current_heat:
+                max_heat_decrease = 50
+                if current_heat - new_heat > max_heat_decrease:
+                    raise HTTPException(status_code=400, detail="Heat decrease too large")
         
-        gen.heat = new_heat
-        changed = True
-    
-    if payload.running is not None:
-        gen.running = bool(payload.running)
-        changed = True
+            gen.heat = new_heat
+            changed = True
     
-    if payload.explode:
-        gen.isdeveloping = True
-        gen.running = False
-        gen.heat = 0
-        gen.build_complete_ts = int(time.time() + _build_duration(getattr(gen, "generator_type", None), gen.level, user))
-        changed = True
+        if payload.running is not None:
+            gen.running = bool(payload.running)
+            changed = True
     
-    if not changed:
-        raise HTTPException(status_code=400, detail="No changes provided")
+        if payload.explode:
+            gen.isdeveloping = True
+            gen.running = False
+            gen.heat = 0
+            gen.build_complete_ts = int(time.time() + build_duration(gt, gen.level, user))
+            changed = True
     
-    db.commit()
-    db.refresh(gen)
+        if not changed:
+            raise HTTPException(status_code=400, detail="No changes provided")
+        touch_user(user)
+
+    await commit_optimistic(db, apply, user, gen, gt, mp)
+    await db.refresh(gen)
     return {
         "user": UserOut.model_validate(user),
-        "generator": _serialize_generator(
+        "generator": serialize_generator(
             gen,
-            getattr(gen.generator_type, "name", None),
-            getattr(gen.generator_type, "cost_data", 0),
-            getattr(gen.generator_type, "cost_high", 0),
+            getattr(gt, "name", None),
+            getattr(gt, "cost_data", 0),
+            getattr(gt, "cost_high", 0),
             mp,
         ),
     }
 
 
-def _gen_upgrade_meta(key: str):
-    meta = GENERATOR_UPGRADE_CONFIG.get(key)
-    if not meta:
-        raise HTTPException(status_code=404, detail="Unknown upgrade")
-    return meta
-
-
-def _calc_generator_upgrade_cost(gt: GeneratorType, mp: MapProgress, key: str, amount: int) -> BigValue:
-    """Calculate upgrade cost using BigValue operations (O(1) per level, no 10^high computation)"""
-    meta = _gen_upgrade_meta(key)
-    # Use BigValue cost from cost_data and cost_high
-    cost_val = BigValue(gt.cost_data, gt.cost_high)
-    current_level = getattr(mp, meta["field"], 0) or 0
-
-    # Calculate total cost by summing each level's cost using BigValue
-    total_cost = BigValue(0, 0)
-    for i in range(amount):
-        level = current_level + i + 1
-        # Calculate: base_cost * base_cost_multiplier * (price_growth ^ level)
-        level_multiplier = meta["base_cost_multiplier"] * (meta["price_growth"] ** level)
-        level_cost = multiply_by_float(cost_val, level_multiplier)
-        total_cost = add_values(total_cost, level_cost)
-
-    return total_cost
-
-
 @router.post("/progress/{generator_id}/upgrade")
 async def upgrade_generator(generator_id: str, payload: GeneratorUpgradeRequest, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    gen = (
-        db.query(Generator)
+    gen = await db.scalar(
+        select(Generator)
         .filter(Generator.generator_id == generator_id, Generator.owner_id == user.user_id)
-        .first()
     )
     if not gen:
         raise HTTPException(status_code=404, detail="Generator not found")
-    gt = db.query(GeneratorType).filter_by(generator_type_id=gen.generator_type_id).first()
+    gt = await db.scalar(select(GeneratorType).filter_by(generator_type_id=gen.generator_type_id))
     if not gt:
         raise HTTPException(status_code=404, detail="Generator type not found")
-    mp = db.query(MapProgress).filter_by(generator_id=generator_id, user_id=user.user_id).first()
+    mp = await db.scalar(select(MapProgress).filter_by(generator_id=generator_id, user_id=user.user_id))
     if not mp:
         raise HTTPException(status_code=404, detail="Progress not found")
     amount = max(1, payload.amount or 1)
-    cost_val = _calc_generator_upgrade_cost(gt, mp, payload.upgrade, amount)
-    money_value = get_user_money_value(user)
-    if compare(money_value, cost_val) < 0:
-        raise HTTPException(status_code=400, detail="Not enough money")
-    meta = _gen_upgrade_meta(payload.upgrade)
-    new_level = getattr(mp, meta["field"], 0) + amount
-    setattr(mp, meta["field"], new_level)
-    set_user_money_value(user, subtract_values(money_value, cost_val))
-    db.commit()
-    db.refresh(user)
-    db.refresh(mp)
-    db.refresh(gen)
+    meta = get_generator_upgrade_meta(payload.upgrade)
+
+    def upgrade():
+        cost_val = calculate_generator_upgrade_cost(gt, mp, payload.upgrade, amount)
+        money_value = get_user_money_value(user)
+        if compare(money_value, cost_val) < 0:
+            raise HTTPException(status_code=400, detail="Not enough money")
+        setattr(mp, meta["field"], getattr(mp, meta["field"], 0) + amount)
+        set_user_money_value(user, subtract_values(money_value, cost_val))
+        return cost_val
+
+    cost_val = await commit_optimistic(db, upgrade, user, gen, gt, mp)
+    await db.refresh(user)
+    await db.refresh(mp)
+    await db.refresh(gen)
     cost_payload = to_payload(cost_val)
     return {
         "user": UserOut.model_validate(user),
-        "generator": _serialize_generator(
+        "generator": serialize_generator(
             gen,
             getattr(gt, "name", None),
             getattr(gt, "cost_data", 0),
@@ -384,18 +327,20 @@ async def upgrade_generator(generator_id: str, payload: GeneratorUpgradeRequest,
     }
 
 
-def _calculate_total_energy_production(user: User, db: Session) -> BigValue:
+async def _calculate_total_energy_production(user: User, db: AsyncSession) -> BigValue:
     """Calculate total energy production per second from all user's generators using BigValue."""
     try:
-        from ..init_db import DEFAULT_GENERATOR_TYPES, DEFAULT_GENERATOR_NAME_TO_INDEX
+        from ..catalog import DEFAULT_GENERATOR_TYPES, DEFAULT_GENERATOR_NAME_TO_INDEX
 
         # Get all running generators for this user
         generators = (
-            db.query(Generator, MapProgress)
-            .join(MapProgress, MapProgress.generator_id == Generator.generator_id)
-            .filter(MapProgress.user_id == user.user_id, Generator.running == True, Generator.isdeveloping == False)
-            .all()
-        )
+            await db.execute(
+                select(Generator, MapProgress)
+                .join(MapProgress, MapProgress.generator_id == Generator.generator_id)
+                .options(joinedload(Generator.generator_type))
+                .filter(MapProgress.user_id == user.user_id, Generator.running == True, Generator.isdeveloping == False)
+            )
+        ).all()
 
         total_production = BigValue(0, 0)
         production_bonus_multiplier = 1.0 + (getattr(user, "production_bonus", 0) or 0) * 0.1
@@ -445,7 +390,7 @@ def _calculate_total_energy_production(user: User, db: Session) -> BigValue:
 
 
 @router.post("/progress/autosave")
-async def autosave_progress(payload: ProgressAutoSaveIn, auth=Depends(get_user_and_db)):
+async def autosave_progress(payload: ProgressAutoSaveIn, request: Request, auth=Depends(get_user_and_db)):
     user, db, _ = auth
     if payload is None:
         raise HTTPException(status_code=400, detail="No payload provided")
@@ -453,181 +398,192 @@ async def autosave_progress(payload: ProgressAutoSaveIn, auth=Depends(get_user_a
     # Import here to avoid circular dependency
     from ..game_logic import current_market_rate
     
-    updated = False
-    
-    # Energy validation (using BigValue, no to_plain())
-    energy_value = from_payload(payload.energy_data, payload.energy_high)
-    if energy_value is not None:
-        # Prefer client-reported production to reduce server recalculation
-        total_production_per_sec_bv = from_payload(payload.production_data, payload.production_high, 0)
-        if total_production_per_sec_bv is None:
-            total_production_per_sec_bv = _calculate_total_energy_production(user, db)
-
-        current_energy_bv = get_user_energy_value(user)
-        energy_delta_bv = subtract_values(energy_value, current_energy_bv)
-
-        production_is_zero = total_production_per_sec_bv.data <= 0 and total_production_per_sec_bv.high <= 0
-        is_first_energy_sync = current_energy_bv.data == 0 and current_energy_bv.high == 0
-
-        if not production_is_zero and not is_first_energy_sync:
-            # Allow a generous increase to avoid false positives after large rebirths/builds:
-            # - production_rate * 10,000,000 seconds
-            # - minimum 1B
-            max_by_rate = multiply_plain(total_production_per_sec_bv, 10_000_000)
-            min_increase_bv = from_plain(1_000_000_000)
-
-            max_allowed_increase = _max_bv(max_by_rate, min_increase_bv)
-
-            if compare(energy_delta_bv, max_allowed_increase) > 0:
-                raise HTTPException(status_code=400, detail="Energy increase is suspiciously large")
-
-        set_user_energy_value(user, energy_value)
-        updated = True
+    # 클라이언트 값을 검증해 반영한다. 동시 요청과 충돌하면(User.row_version) 새 값 기준으로 다시 검증한다
+    async def save():
+        updated = False
     
-    # Money validation (using BigValue, no to_plain())
-    money_value = from_payload(payload.money_data, payload.money_high)
-    if money_value is not None:
-        # Check for suspicious increases based on energy * exchange_rate * 1,000,000 (allow idle play)
-        current_money_bv = get_user_money_value(user)
-        current_energy_bv = get_user_energy_value(user)
+        # Energy validation (using BigValue, no to_plain())
+        energy_value = from_payload(payload.energy_data, payload.energy_high)
+        if energy_value is not None:
+            # Prefer client-reported production to reduce server recalculation
+            total_production_per_sec_bv = from_payload(payload.production_data, payload.production_high, 0)
+            if total_production_per_sec_bv is None:
+                total_production_per_sec_bv = await _calculate_total_energy_production(user, db)
 
-        try:
-            exchange_rate = current_market_rate(user)
-            # Maximum reasonable money increase:
-            # - current_energy * exchange_rate * 10,000,000
-            # - current_money * 100
-            # - minimum 1B
-            energy_times_rate = multiply_by_float(multiply_plain(current_energy_bv, 10_000_000), exchange_rate)
-            headroom_money = multiply_plain(current_money_bv, 100)
-            min_increase_bv = from_plain(1_000_000_000)
-            max_reasonable_increase_bv = _max_bv(_max_bv(energy_times_rate, headroom_money), min_increase_bv)
-            max_allowed_money = add_values(current_money_bv, max_reasonable_increase_bv)
-            if compare(money_value, max_allowed_money) > 0:
-                raise HTTPException(status_code=400, detail="Money increase is suspiciously large")
-        except Exception as e:
-            # Log error but don't block autosave
-            import logging
-            logging.warning(f"Money validation failed: {e}")
-            # Skip validation on error
+            current_energy_bv = get_user_energy_value(user)
+            energy_delta_bv = subtract_values(energy_value, current_energy_bv)
 
-        set_user_money_value(user, money_value)
-        updated = True
+            production_is_zero = total_production_per_sec_bv.data <= 0 and total_production_per_sec_bv.high <= 0
+            is_first_energy_sync = current_energy_bv.data == 0 and current_energy_bv.high == 0
+
+            if not production_is_zero and not is_first_energy_sync:
+                # Allow a generous increase to avoid false positives after large rebirths/builds:
+                # - production_rate * 10,000,000 seconds
+                # - minimum 1B
+                max_by_rate = multiply_plain(total_production_per_sec_bv, 10_000_000)
+                min_increase_bv = from_plain(1_000_000_000)
+
+                max_allowed_increase = _max_bv(max_by_rate, min_increase_bv)
+
+                if compare(energy_delta_bv, max_allowed_increase) > 0:
+                    raise HTTPException(status_code=400, detail="Energy increase is suspiciously large")
+
+            set_user_energy_value(user, energy_value)
+            updated = True
     
-    if payload.play_time_ms is not None:
-        user.play_time_ms = max(0, int(payload.play_time_ms))
-        updated = True
-
-    if payload.supercoin is not None:
-        user.supercoin = max(0, int(payload.supercoin))
-        updated = True
-
-    # Update generators (heat, running)
-    if payload.generators:
-        gen_updates = {g.generator_id: g for g in payload.generators if g.generator_id}
-        if gen_updates:
-            # Fetch relevant generators owned by user
-            gens = (
-                db.query(Generator)
-                .filter(
-                    Generator.generator_id.in_(gen_updates.keys()),
-                    Generator.owner_id == user.user_id
-                )
-                .all()
-            )
-            for g in gens:
-                update_data = gen_updates.get(g.generator_id)
-                if update_data:
-                    if update_data.heat is not None:
-                        g.heat = max(0, int(update_data.heat))
-                        updated = True
-                    if update_data.running is not None:
-                        g.running = bool(update_data.running)
-                        updated = True
+        # Money validation (using BigValue, no to_plain())
+        money_value = from_payload(payload.money_data, payload.money_high)
+        if money_value is not None:
+            # Check for suspicious increases based on energy * exchange_rate * 1,000,000 (allow idle play)
+            current_money_bv = get_user_money_value(user)
+            current_energy_bv = get_user_energy_value(user)
+
+            try:
+                exchange_rate = current_market_rate(user)
+                # Maximum reasonable money increase:
+                # - current_energy * exchange_rate * 10,000,000
+                # - current_money * 100
+                # - minimum 1B
+                energy_times_rate = multiply_by_float(multiply_plain(current_energy_bv, 10_000_000), exchange_rate)
+                headroom_money = multiply_plain(current_money_bv, 100)
+                min_increase_bv = from_plain(1_000_000_000)
+                max_reasonable_increase_bv = _max_bv(_max_bv(energy_times_rate, headroom_money), min_increase_bv)
+                max_allowed_money = add_values(current_money_bv, max_reasonable_increase_bv)
+                if compare(money_value, max_allowed_money) > 0:
+                    raise HTTPException(status_code=400, detail="Money increase is suspiciously large")
+            except Exception as e:
+                # Log error but don't block autosave
+                import logging
+                logging.warning(f"Money validation failed: {e}")
+                # Skip validation on error
+
+            set_user_money_value(user, money_value)
+            updated = True
+    
+        if payload.play_time_ms is not None:
+            user.play_time_ms = max(0, int(payload.play_time_ms))
+            updated = True
+
+        if payload.supercoin is not None:
+            user.supercoin = max(0, int(payload.supercoin))
+            updated = True
+
+        # Update generators (heat, running)
+        if payload.generators:
+            gen_updates = {g.generator_id: g for g in payload.generators if g.generator_id}
+            if gen_updates:
+                # Fetch relevant generators owned by user
+                gens = (
+                    await db.execute(
+                        select(Generator).filter(
+                            Generator.generator_id.in_(gen_updates.keys()),
+                            Generator.owner_id == user.user_id
+                        )
+                    )
+                ).scalars().all()
+                for g in gens:
+                    update_data = gen_updates.get(g.generator_id)
+                    if update_data:
+                        if update_data.heat is not None:
+                            g.heat = max(0, int(update_data.heat))
+                            updated = True
+                        if update_data.running is not None:
+                            g.running = bool(update_data.running)
+                            updated = True
+                if updated:
+                    touch_user(user)
+
+        # 자동 환전 정책이 켜져 있으면 저장된 에너지 기준으로 같은 트랜잭션에서 판다 (별도 /change 요청 없음)
+        auto_exchange = apply_auto_exchange(user)
+        if auto_exchange is not None:
+            updated = True
+        return updated, auto_exchange
+
+    updated, auto_exchange = await commit_optimistic(db, save, user)
     
     if not updated:
         # No changes detected - return success without error
-        return {"user": UserOut.model_validate(user), "message": "No changes to save"}
+        return negotiate(request, {"user": UserOut.model_validate(user), "message": "No changes to save"})
     
-    db.commit()
-    db.refresh(user)
-    return {"user": UserOut.model_validate(user)}
+    await db.refresh(user)
+    return negotiate(request, {"user": UserOut.model_validate(user), "auto_exchange": auto_exchange})
 
 
 @router.post("/progress/{generator_id}/build/skip")
 async def skip_build(generator_id: str, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    gen = (
-        db.query(Generator)
+    gen = await db.scalar(
+        select(Generator)
         .filter(Generator.generator_id == generator_id, Generator.owner_id == user.user_id)
-        .first()
     )
     if not gen:
         raise HTTPException(status_code=404, detail="Generator not found")
-    gt = db.query(GeneratorType).filter_by(generator_type_id=gen.generator_type_id).first()
-    mp = db.query(MapProgress).filter_by(generator_id=generator_id, user_id=user.user_id).first()
+    gt = await db.scalar(select(GeneratorType).filter_by(generator_type_id=gen.generator_type_id))
+    mp = await db.scalar(select(MapProgress).filter_by(generator_id=generator_id, user_id=user.user_id))
     type_name = getattr(gt, "name", None)
     cost_data = getattr(gt, "cost_data", 0)
     cost_high = getattr(gt, "cost_high", 0)
     now = int(time.time())
-    if _maybe_complete_build(gen, now):
-        db.commit()
-        db.refresh(gen)
+    if gen.isdeveloping and gen.build_complete_ts and gen.build_complete_ts <= now:
+        async with write_transaction(db):
+            maybe_complete_build(gen, now)
+            await db.commit()
+        await db.refresh(gen)
         return {
             "user": UserOut.model_validate(user),
-            "generator": _serialize_generator(gen, type_name, cost_data, cost_high, mp),
+            "generator": serialize_generator(gen, type_name, cost_data, cost_high, mp),
         }
     if not gen.isdeveloping or not gen.build_complete_ts:
         return {
             "user": UserOut.model_validate(user),
-            "generator": _serialize_generator(gen, type_name, cost_data, cost_high, mp),
+            "generator": serialize_generator(gen, type_name, cost_data, cost_high, mp),
         }
     remaining = max(0, gen.build_complete_ts - now)
     if remaining <= 0:
-        gen.isdeveloping = False
-        gen.build_complete_ts = None
-        gen.running = True
-        db.commit()
-        db.refresh(gen)
+        async with write_transaction(db):
+            gen.isdeveloping = False
+            gen.build_complete_ts = None
+            gen.running = True
+            await db.commit()
+        await db.refresh(gen)
         return {
             "user": UserOut.model_validate(user),
-            "generator": _serialize_generator(gen, type_name, cost_data, cost_high, mp),
+            "generator": serialize_generator(gen, type_name, cost_data, cost_high, mp),
         }
     if not gt:
         raise HTTPException(status_code=404, detail="Generator type not found")
     
-    # Calculate proportional cost using BigValue (no to_plain())
-    # Cost is reduced by 10x for faster progression
-    try:
-        total_duration = max(1, _build_duration(gt, gen.level, user))
-        full_cost_val = BigValue(gt.cost_data, gt.cost_high)
-        # Proportional cost based on remaining time: (remaining / total_duration) * full_cost / 10
-        proportion = remaining / total_duration
-        cost_val = multiply_by_float(full_cost_val, proportion)
-        # Reduce cost by 10x
-        cost_val = multiply_by_float(cost_val, 0.1)
-        # Ensure at least cost of 1
-        if cost_val.data == 0:
-            cost_val = from_plain(1)
-    except Exception as e:
-        import logging
-        logging.error(f"Skip build cost calculation error: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Cost calculation failed: {str(e)}")
-    
-    money_value = get_user_money_value(user)
-    if compare(money_value, cost_val) < 0:
-        raise HTTPException(status_code=400, detail="Not enough money to skip build")
-    set_user_money_value(user, subtract_values(money_value, cost_val))
-    gen.isdeveloping = False
-    gen.build_complete_ts = None
-    gen.running = True
-    db.commit()
-    db.refresh(gen)
-    db.refresh(user)
+    def skip():
+        # 재시도라면 동시 요청이 이미 건설을 끝냈을 수 있다: 그때는 비용 없이 끝낸다
+        if not gen.isdeveloping or not gen.build_complete_ts:
+            return from_plain(0), 0
+        left = max(0, gen.build_complete_ts - now)
+        # Calculate proportional cost using BigValue (no to_plain())
+        # Cost is reduced by 10x for faster progression
+        try:
+            cost_val = calculate_skip_build_cost(gt, gen, user, left)
+        except Exception as e:
+            import logging
+            logging.error(f"Skip build cost calculation error: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"Cost calculation failed: {str(e)}")
+
+        money_value = get_user_money_value(user)
+        if compare(money_value, cost_val) < 0:
+            raise HTTPException(status_code=400, detail="Not enough money to skip build")
+        set_user_money_value(user, subtract_values(money_value, cost_val))
+        gen.isdeveloping = False
+        gen.build_complete_ts = None
+        gen.running = True
+        return cost_val, left
+
+    cost_val, remaining = await commit_optimistic(db, skip, user, gen, gt, mp)
+    await db.refresh(gen)
+    await db.refresh(user)
     
     cost_payload = to_payload(cost_val)
     return {
         "user": UserOut.model_validate(user),
-        "generator": _serialize_generator(gen, type_name, cost_data, cost_high, mp),
+        "generator": serialize_generator(gen, type_name, cost_data, cost_high, mp),
         "skip_cost_data": cost_payload["data"],
         "skip_cost_high": cost_payload["high"],
         "remaining_seconds": remaining,
@@ -635,99 +591,98 @@ async def skip_build(generator_id: str, auth=Depends(get_user_and_db)):
 
 
 @router.post("/generators/bulk-upgrade")
-async def bulk_upgrade_generators(payload: BulkGeneratorUpgradeRequest, auth=Depends(get_user_and_db)):
+async def bulk_upgrade_generators(payload: BulkGeneratorUpgradeRequest, request: Request, auth=Depends(get_user_and_db)):
     user, db, _ = auth
     if not payload.upgrades:
-        return {"user": UserOut.model_validate(user), "generators": []}
-
-    # Lock user row to prevent race conditions with money
-    user = db.query(User).filter_by(user_id=user.user_id).with_for_update().first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+        return negotiate(request, {"user": UserOut.model_validate(user), "generators": []})
 
-    money_value = get_user_money_value(user)
+    # 행 잠금 없이 읽고 계산한 뒤 User.row_version 으로 충돌을 검사한다 (충돌 시 전체를 다시 읽어 재시도)
+    async def upgrade_all():
+        money_value = get_user_money_value(user)
     
-    # Pre-fetch all necessary data to avoid queries in a loop
-    generator_ids = {item.generator_id for item in payload.upgrades}
+        # Pre-fetch all necessary data to avoid queries in a loop
+        generator_ids = {item.generator_id for item in payload.upgrades}
     
-    map_progresses = db.query(MapProgress).filter(
-        MapProgress.user_id == user.user_id,
-        MapProgress.generator_id.in_(generator_ids)
-    ).all()
-    map_progress_dict = {mp.generator_id: mp for mp in map_progresses}
+        map_progresses = (await db.execute(select(MapProgress).filter(
+            MapProgress.user_id == user.user_id,
+            MapProgress.generator_id.in_(generator_ids)
+        ))).scalars().all()
+        map_progress_dict = {mp.generator_id: mp for mp in map_progresses}
     
-    generators = db.query(Generator).filter(
-        Generator.generator_id.in_(generator_ids),
-        Generator.owner_id == user.user_id
-    ).all()
-    generator_dict = {g.generator_id: g for g in generators}
-
-    generator_type_ids = {g.generator_type_id for g in generators}
-    generator_types = db.query(GeneratorType).filter(
-        GeneratorType.generator_type_id.in_(generator_type_ids)
-    ).all()
-    generator_type_dict = {gt.generator_type_id: gt for gt in generator_types}
-
-    updated_gens = set()
-
-    for upgrade_item in payload.upgrades:
-        gen_id = upgrade_item.generator_id
-        key = upgrade_item.key
-        amount = upgrade_item.amount
-
-        mp = map_progress_dict.get(gen_id)
-        gen = generator_dict.get(gen_id)
-        if not mp or not gen:
-            continue  # Skip if generator or progress not found for this user
-
-        gt = generator_type_dict.get(gen.generator_type_id)
-        if not gt:
-            continue
+        generators = (await db.execute(select(Generator).filter(
+            Generator.generator_id.in_(generator_ids),
+            Generator.owner_id == user.user_id
+        ))).scalars().all()
+        generator_dict = {g.generator_id: g for g in generators}
+
+        generator_type_ids = {g.generator_type_id for g in generators}
+        generator_types = (await db.execute(select(GeneratorType).filter(
+            GeneratorType.generator_type_id.in_(generator_type_ids)
+        ))).scalars().all()
+        generator_type_dict = {gt.generator_type_id: gt for gt in generator_types}
+
+        updated_gens = set()
+
+        for upgrade_item in payload.upgrades:
+            gen_id = upgrade_item.generator_id
+            key = upgrade_item.key
+            amount = upgrade_item.amount
+
+            mp = map_progress_dict.get(gen_id)
+            gen = generator_dict.get(gen_id)
+            if not mp or not gen:
+                continue  # Skip if generator or progress not found for this user
+
+            gt = generator_type_dict.get(gen.generator_type_id)
+            if not gt:
+                continue
 
-        try:
-            cost_val = _calc_generator_upgrade_cost(gt, mp, key, amount)
-            if compare(money_value, cost_val) < 0:
-                # Not enough money, stop processing further upgrades
-                break
+            try:
+                cost_val = calculate_generator_upgrade_cost(gt, mp, key, amount)
+                if compare(money_value, cost_val) < 0:
+                    # Not enough money, stop processing further upgrades
+                    break
             
-            meta = _gen_upgrade_meta(key)
+                meta = get_generator_upgrade_meta(key)
             
-            # Apply changes
-            current_level = getattr(mp, meta["field"], 0) or 0
-            setattr(mp, meta["field"], current_level + amount)
-            money_value = subtract_values(money_value, cost_val)
-            updated_gens.add(gen_id)
+                # Apply changes
+                current_level = getattr(mp, meta["field"], 0) or 0
+                setattr(mp, meta["field"], current_level + amount)
+                money_value = subtract_values(money_value, cost_val)
+                updated_gens.add(gen_id)
+
+            except HTTPException:
+                # This could happen if 'key' is invalid.
+                # In a bulk operation, we prefer to skip the invalid item.
+                continue
 
-        except HTTPException:
-            # This could happen if 'key' is invalid.
-            # In a bulk operation, we prefer to skip the invalid item.
-            continue
+        # Update user's money once after all successful upgrades
+        set_user_money_value(user, money_value)
+        return updated_gens, generator_type_dict
 
-    # Update user's money once after all successful upgrades
-    set_user_money_value(user, money_value)
-    db.commit()
+    updated_gens, generator_type_dict = await commit_optimistic(db, upgrade_all, user)
 
     # Refresh user and generator objects to get the latest state
-    db.refresh(user)
+    await db.refresh(user)
     
     # Serialize only the generators that were actually updated
     updated_generator_data = []
     if updated_gens:
-        final_gens = db.query(Generator, MapProgress).join(
+        final_gens = (await db.execute(select(Generator, MapProgress).join(
             MapProgress, MapProgress.generator_id == Generator.generator_id
         ).filter(
             Generator.generator_id.in_(updated_gens)
-        ).all()
+        ))).all()
 
         for g, mp in final_gens:
             gt = generator_type_dict.get(g.generator_type_id)
             updated_generator_data.append(
-                _serialize_generator(g, getattr(gt, "name", None), getattr(gt, "cost_data", 0), getattr(gt, "cost_high", 0), mp)
+                serialize_generator(g, getattr(gt, "name", None), getattr(gt, "cost_data", 0), getattr(gt, "cost_high", 0), mp)
             )
 
-    return {
+    return negotiate(request, {
         "user": UserOut.model_validate(user),
         "generators": updated_generator_data
-    }
+    })
 
 
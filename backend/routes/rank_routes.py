@@ -1,8 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import aliased
 
-from ..dependencies import get_user_and_db
+from ..auth_utils import forget_user_access_tokens
+from ..dependencies import get_principal_and_read_db
 from ..models import User
+from ..responses import FastJSONResponse
 from ..bigvalue import get_user_money_value, get_user_energy_value, normalize
 
 router = APIRouter()
@@ -38,42 +41,59 @@ def _user_score(u: User, criteria: str = "money"):
         }
 
 
+# 기준별 정렬 키: (컬럼, 내림차순 여부). 마지막의 user_id 가 동점을 끊는다
+_ORDER_KEYS = {
+    "energy": [("energy_high", True), ("energy_data", True)],
+    "playtime": [("play_time_ms", True)],
+    "rebirth": [("rebirth_count", True), ("money_high", True), ("money_data", True)],
+    "supercoin": [("supercoin", True), ("money_high", True), ("money_data", True)],
+    "money": [("money_high", True), ("money_data", True)],
+}
+
+
+def _order_keys(criteria: str):
+    return _ORDER_KEYS.get(criteria, _ORDER_KEYS["money"]) + [("user_id", False)]
+
+
 def _get_order_by(criteria: str):
     """Get SQLAlchemy order_by clause based on criteria."""
-    if criteria == "energy":
-        return [User.energy_high.desc(), User.energy_data.desc(), User.user_id]
-    elif criteria == "playtime":
-        return [User.play_time_ms.desc(), User.user_id]
-    elif criteria == "rebirth":
-        return [User.rebirth_count.desc(), User.money_high.desc(), User.money_data.desc(), User.user_id]
-    elif criteria == "supercoin":
-        return [User.supercoin.desc(), User.money_high.desc(), User.money_data.desc(), User.user_id]
-    else:  # money (default)
-        return [User.money_high.desc(), User.money_data.desc(), User.user_id]
+    return [getattr(User, name).desc() if desc else getattr(User, name) for name, desc in _order_keys(criteria)]
+
+
+def _ahead_of(other, me, criteria: str):
+    """SQL condition: `other` sorts before `me` under _get_order_by(criteria) (lexicographic over the keys)."""
+    ahead = None
+    for name, desc in reversed(_order_keys(criteria)):
+        mine, theirs = getattr(me, name), getattr(other, name)
+        before = theirs > mine if desc else theirs < mine
+        ahead = before if ahead is None else or_(before, and_(theirs == mine, ahead))
+    return ahead
 
 
 @router.get("/rank")
-async def rank(criteria: str = "money", auth=Depends(get_user_and_db)):
-    user, db, _ = auth
+async def rank(criteria: str = "money", auth=Depends(get_principal_and_read_db)):
+    user_id, db = auth
     import logging
     logger = logging.getLogger(__name__)
-    logger.info(f"Fetching rank for user {user.username} with criteria: {criteria}")
-    
-    order_clause = _get_order_by(criteria)
-    logger.info(f"Order clause: {order_clause}")
-    
-    ordered = db.query(User).order_by(*order_clause).all()
-    for idx, u in enumerate(ordered):
-        if u.user_id == user.user_id:
-            score = _user_score(u, criteria)
-            logger.info(f"User {user.username} rank: {idx + 1}, score: {score}, criteria: {criteria}")
-            return {"username": u.username, "rank": idx + 1, "score": score, "criteria": criteria}
-    raise HTTPException(status_code=404, detail="User not found")
+    logger.info(f"Fetching rank for user {user_id} with criteria: {criteria}")
+
+    # 앞선 사용자 수를 DB 에서 세어 요청자 행과 함께 한 번에 읽는다 (전체 사용자를 불러오지 않는다)
+    other = aliased(User)
+    ahead = select(func.count()).select_from(other).where(_ahead_of(other, User, criteria)).scalar_subquery()
+    found = (await db.execute(select(User, ahead).where(User.user_id == user_id))).first()
+    if found is None:
+        # 토큰은 유효하지만 계정이 삭제됨: 캐시된 토큰도 버리고 다른 경로처럼 401 (클라이언트가 로그아웃한다)
+        forget_user_access_tokens(user_id)
+        raise HTTPException(status_code=401, detail="User not found for token")
+    u, idx = found
+    score = _user_score(u, criteria)
+    logger.info(f"User {u.username} rank: {idx + 1}, score: {score}, criteria: {criteria}")
+    return FastJSONResponse({"username": u.username, "rank": idx + 1, "score": score, "criteria": criteria})
 
 
 @router.get("/ranks")
-async def ranks(limit: int = 100, offset: int = 0, criteria: str = "money", auth=Depends(get_user_and_db)):
-    _, db, _ = auth
+async def ranks(limit: int = 100, offset: int = 0, criteria: str = "money", auth=Depends(get_principal_and_read_db)):
+    user_id, db = auth
     import logging
     logger = logging.getLogger(__name__)
     logger.info(f"Fetching ranks with criteria: {criteria}, limit: {limit}, offset: {offset}")
@@ -84,9 +104,16 @@ async def ranks(limit: int = 100, offset: int = 0, criteria: str = "money", auth
     order_clause = _get_order_by(criteria)
     logger.info(f"Order clause: {order_clause}")
     
-    base_query = db.query(User).order_by(*order_clause)
-    total = base_query.count()
-    users = base_query.offset(offset).limit(limit).all()
+    # 전체 수와 함께 요청자 계정이 아직 있는지 같은 쿼리에서 확인한다 (principal 만 믿지 않는다)
+    total, requester_exists = (
+        await db.execute(
+            select(func.count(), select(User.user_id).where(User.user_id == user_id).exists()).select_from(User)
+        )
+    ).one()
+    if not requester_exists:
+        forget_user_access_tokens(user_id)
+        raise HTTPException(status_code=401, detail="User not found for token")
+    users = (await db.execute(select(User).order_by(*order_clause).offset(offset).limit(limit))).scalars().all()
     out = [{"username": u.username, "rank": offset + i + 1, "score": _user_score(u, criteria)} for i, u in enumerate(users)]
     logger.info(f"Returning {len(out)} ranks with criteria: {criteria}")
-    return {"total": total, "limit": limit, "offset": offset, "criteria": criteria, "ranks": out}
+    return FastJSONResponse({"total": total, "limit": limit, "offset": offset, "criteria": criteria, "ranks": out})
@@ -1,6 +1,8 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy import delete
 
-from ..dependencies import get_user_and_db
+from ..dependencies import commit_optimistic, get_user_and_db, get_user_and_read_db
+from ..etag import matching_etag, not_modified, set_etag, user_etag
 from ..models import MapProgress, Generator
 from ..schemas import RebirthRequest, UserOut
 from ..bigvalue import (
@@ -42,9 +44,13 @@ def calculate_rebirth_start_money(user) -> BigValue:
 
 
 @router.get("/rebirth/info")
-async def get_rebirth_info(auth=Depends(get_user_and_db)):
+async def get_rebirth_info(request: Request, response: Response, auth=Depends(get_user_and_read_db)):
     """Get current rebirth information for the user"""
     user, db, _ = auth
+    cached = matching_etag(request, user.user_id, user.row_version)
+    if cached:
+        return not_modified(cached)
+    set_etag(response, user_etag(user.user_id, user.row_version))
     
     current_count = getattr(user, "rebirth_count", 0) or 0
     max_chain = max(1, 1 + (getattr(user, "rebirth_chain_upgrade", 0) or 0))
@@ -86,53 +92,51 @@ async def perform_rebirth(payload: RebirthRequest | None = None, auth=Depends(ge
         if amount < 1:
             raise HTTPException(status_code=400, detail="환생 횟수는 1 이상이어야 합니다.")
         
-        # Use FOR UPDATE to lock the user row
-        user = db.query(type(user)).filter_by(user_id=user.user_id).with_for_update().first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+        # 행 잠금 없이 검사/변경하고 User.row_version 으로 충돌을 검사한다 (충돌 시 새 상태로 다시 검사)
+        async def rebirth():
+            max_chain = max(1, 1 + (getattr(user, "rebirth_chain_upgrade", 0) or 0))
+            if amount > max_chain:
+                raise HTTPException(status_code=400, detail=f"한 번에 최대 {max_chain}회까지 환생할 수 있습니다.")
         
-        max_chain = max(1, 1 + (getattr(user, "rebirth_chain_upgrade", 0) or 0))
-        if amount > max_chain:
-            raise HTTPException(status_code=400, detail=f"한 번에 최대 {max_chain}회까지 환생할 수 있습니다.")
+            current_count = getattr(user, "rebirth_count", 0) or 0
+            target_rebirth_index = current_count + amount - 1
+            rebirth_cost = calculate_rebirth_cost(target_rebirth_index)
+            money_value = get_user_money_value(user)
         
-        current_count = getattr(user, "rebirth_count", 0) or 0
-        target_rebirth_index = current_count + amount - 1
-        rebirth_cost = calculate_rebirth_cost(target_rebirth_index)
-        money_value = get_user_money_value(user)
+            # Check if user has enough money
+            if compare(money_value, rebirth_cost) < 0:
+                raise HTTPException(status_code=400, detail="Not enough money for rebirth")
         
-        # Check if user has enough money
-        if compare(money_value, rebirth_cost) < 0:
-            raise HTTPException(status_code=400, detail="Not enough money for rebirth")
+            # Calculate new multiplier
+            new_multiplier = calculate_rebirth_multiplier(current_count + amount)
         
-        # Calculate new multiplier
-        new_multiplier = calculate_rebirth_multiplier(current_count + amount)
+            # Delete all generators and map progress
+            await db.execute(delete(MapProgress).where(MapProgress.user_id == user.user_id))
+            await db.execute(delete(Generator).where(Generator.owner_id == user.user_id))
         
-        # Delete all generators and map progress
-        db.query(MapProgress).filter(MapProgress.user_id == user.user_id).delete()
-        db.query(Generator).filter(Generator.owner_id == user.user_id).delete()
+            # Reset upgrades
+            user.production_bonus = 0
+            user.heat_reduction = 0
+            user.tolerance_bonus = 0
+            user.max_generators_bonus = 0
+            user.demand_bonus = 0
         
-        # Reset upgrades
-        user.production_bonus = 0
-        user.heat_reduction = 0
-        user.tolerance_bonus = 0
-        user.max_generators_bonus = 0
-        user.demand_bonus = 0
+            # Reset energy to 0
+            set_user_energy_value(user, from_plain(0))
         
-        # Reset energy to 0
-        set_user_energy_value(user, from_plain(0))
+            # Reset money to upgraded starting amount
+            set_user_money_value(user, calculate_rebirth_start_money(user))
         
-        # Reset money to upgraded starting amount
-        set_user_money_value(user, calculate_rebirth_start_money(user))
+            # Increment rebirth count
+            user.rebirth_count = current_count + amount
         
-        # Increment rebirth count
-        user.rebirth_count = current_count + amount
-        
-        # Reset user's sold_energy (per-user market state)
-        user.sold_energy_data = 0
-        user.sold_energy_high = 0
-        
-        db.commit()
-        db.refresh(user)
+            # Reset user's sold_energy (per-user market state)
+            user.sold_energy_data = 0
+            user.sold_energy_high = 0
+            return new_multiplier
+
+        new_multiplier = await commit_optimistic(db, rebirth, user)
+        await db.refresh(user)
         
         return {
             "user": UserOut.model_validate(user),
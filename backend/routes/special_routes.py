@@ -1,12 +1,21 @@
 from fastapi import APIRouter, Depends, HTTPException
 
+from ..database import atomic_update, write_transaction
 from ..dependencies import get_user_and_db
+from ..models import User
 from ..schemas import UserOut
 
 router = APIRouter()
 
+# upgrade_type -> (User 컬럼, 최대 레벨 또는 None)
+SPECIAL_UPGRADES = {
+    "build_speed": (User.build_speed_reduction, 9),
+    "energy_mult": (User.energy_multiplier, None),
+    "exchange_mult": (User.exchange_rate_multiplier, None),
+}
 
-def apply_special_upgrade(user, db, upgrade_type: str):
+
+async def apply_special_upgrade(user, db, upgrade_type: str):
     """
     Apply special upgrade using supercoin (fixed cost: 1 supercoin)
     
@@ -18,50 +27,50 @@ def apply_special_upgrade(user, db, upgrade_type: str):
     Returns:
         Updated user
     """
-    # Check supercoin
+    if upgrade_type not in SPECIAL_UPGRADES:
+        raise HTTPException(status_code=400, detail="잘못된 업그레이드 타입입니다.")
+    column, max_level = SPECIAL_UPGRADES[upgrade_type]
+
+    # 읽은 값으로 먼저 검사해 정확한 메시지를 주고, 같은 조건을 UPDATE 의 WHERE 에도 걸어 경합을 막는다
     if user.supercoin < 1:
         raise HTTPException(status_code=400, detail="슈퍼코인이 부족합니다.")
-    
-    # Check max level
-    if upgrade_type == "build_speed":
-        current_level = user.build_speed_reduction
-        max_level = 9
-        if current_level >= max_level:
-            raise HTTPException(status_code=400, detail="최대 레벨에 도달했습니다.")
-        user.build_speed_reduction += 1
-    elif upgrade_type == "energy_mult":
-        user.energy_multiplier += 1
-    elif upgrade_type == "exchange_mult":
-        user.exchange_rate_multiplier += 1
-    else:
-        raise HTTPException(status_code=400, detail="잘못된 업그레이드 타입입니다.")
-    
-    # Deduct supercoin
-    user.supercoin -= 1
-    
-    db.commit()
-    db.refresh(user)
+    if max_level is not None and getattr(user, column.key) >= max_level:
+        raise HTTPException(status_code=400, detail="최대 레벨에 도달했습니다.")
+
+    guard = [User.supercoin >= 1]
+    if max_level is not None:
+        guard.append(column < max_level)
+    async with write_transaction(db):
+        row = await atomic_update(
+            db, User, [User.user_id == user.user_id],
+            {column: column + 1, User.supercoin: User.supercoin - 1},
+            guard=guard, returning=(column, User.supercoin), sync=user,
+        )
+        if row is None:
+            # 동시 요청이 먼저 슈퍼코인/레벨을 소모했다
+            raise HTTPException(status_code=400, detail="슈퍼코인이 부족하거나 최대 레벨에 도달했습니다.")
+        await db.commit()
     return user
 
 
 @router.post("/special/build_speed")
 async def upgrade_build_speed(auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_special_upgrade(user, db, "build_speed")
+    upgraded_user = await apply_special_upgrade(user, db, "build_speed")
     return UserOut.model_validate(upgraded_user)
 
 
 @router.post("/special/energy_mult")
 async def upgrade_energy_mult(auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_special_upgrade(user, db, "energy_mult")
+    upgraded_user = await apply_special_upgrade(user, db, "energy_mult")
     return UserOut.model_validate(upgraded_user)
 
 
 @router.post("/special/exchange_mult")
 async def upgrade_exchange_mult(auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_special_upgrade(user, db, "exchange_mult")
+    upgraded_user = await apply_special_upgrade(user, db, "exchange_mult")
     return UserOut.model_validate(upgraded_user)
 
 
@@ -71,7 +80,13 @@ async def award_supercoin(auth=Depends(get_user_and_db)):
     Award 1 supercoin to user (called automatically from frontend when lucky)
     """
     user, db, _ = auth
-    user.supercoin = (user.supercoin or 0) + 1
-    db.commit()
-    db.refresh(user)
-    return {"supercoin": user.supercoin}
+    async with write_transaction(db):
+        row = await atomic_update(
+            db, User, [User.user_id == user.user_id],
+            {User.supercoin: User.supercoin + 1},
+            returning=(User.supercoin,), sync=user,
+        )
+        if row is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        await db.commit()
+    return {"supercoin": row.supercoin}
@@ -1,23 +1,44 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+
+import orjson
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import Response
 from pydantic import BaseModel, Field
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 
-from ..dependencies import get_user_and_db
+from ..dependencies import commit_optimistic, get_user_and_db
+from ..game_logic import apply_auto_exchange, touch_user
+from ..responses import MsgPackResponse, MsgPackRoute, negotiate, wants_msgpack
 from ..schemas import UserOut
 from ..sync_logic import (
     apply_action_to_state,
+    apply_state_to_user,
+    batch_fingerprint,
+    load_generator_snapshot,
+    load_sync_batch,
     load_user_state,
-    persist_user_state,
+    pending_actions,
+    serialize_touched_generators,
+    stage_generator_changes,
+    store_sync_batch,
     validate_client_state,
 )
 
-router = APIRouter()
+router = APIRouter(route_class=MsgPackRoute)
 
 
 class ActionPayload(BaseModel):
-    type: str = Field(..., description="upgrade | collect_money | collect_energy | ...")
+    type: str = Field(
+        ...,
+        description=(
+            "upgrade | collect_money | collect_energy | exchange | build | demolish | "
+            "generator_upgrade | skip_build | generator_state"
+        ),
+    )
     payload: dict = Field(default_factory=dict)
     ts: int | None = None
+    id: str | None = Field(default=None, max_length=64, description="Client-generated action id")
+    seq: int | None = Field(default=None, ge=1, description="Per-user increasing sequence number")
 
 
 class ClientState(BaseModel):
@@ -33,24 +54,101 @@ class ClientState(BaseModel):
 class SyncRequest(BaseModel):
     actions: list[ActionPayload] = Field(default_factory=list)
     clientState: ClientState
+    idempotencyKey: str | None = Field(default=None, min_length=1, max_length=128)
+
+
+class SyncOut(UserOut):
+    applied: int = 0
+    skipped: int = 0
+    # 발전기 명령이 있던 배치에서만 채워진다
+    generators: list[dict] = Field(default_factory=list)
+    created: dict[str, str] = Field(default_factory=dict)
+    demolished: list[str] = Field(default_factory=list)
+    # 사용자의 자동 환전 정책이 이번 배치에서 판 양 (없으면 null)
+    auto_exchange: dict | None = None
+
 
+def _replay(request: Request, batch) -> Response:
+    headers = {"Idempotent-Replayed": "true"}
+    if wants_msgpack(request):
+        # 저장된 결과는 JSON 이므로 msgpack 클라이언트에는 다시 인코딩해 준다
+        return MsgPackResponse(orjson.loads(batch.response), headers=headers)
+    return Response(content=batch.response, media_type="application/json", headers=headers)
 
-@router.post("/sync", response_model=UserOut)
-async def sync_progress(payload: SyncRequest, auth=Depends(get_user_and_db)):
+
+@router.post("/sync", response_model=SyncOut)
+async def sync_progress(
+    payload: SyncRequest,
+    request: Request,
+    auth=Depends(get_user_and_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=128),
+):
     user, db, _ = auth  # type: ignore
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    state = load_user_state(user)
+    actions = [action.model_dump() for action in payload.actions]
+    key = payload.idempotencyKey or idempotency_key
+    request_hash = None
+    if key:
+        # 같은 키의 재시도는 저장된 결과를 그대로 돌려준다 (상태 재적용/409 없음)
+        request_hash = batch_fingerprint(actions)
+        stored = await load_sync_batch(db, user.user_id, key)
+        if stored is not None:
+            if stored.request_hash != request_hash:
+                raise HTTPException(status_code=422, detail="Idempotency key reused with different actions")
+            return _replay(request, stored)
 
-    for action in payload.actions:
+    # 행 잠금 없이 처리하고 User.row_version 으로 충돌을 검사한다. 충돌하면 새 sync_seq / 잔액 기준으로
+    # 배치를 처음부터 다시 적용한다 (이미 적용된 seq 는 건너뛰어진다)
+    async def process():
         try:
-            state = apply_action_to_state(state, action.model_dump())
+            to_apply, high_water, skipped = pending_actions(actions, user.sync_seq or 0)
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
 
-    if not validate_client_state(state, payload.clientState.model_dump()):
-        raise HTTPException(status_code=409, detail="Client state out of sync")
+        # 배치 전체를 하나의 메모리 스냅샷(사용자 + 발전기)에 순서대로 적용하고 한 번에 커밋한다
+        state = load_user_state(user)
+        await load_generator_snapshot(db, state, to_apply)
+        for action in to_apply:
+            try:
+                state = apply_action_to_state(state, action)
+            except ValueError as e:
+                label = action.get("id") or action.get("seq")
+                raise HTTPException(status_code=400, detail=f"{e} (action {label})" if label else str(e))
+
+        if not validate_client_state(state, payload.clientState.model_dump()):
+            raise HTTPException(status_code=409, detail="Client state out of sync")
+
+        apply_state_to_user(user, state)
+        # 클라이언트 상태 검증 뒤에 적용한다: 클라이언트는 응답의 값으로 맞춘다
+        auto_exchange = apply_auto_exchange(user)
+        user.sync_seq = high_water
+        if state["touched"] or state["added"] or state["removed"]:
+            # 발전기만 바뀐 배치도 사용자 상태 버전(ETag)을 올린다
+            touch_user(user)
+        await stage_generator_changes(db, state)
+        # User.generators 관계를 읽지 않도록 UserOut 필드만 먼저 뽑는다
+        result = SyncOut(
+            **UserOut.model_validate(user).model_dump(),
+            applied=len(to_apply),
+            skipped=skipped,
+            generators=serialize_touched_generators(state) if state["generators"] is not None else [],
+            created=state["created"],
+            demolished=[gen.generator_id for gen, _ in state["removed"]],
+            auto_exchange=auto_exchange,
+        )
+        if key:
+            await store_sync_batch(db, user.user_id, key, request_hash, result.model_dump_json())
+        return result
 
-    user = persist_user_state(db, user, state)
-    return UserOut.model_validate(user)
+    try:
+        result = await commit_optimistic(db, process, user)
+    except IntegrityError:
+        # 같은 키의 동시 요청이 먼저 커밋했다: 그쪽 결과를 돌려준다
+        await db.rollback()
+        stored = await load_sync_batch(db, user.user_id, key) if key else None
+        if stored is None:
+            raise
+        return _replay(request, stored)
+    return negotiate(request, result)
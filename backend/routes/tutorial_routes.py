@@ -1,12 +1,13 @@
 """
 Tutorial progress management routes.
 """
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from pydantic import BaseModel
 
 from .. import schemas
-from ..dependencies import get_user_and_db
+from ..database import atomic_update, write_transaction
+from ..dependencies import get_principal_and_db, get_user_and_db, load_user_columns
+from ..etag import matching_etag, not_modified, set_etag, user_etag
 from ..models import User
 
 router = APIRouter()
@@ -17,7 +18,7 @@ class TutorialProgressIn(BaseModel):
 
 
 @router.post("/progress", include_in_schema=False)
-def update_tutorial_progress(
+async def update_tutorial_progress(
     data: TutorialProgressIn,
     user_and_db: tuple = Depends(get_user_and_db)
 ):
@@ -30,17 +31,22 @@ def update_tutorial_progress(
             detail="Tutorial step must be between 0 and 20"
         )
     
+    values = {User.tutorial: data.step}
     # Auto-grant money for specific tutorial steps
     if data.step == 11:
         # Step 11: Grant 18 money for production upgrade
-        current_user.money_data += 18000
+        values[User.money_data] = User.money_data + 18000
     elif data.step == 13:
         # Step 13: Grant 30 money for generator upgrade
-        current_user.money_data += 30000
+        values[User.money_data] = User.money_data + 30000
     
-    current_user.tutorial = data.step
-    db.commit()
-    db.refresh(current_user)
+    # 한 번의 UPDATE ... RETURNING 으로 적용하고 세션의 사용자 객체도 갱신한다 (refresh 없음)
+    async with write_transaction(db):
+        await atomic_update(
+            db, User, [User.user_id == current_user.user_id], values,
+            returning=tuple(values), sync=current_user,
+        )
+        await db.commit()
     
     return {
         "tutorial": current_user.tutorial,
@@ -50,23 +56,33 @@ def update_tutorial_progress(
 
 
 @router.post("/skip", include_in_schema=False)
-def skip_tutorial(
+async def skip_tutorial(
     user_and_db: tuple = Depends(get_user_and_db)
 ):
     """Skip tutorial (set to 0)."""
     current_user, db, _ = user_and_db
     
-    current_user.tutorial = 0
-    db.commit()
-    db.refresh(current_user)
+    async with write_transaction(db):
+        await atomic_update(
+            db, User, [User.user_id == current_user.user_id], {User.tutorial: 0},
+            returning=(User.tutorial,), sync=current_user,
+        )
+        await db.commit()
     
     return {"tutorial": current_user.tutorial, "message": "Tutorial skipped"}
 
 
 @router.get("/status", include_in_schema=False)
-def get_tutorial_status(
-    user_and_db: tuple = Depends(get_user_and_db)
+async def get_tutorial_status(
+    request: Request,
+    response: Response,
+    principal_and_db: tuple = Depends(get_principal_and_db)
 ):
     """Get current tutorial status."""
-    current_user, db, _ = user_and_db
-    return {"tutorial": current_user.tutorial}
+    user_id, db = principal_and_db
+    row = await load_user_columns(db, user_id, User.tutorial, User.row_version)
+    cached = matching_etag(request, user_id, row.row_version)
+    if cached:
+        return not_modified(cached)
+    set_etag(response, user_etag(user_id, row.row_version))
+    return {"tutorial": row.tutorial}
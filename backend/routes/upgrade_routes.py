@@ -14,56 +14,56 @@ def _amount_from_payload(payload: UpgradeRequest | None) -> int:
 @router.post("/upgrade/production")
 async def upgrade_production(payload: UpgradeRequest | None = None, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_upgrade(user, db, "production", _amount_from_payload(payload))
+    upgraded_user = await apply_upgrade(user, db, "production", _amount_from_payload(payload))
     return UserOut.model_validate(upgraded_user)
 
 
 @router.post("/upgrade/heat_reduction")
 async def upgrade_heat_reduction(payload: UpgradeRequest | None = None, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_upgrade(user, db, "heat_reduction", _amount_from_payload(payload))
+    upgraded_user = await apply_upgrade(user, db, "heat_reduction", _amount_from_payload(payload))
     return UserOut.model_validate(upgraded_user)
 
 
 @router.post("/upgrade/tolerance")
 async def upgrade_tolerance(payload: UpgradeRequest | None = None, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_upgrade(user, db, "tolerance", _amount_from_payload(payload))
+    upgraded_user = await apply_upgrade(user, db, "tolerance", _amount_from_payload(payload))
     return UserOut.model_validate(upgraded_user)
 
 
 @router.post("/upgrade/max_generators")
 async def upgrade_max_generators(payload: UpgradeRequest | None = None, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_upgrade(user, db, "max_generators", _amount_from_payload(payload))
+    upgraded_user = await apply_upgrade(user, db, "max_generators", _amount_from_payload(payload))
     return UserOut.model_validate(upgraded_user)
 
 
 @router.post("/upgrade/demand")
 async def upgrade_demand(payload: UpgradeRequest | None = None, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_upgrade(user, db, "demand", _amount_from_payload(payload))
+    upgraded_user = await apply_upgrade(user, db, "demand", _amount_from_payload(payload))
     return UserOut.model_validate(upgraded_user)
 
 
 @router.post("/upgrade/rebirth_chain")
 async def upgrade_rebirth_chain(payload: UpgradeRequest | None = None, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_rebirth_upgrade(user, db, "rebirth_chain", _amount_from_payload(payload))
+    upgraded_user = await apply_rebirth_upgrade(user, db, "rebirth_chain", _amount_from_payload(payload))
     return UserOut.model_validate(upgraded_user)
 
 
 @router.post("/upgrade/upgrade_batch")
 async def upgrade_upgrade_batch(payload: UpgradeRequest | None = None, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_rebirth_upgrade(user, db, "upgrade_batch", _amount_from_payload(payload))
+    upgraded_user = await apply_rebirth_upgrade(user, db, "upgrade_batch", _amount_from_payload(payload))
     return UserOut.model_validate(upgraded_user)
 
 
 @router.post("/upgrade/rebirth_start_money")
 async def upgrade_rebirth_start_money(payload: UpgradeRequest | None = None, auth=Depends(get_user_and_db)):
     user, db, _ = auth
-    upgraded_user = apply_rebirth_upgrade(user, db, "rebirth_start_money", _amount_from_payload(payload))
+    upgraded_user = await apply_rebirth_upgrade(user, db, "rebirth_start_money", _amount_from_payload(payload))
     return UserOut.model_validate(upgraded_user)
 
 
@@ -103,9 +103,9 @@ async def bulk_upgrade(payload: BulkUpgradeRequest, auth=Depends(get_user_and_db
 
         try:
             if upgrade_type == "upgrade":
-                user = apply_upgrade(user, db, upgrade_name, amount, commit=True)
+                user = await apply_upgrade(user, db, upgrade_name, amount, commit=True)
             elif upgrade_type == "rebirth":
-                user = apply_rebirth_upgrade(user, db, upgrade_name, amount, commit=True)
+                user = await apply_rebirth_upgrade(user, db, upgrade_name, amount, commit=True)
             results.append({"index": idx, "endpoint": endpoint, "amount": amount, "status": "applied"})
         except HTTPException as e:
             failed = {"index": idx, "endpoint": endpoint, "amount": amount, "error": e.detail}
@@ -114,8 +114,7 @@ async def bulk_upgrade(payload: BulkUpgradeRequest, auth=Depends(get_user_and_db
             failed = {"index": idx, "endpoint": endpoint, "amount": amount, "error": str(e)}
             break
 
-    # Always refresh the latest user state after applying successful items
-    db.refresh(user)
+    # apply_* 가 UPDATE ... RETURNING 결과를 user 에 반영하므로 별도 refresh 는 필요 없다
 
     response = {
         "user": UserOut.model_validate(user),
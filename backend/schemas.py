@@ -32,6 +32,10 @@ class UserOut(BaseModel):
     exchange_rate_multiplier: int = 0
     sold_energy_data: int = 0
     sold_energy_high: int = 0
+    sync_seq: int = 0
+    auto_exchange_percent: int = 0
+    auto_exchange_threshold_data: int = 0
+    auto_exchange_threshold_high: int = 0
 
     model_config = {"from_attributes": True}
 
@@ -47,6 +51,13 @@ class ExchangeIn(BaseModel):
     amount_high: int
 
 
+class AutoExchangeIn(BaseModel):
+    # 0 이면 자동 환전을 끈다
+    percent: int = Field(..., ge=0, le=100)
+    threshold_data: int = Field(0, ge=0)
+    threshold_high: int = Field(0, ge=0)
+
+
 class ProgressSaveIn(BaseModel):
     user_id: str
     generator_type_id: str
@@ -0,0 +1,130 @@
+"""
+Cold-start profiling (STARTUP_PROFILE=1).
+
+Import this module first in main.py. When enabled it records:
+  - inclusive import time of every module imported afterwards (top-level packages and backend.*)
+  - duration of each named startup phase
+  - time from process launch to the first response byte, checked against STARTUP_TTFB_TARGET_MS
+and prints a report to stderr. When disabled every hook is a no-op.
+"""
+import os
+import sys
+import time
+from contextlib import contextmanager
+from importlib.abc import MetaPathFinder
+
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "").strip().lower() in ("1", "true", "yes")
+# Cloud Run 콜드 스타트 목표: 프로세스 시작 -> 첫 응답 바이트
+STARTUP_TTFB_TARGET_MS = int(os.getenv("STARTUP_TTFB_TARGET_MS", 2500))
+STARTUP_PROFILE_TOP = int(os.getenv("STARTUP_PROFILE_TOP", 25))
+
+
+def _process_start_wall() -> float:
+    """Wall-clock launch time of this process (Linux /proc), falling back to now."""
+    try:
+        with open("/proc/self/stat") as fh:
+            fields = fh.read().rsplit(")", 1)[1].split()
+        start_ticks = int(fields[19])
+        with open("/proc/uptime") as fh:
+            uptime = float(fh.read().split()[0])
+        ticks = os.sysconf("SC_CLK_TCK")
+        return time.time() - (uptime - start_ticks / ticks)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+
+PROCESS_START = _process_start_wall()
+_import_times: dict[str, float] = {}
+_phases: list[tuple[str, float]] = []
+_first_byte_ms: float | None = None
+
+
+class _TimedLoader:
+    def __init__(self, loader, name):
+        self._loader = loader
+        self._name = name
+
+    def __getattr__(self, item):
+        return getattr(self._loader, item)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        started = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            _import_times[self._name] = (time.perf_counter() - started) * 1000
+
+
+class _ImportTimer(MetaPathFinder):
+    """Wraps loaders found by the remaining finders to time module execution."""
+
+    def find_spec(self, fullname, path, target=None):
+        if "." in fullname and not fullname.startswith("backend."):
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, fullname)
+                return spec
+        return None
+
+
+if STARTUP_PROFILE:
+    sys.meta_path.insert(0, _ImportTimer())
+
+
+@contextmanager
+def phase(name: str):
+    """Time a startup phase (no-op unless STARTUP_PROFILE)."""
+    if not STARTUP_PROFILE:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, (time.perf_counter() - started) * 1000))
+
+
+def report(out=None):
+    out = out or sys.stderr
+    since_launch = (time.time() - PROCESS_START) * 1000
+    print(f"[startup] ready {since_launch:.0f} ms after process launch", file=out)
+    print(f"[startup] imports (inclusive, top {STARTUP_PROFILE_TOP}):", file=out)
+    for name, ms in sorted(_import_times.items(), key=lambda kv: kv[1], reverse=True)[:STARTUP_PROFILE_TOP]:
+        print(f"[startup]   {ms:8.1f} ms  {name}", file=out)
+    print("[startup] phases:", file=out)
+    for name, ms in _phases:
+        print(f"[startup]   {ms:8.1f} ms  {name}", file=out)
+
+
+class FirstByteTimer:
+    """ASGI wrapper that reports process-launch -> first response byte once, then gets out of the way."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if _first_byte_ms is not None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            global _first_byte_ms
+            if message["type"] == "http.response.start" and _first_byte_ms is None:
+                _first_byte_ms = (time.time() - PROCESS_START) * 1000
+                verdict = "OK" if _first_byte_ms <= STARTUP_TTFB_TARGET_MS else "OVER TARGET"
+                print(
+                    f"[startup] first byte {_first_byte_ms:.0f} ms after process launch "
+                    f"(target {STARTUP_TTFB_TARGET_MS} ms) {verdict}",
+                    file=sys.stderr,
+                )
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
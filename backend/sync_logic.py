@@ -1,71 +1,364 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List
+import hashlib
+import json
+import math
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 
+from . import metrics
+from .database import write_transaction
+from .auth_utils import generate_uuid
 from .bigvalue import (
+    DATA_SCALE,
     BigValue,
     add_values,
-    ensure_user_big_values,
+    compare,
     from_payload,
+    from_plain,
     get_user_energy_value,
     get_user_money_value,
+    get_user_sold_energy_value,
     normalize,
     set_user_energy_value,
     set_user_money_value,
+    set_user_sold_energy_value,
+    subtract_values,
 )
-from .models import User
+from .game_logic import (
+    GENERATOR_UPGRADE_CONFIG,
+    UPGRADE_CONFIG,
+    build_duration,
+    calculate_generator_upgrade_cost,
+    calculate_progressive_exchange,
+    calculate_skip_build_cost,
+    calculate_upgrade_cost,
+    demolish_cost,
+    get_upgrade_batch_limit,
+    max_generators_allowed,
+    maybe_complete_build,
+    serialize_generator,
+)
+from .models import Generator, GeneratorType, MapProgress, SyncBatch, User
+
+# 클라이언트 낙관적 값 허용 오차: |server - client| <= SYNC_TOLERANCE * |server| + SYNC_TOLERANCE_ABS
+SYNC_TOLERANCE = float(os.getenv("SYNC_TOLERANCE", 0.02))  # relative (2%)
+SYNC_TOLERANCE_ABS = float(os.getenv("SYNC_TOLERANCE_ABS", 0))  # absolute, in plain units (e.g. 1 money)
+# 저장된 /sync 응답(idempotency key 별) 보존 기간과 정리 주기 (초)
+SYNC_BATCH_RETENTION = int(os.getenv("SYNC_BATCH_RETENTION", 86400))
+SYNC_BATCH_PRUNE_INTERVAL = int(os.getenv("SYNC_BATCH_PRUNE_INTERVAL", 600))
+
+_next_batch_prune = 0.0
 
-SYNC_TOLERANCE = 0.02  # 2% difference allowed for optimistic client values
+
+# 발전기 행(스냅샷)이 필요한 명령. 이런 명령이 없는 배치는 사용자 행만으로 처리된다
+GENERATOR_ACTIONS = frozenset({"build", "demolish", "generator_upgrade", "skip_build", "generator_state"})
+UPGRADE_FIELD_TO_KEY = {
+    meta["field"]: key
+    for key, meta in UPGRADE_CONFIG.items()
+    if meta["field"] in ("production_bonus", "heat_reduction", "tolerance_bonus", "demand_bonus")
+}
+MAX_HEAT_DECREASE = 50
 
 
 def load_user_state(user: User) -> Dict[str, Any]:
-    ensure_user_big_values(user)
     return {
+        "user": user,
+        "now": int(time.time()),
         "money": get_user_money_value(user),
         "energy": get_user_energy_value(user),
         "production_bonus": getattr(user, "production_bonus", 0) or 0,
         "heat_reduction": getattr(user, "heat_reduction", 0) or 0,
         "tolerance_bonus": getattr(user, "tolerance_bonus", 0) or 0,
         "demand_bonus": getattr(user, "demand_bonus", 0) or 0,
+        # generator_id -> (Generator, MapProgress); load_generator_snapshot 가 채운다
+        "generators": None,
+        "types": {},
+        "touched": [],
+        "created": {},
+        "added": [],
+        "removed": [],
     }
 
 
-def apply_action_to_state(state: Dict[str, Any], action: Dict[str, Any]) -> Dict[str, Any]:
-    a_type = action.get("type")
-    payload = action.get("payload") or {}
-
-    if a_type == "upgrade":
-        field = payload.get("field")
-        amount = int(payload.get("amount", 1) or 1)
-        if amount < 1:
-            raise ValueError("Invalid upgrade amount")
-        if field not in ("production_bonus", "heat_reduction", "tolerance_bonus", "demand_bonus"):
-            raise ValueError("Invalid upgrade field")
-        state[field] = (state.get(field) or 0) + amount
-    elif a_type == "collect_money":
-        delta_payload = payload.get("money_delta")
-        delta: BigValue = from_payload(
-            (delta_payload or {}).get("data"),
-            (delta_payload or {}).get("high"),
-            0,
-        )
-        state["money"] = add_values(state["money"], delta)
-    elif a_type == "collect_energy":
-        delta_payload = payload.get("energy_delta")
-        delta: BigValue = from_payload(
-            (delta_payload or {}).get("data"),
-            (delta_payload or {}).get("high"),
-            0,
+async def load_generator_snapshot(db: AsyncSession, state: Dict[str, Any], actions: List[Dict[str, Any]]) -> None:
+    """
+    Load the user's generators (one joined SELECT) and any generator types that build
+    actions reference (one more), only if the batch contains generator commands.
+    """
+    if not any(action.get("type") in GENERATOR_ACTIONS for action in actions):
+        return
+    user = state["user"]
+    rows = (
+        await db.execute(
+            select(Generator, MapProgress)
+            .join(MapProgress, MapProgress.generator_id == Generator.generator_id)
+            .options(joinedload(Generator.generator_type))
+            .filter(MapProgress.user_id == user.user_id)
         )
-        state["energy"] = add_values(state["energy"], delta)
-    # Other action types can be added as needed
+    ).all()
+    generators: Dict[str, Tuple[Generator, MapProgress]] = {}
+    for gen, mp in rows:
+        maybe_complete_build(gen, state["now"])
+        generators[gen.generator_id] = (gen, mp)
+        if gen.generator_type is not None:
+            state["types"][gen.generator_type_id] = gen.generator_type
+    state["generators"] = generators
+
+    wanted = {
+        (action.get("payload") or {}).get("generator_type_id")
+        for action in actions
+        if action.get("type") == "build"
+    } - set(state["types"]) - {None}
+    if wanted:
+        types = (await db.execute(select(GeneratorType).filter(GeneratorType.generator_type_id.in_(wanted)))).scalars().all()
+        state["types"].update({gt.generator_type_id: gt for gt in types})
+
+
+def _bv_from(payload: Dict[str, Any], key: str) -> BigValue:
+    raw = payload.get(key) or {}
+    return from_payload(raw.get("data"), raw.get("high"), 0)
+
+
+def _spend(state: Dict[str, Any], cost: BigValue, message: str = "Not enough money") -> None:
+    if compare(state["money"], cost) < 0:
+        raise ValueError(message)
+    state["money"] = subtract_values(state["money"], cost)
+
+
+def _touch(state: Dict[str, Any], generator_id: str) -> None:
+    if generator_id not in state["touched"]:
+        state["touched"].append(generator_id)
+
+
+def _owned_generator(state: Dict[str, Any], payload: Dict[str, Any]) -> Tuple[Generator, MapProgress]:
+    generator_id = payload.get("generator_id")
+    # 같은 배치에서 build 한 발전기는 클라이언트 ref 로 가리킬 수 있다
+    generator_id = state["created"].get(generator_id, generator_id)
+    entry = state["generators"].get(generator_id) if generator_id else None
+    if entry is None:
+        raise ValueError("Generator not found")
+    return entry
+
+
+def _apply_upgrade(state: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    field = payload.get("field")
+    amount = int(payload.get("amount", 1) or 1)
+    if amount < 1:
+        raise ValueError("Invalid upgrade amount")
+    if field not in UPGRADE_FIELD_TO_KEY:
+        raise ValueError("Invalid upgrade field")
+    user = state["user"]
+    max_amount = get_upgrade_batch_limit(user)
+    if amount > max_amount:
+        raise ValueError(f"한 번에 {max_amount}회까지만 업그레이드할 수 있습니다.")
+    # /upgrade/* 엔드포인트와 같은 비용 곡선, 배치 안의 이전 업그레이드 레벨 기준
+    cost = calculate_upgrade_cost(user, UPGRADE_FIELD_TO_KEY[field], amount, level=state[field])
+    _spend(state, from_plain(cost))
+    state[field] = (state.get(field) or 0) + amount
+
+
+def _apply_collect_money(state: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    state["money"] = add_values(state["money"], _bv_from(payload, "money_delta"))
+
+
+def _apply_collect_energy(state: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    state["energy"] = add_values(state["energy"], _bv_from(payload, "energy_delta"))
+
+
+def _apply_exchange(state: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    amount = normalize(_bv_from(payload, "amount"))
+    if amount.data <= 0 and amount.high <= 0:
+        raise ValueError("Invalid amount")
+    if compare(state["energy"], amount) < 0:
+        raise ValueError("Not enough energy")
+    user = state["user"]
+    # 환율은 수요 보너스에 따라 달라지므로 배치 안의 업그레이드를 먼저 반영한다
+    user.demand_bonus = state["demand_bonus"]
+    gained, _ = calculate_progressive_exchange(user, amount)
+    state["energy"] = subtract_values(state["energy"], amount)
+    state["money"] = add_values(state["money"], gained)
+    set_user_sold_energy_value(user, add_values(get_user_sold_energy_value(user), amount))
+
+
+def _apply_build(state: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    user = state["user"]
+    gt = state["types"].get(payload.get("generator_type_id"))
+    if gt is None:
+        raise ValueError("Generator type not found")
+    try:
+        x_position = int(payload["x_position"])
+        world_position = int(payload["world_position"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Build position required")
+    generators = state["generators"]
+    if len(generators) >= max_generators_allowed(user):
+        raise ValueError("Generator limit reached")
+    if any(g.world_position == world_position and g.x_position == x_position for g, _ in generators.values()):
+        raise ValueError("Generator already exists in this position")
+    _spend(state, BigValue(gt.cost_data, gt.cost_high))
+
+    gen = Generator(
+        generator_id=generate_uuid(),
+        generator_type_id=gt.generator_type_id,
+        owner_id=user.user_id,
+        level=1,
+        x_position=x_position,
+        world_position=world_position,
+        isdeveloping=True,
+        build_complete_ts=state["now"] + build_duration(gt, 1, user),
+        heat=0,
+        running=True,
+    )
+    mp = MapProgress(
+        map_progress_id=generate_uuid(),
+        user_id=user.user_id,
+        generator_id=gen.generator_id,
+        production_upgrade=0,
+        heat_reduction_upgrade=0,
+        tolerance_upgrade=0,
+    )
+    generators[gen.generator_id] = (gen, mp)
+    state["added"].append((gen, mp))
+    ref = payload.get("ref")
+    if ref:
+        state["created"][str(ref)] = gen.generator_id
+    _touch(state, gen.generator_id)
+
+
+def _apply_demolish(state: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    gen, mp = _owned_generator(state, payload)
+    gt = state["types"].get(gen.generator_type_id)
+    if gt is None:
+        raise ValueError("Generator type not found")
+    _spend(state, demolish_cost(gt), "Not enough money to demolish")
+    del state["generators"][gen.generator_id]
+    if (gen, mp) in state["added"]:
+        # 같은 배치에서 지은 발전기: DB 에 쓰지 않고 버린다
+        state["added"].remove((gen, mp))
+        state["created"] = {ref: gid for ref, gid in state["created"].items() if gid != gen.generator_id}
+    else:
+        state["removed"].append((gen, mp))
+    if gen.generator_id in state["touched"]:
+        state["touched"].remove(gen.generator_id)
+
+
+def _apply_generator_upgrade(state: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    gen, mp = _owned_generator(state, payload)
+    key = payload.get("key")
+    if key not in GENERATOR_UPGRADE_CONFIG:
+        raise ValueError("Unknown upgrade")
+    amount = int(payload.get("amount", 1) or 1)
+    if amount < 1:
+        raise ValueError("Invalid upgrade amount")
+    gt = state["types"].get(gen.generator_type_id)
+    if gt is None:
+        raise ValueError("Generator type not found")
+    _spend(state, calculate_generator_upgrade_cost(gt, mp, key, amount))
+    field = GENERATOR_UPGRADE_CONFIG[key]["field"]
+    setattr(mp, field, (getattr(mp, field, 0) or 0) + amount)
+    _touch(state, gen.generator_id)
+
+
+def _apply_skip_build(state: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    gen, _ = _owned_generator(state, payload)
+    now = state["now"]
+    _touch(state, gen.generator_id)
+    if maybe_complete_build(gen, now) or not gen.isdeveloping or not gen.build_complete_ts:
+        return
+    gt = state["types"].get(gen.generator_type_id)
+    if gt is None:
+        raise ValueError("Generator type not found")
+    remaining = max(0, gen.build_complete_ts - now)
+    if remaining > 0:
+        _spend(state, calculate_skip_build_cost(gt, gen, state["user"], remaining), "Not enough money to skip build")
+    gen.isdeveloping = False
+    gen.build_complete_ts = None
+    gen.running = True
 
+
+def _apply_generator_state(state: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    gen, _ = _owned_generator(state, payload)
+    changed = False
+    if payload.get("heat") is not None:
+        new_heat = max(0, int(payload["heat"]))
+        current_heat = gen.heat or 0
+        # Prevent suspicious heat resets (only allow gradual decreases)
+        if new_heat < current_heat and current_heat - new_heat > MAX_HEAT_DECREASE:
+            raise ValueError("Heat decrease too large")
+        gen.heat = new_heat
+        changed = True
+    if payload.get("running") is not None:
+        gen.running = bool(payload["running"])
+        changed = True
+    if payload.get("explode"):
+        gen.isdeveloping = True
+        gen.running = False
+        gen.heat = 0
+        gen.build_complete_ts = state["now"] + build_duration(state["types"].get(gen.generator_type_id), gen.level, state["user"])
+        changed = True
+    if not changed:
+        raise ValueError("No changes provided")
+    _touch(state, gen.generator_id)
+
+
+ACTION_HANDLERS = {
+    "upgrade": _apply_upgrade,
+    "collect_money": _apply_collect_money,
+    "collect_energy": _apply_collect_energy,
+    "exchange": _apply_exchange,
+    "build": _apply_build,
+    "demolish": _apply_demolish,
+    "generator_upgrade": _apply_generator_upgrade,
+    "skip_build": _apply_skip_build,
+    "generator_state": _apply_generator_state,
+}
+
+
+def apply_action_to_state(state: Dict[str, Any], action: Dict[str, Any]) -> Dict[str, Any]:
+    a_type = action.get("type")
+    handler = ACTION_HANDLERS.get(a_type)
+    if handler is None:
+        # 알 수 없는 타입은 이전과 같이 무시한다
+        return state
+    if a_type in GENERATOR_ACTIONS and state.get("generators") is None:
+        raise ValueError("Generator snapshot not loaded")
+    handler(state, action.get("payload") or {})
     return state
 
 
+def serialize_touched_generators(state: Dict[str, Any]) -> List[Dict[str, Any]]:
+    out = []
+    for generator_id in state["touched"]:
+        entry = state["generators"].get(generator_id)
+        if entry is None:
+            continue
+        gen, mp = entry
+        gt = state["types"].get(gen.generator_type_id)
+        out.append(serialize_generator(gen, getattr(gt, "name", None), getattr(gt, "cost_data", 0), getattr(gt, "cost_high", 0), mp))
+    return out
+
+
+def _decades(value: BigValue) -> float:
+    """log10 of |value| in BigValue data units (-inf for zero)."""
+    return math.log10(abs(value.data)) + value.high if value.data else -math.inf
+
+
+# 두 값의 자릿수(log10) 차이가 이보다 크면 상대 오차로는 절대 통과할 수 없다 (SYNC_TOLERANCE < 1 가정).
+# 정렬용 10**n 지수를 작게 묶어 두는 역할도 한다
+_MAX_DECADE_GAP = 2.0
+
+
 def _within_tolerance(server_val: BigValue, client_val: Dict[str, int]) -> bool:
+    """
+    Compare in a common `high` instead of requiring equal normalized highs, so
+    999,999e5 vs 1,000,000e5 (normalized 100,000e6) is a 0.0001% difference, not a 409.
+    """
     if client_val is None:
         return True
     s = normalize(server_val)
@@ -75,31 +368,124 @@ def _within_tolerance(server_val: BigValue, client_val: Dict[str, int]) -> bool:
             int(client_val.get("high", 0)),
         )
     )
-    if s.high != c.high:
-        return False
-    base = max(1, s.data)
-    diff = abs(s.data - c.data) / base
-    return diff <= SYNC_TOLERANCE
+    if s == c:
+        return True
+    abs_eps = SYNC_TOLERANCE_ABS * DATA_SCALE  # data units at high 0
+    s_dec, c_dec = _decades(s), _decades(c)
+    if abs(s_dec - c_dec) > _MAX_DECADE_GAP:
+        # 크기가 전혀 다르다: 큰 쪽이 절대 오차 근처일 때만 통과 가능 (예: 0 과 아주 작은 값).
+        # 그 범위에서는 float 로 충분하고, 작은 쪽의 10.0**high 는 0 으로 사라져도 된다
+        if abs_eps <= 0 or max(s_dec, c_dec) > math.log10(abs_eps) + _MAX_DECADE_GAP:
+            return False
+        s_float, c_float = s.data * 10.0 ** s.high, c.data * 10.0 ** c.high
+        return abs(s_float - c_float) <= SYNC_TOLERANCE * abs(s_float) + abs_eps
+    # 자릿수가 가까우므로 high 차이도 작다: 낮은 high 에 맞춰 정수로 정확히 뺀다
+    low = min(s.high, c.high)
+    s_aligned = s.data * 10 ** (s.high - low)
+    c_aligned = c.data * 10 ** (c.high - low)
+    diff = abs(s_aligned - c_aligned)
+    allowed = SYNC_TOLERANCE * abs(s_aligned) + abs_eps * 10.0 ** -low
+    return diff <= allowed
+
+
+def _legacy_within_tolerance(server_val: BigValue, client_val: Dict[str, int]) -> bool:
+    # 이전 규칙(같은 high 에서만 비교): 새 규칙이 없앤 409 를 세기 위해서만 쓴다
+    s = normalize(server_val)
+    c = normalize(BigValue(int(client_val.get("data", 0)), int(client_val.get("high", 0))))
+    return s.high == c.high and abs(s.data - c.data) / max(1, s.data) <= SYNC_TOLERANCE
 
 
 def validate_client_state(state: Dict[str, Any], client_state: Dict[str, Any]) -> bool:
     try:
-        if not _within_tolerance(state["money"], client_state.get("money")):
-            return False
-        if not _within_tolerance(state["energy"], client_state.get("energy")):
-            return False
+        for field in ("money", "energy"):
+            client_val = client_state.get(field)
+            ok = _within_tolerance(state[field], client_val)
+            if client_val is not None:
+                metrics.record_sync_tolerance(field, ok, _legacy_within_tolerance(state[field], client_val))
+            if not ok:
+                return False
     except Exception:
         return False
     return True
 
 
-def persist_user_state(db: Session, user: User, state: Dict[str, Any]) -> User:
+def pending_actions(actions: List[Dict[str, Any]], high_water: int) -> Tuple[List[Dict[str, Any]], int, int]:
+    """
+    Drop actions whose seq is at or below the user's high-water mark (already applied
+    by an earlier, possibly timed-out request). Returns (to_apply, new_high_water, skipped).
+    Actions without a seq are legacy clients and are always applied.
+    """
+    to_apply: List[Dict[str, Any]] = []
+    skipped = 0
+    last_seq = None
+    for action in actions:
+        seq = action.get("seq")
+        if seq is None:
+            to_apply.append(action)
+            continue
+        if last_seq is not None and seq <= last_seq:
+            raise ValueError(f"Action seq must increase within a batch (action {action.get('id') or seq})")
+        last_seq = seq
+        if seq <= high_water:
+            skipped += 1
+            continue
+        to_apply.append(action)
+    new_high = max(high_water, last_seq) if last_seq is not None else high_water
+    return to_apply, new_high, skipped
+
+
+def batch_fingerprint(actions: List[Dict[str, Any]]) -> str:
+    """Hash of the action list; a reused idempotency key must come with the same actions."""
+    canonical = json.dumps(actions, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+async def load_sync_batch(db: AsyncSession, user_id: str, key: str) -> Optional[SyncBatch]:
+    return await db.scalar(
+        select(SyncBatch).filter(SyncBatch.user_id == user_id, SyncBatch.idempotency_key == key)
+    )
+
+
+async def store_sync_batch(db: AsyncSession, user_id: str, key: str, request_hash: str, response: str) -> None:
+    """Queue the batch result in the current transaction (committed with the state change)."""
+    global _next_batch_prune
+    now = time.time()
+    db.add(SyncBatch(
+        user_id=user_id,
+        idempotency_key=key,
+        request_hash=request_hash,
+        response=response,
+        created_at=int(now * 1000),
+    ))
+    if now >= _next_batch_prune:
+        _next_batch_prune = now + SYNC_BATCH_PRUNE_INTERVAL
+        cutoff = int((now - SYNC_BATCH_RETENTION) * 1000)
+        await db.execute(delete(SyncBatch).where(SyncBatch.created_at < cutoff))
+
+
+def apply_state_to_user(user: User, state: Dict[str, Any]) -> User:
     user.production_bonus = state.get("production_bonus", 0)
     user.heat_reduction = state.get("heat_reduction", 0)
     user.tolerance_bonus = state.get("tolerance_bonus", 0)
     user.demand_bonus = state.get("demand_bonus", 0)
     set_user_money_value(user, state["money"])
     set_user_energy_value(user, state["energy"])
-    db.commit()
-    db.refresh(user)
+    return user
+
+
+async def stage_generator_changes(db: AsyncSession, state: Dict[str, Any]) -> None:
+    """Queue built / demolished generators in the session; the caller commits once."""
+    for gen, mp in state["added"]:
+        db.add(gen)
+        db.add(mp)
+    for gen, mp in state["removed"]:
+        await db.delete(mp)
+        await db.delete(gen)
+
+
+async def persist_user_state(db: AsyncSession, user: User, state: Dict[str, Any]) -> User:
+    async with write_transaction(db):
+        apply_state_to_user(user, state)
+        await db.commit()
+    await db.refresh(user)
     return user
@@ -0,0 +1,123 @@
+"""
+Property check for the /sync client-value tolerance (sync_logic._within_tolerance).
+
+    python -m backend.tolerance_check [--samples 50000] [--seed 1]
+
+Compares _within_tolerance against an exact rational reference of the documented rule,
+|server - client| <= SYNC_TOLERANCE * |server| + SYNC_TOLERANCE_ABS, over fixed boundary
+cases and random pairs biased towards high/decade boundaries, for several tolerance
+settings. Also checks that everything the old same-high rule (_legacy_within_tolerance)
+accepted is still accepted. Exits 1 on any disagreement.
+"""
+import argparse
+import math
+import os
+import random
+import sys
+from fractions import Fraction
+
+os.environ.setdefault("JWT_SECRET", "tolerance-check-" + "x" * 32)
+
+from . import sync_logic  # noqa: E402
+from .bigvalue import DATA_SCALE, BigValue, normalize  # noqa: E402
+
+# (SYNC_TOLERANCE, SYNC_TOLERANCE_ABS)
+SETTINGS = ((0.02, 0.0), (0.001, 1.0), (0.1, 5.0))
+
+# (server, client, expected, expected by the old same-high rule) at the default 2% / 0 setting
+BOUNDARY_CASES = [
+    # 999,999e5 와 1,000,000e5 (정규화하면 100,000e6): high 가 달라도 0.0001% 차이
+    (BigValue(999_999, 5), {"data": 1_000_000, "high": 5}, True, False),
+    (BigValue(100_000, 6), {"data": 999_999, "high": 5}, True, False),
+    (BigValue(100_000, 6), {"data": 980_000, "high": 5}, True, False),
+    (BigValue(100_000, 6), {"data": 979_999, "high": 5}, False, False),
+    (BigValue(999_999, 5), {"data": 101_999, "high": 6}, True, False),
+    (BigValue(999_999, 5), {"data": 102_000, "high": 6}, False, False),
+    (BigValue(500_000, 10), {"data": 510_000, "high": 10}, True, True),
+    (BigValue(500_000, 10), {"data": 511_000, "high": 10}, False, False),
+    (BigValue(500_000, 10), {"data": 500_000, "high": 13}, False, False),
+    (BigValue(0, 0), {"data": 0, "high": 0}, True, True),
+    (BigValue(0, 0), {"data": 1, "high": 0}, False, False),
+]
+
+
+def _exact(value: BigValue) -> Fraction:
+    return Fraction(value.data) * Fraction(10) ** value.high
+
+
+def reference(server: BigValue, client: dict, rel: float, abs_plain: float) -> bool:
+    s = normalize(server)
+    c = normalize(BigValue(int(client["data"]), int(client["high"])))
+    allowed = Fraction(rel).limit_denominator(10**9) * abs(_exact(s)) + Fraction(abs_plain) * DATA_SCALE
+    return abs(_exact(s) - _exact(c)) <= allowed
+
+
+def _random_pair(rng: random.Random, rel: float):
+    high = rng.randint(0, 40)
+    # 절반 가까이는 자릿수 경계(999,999 / 100,000) 근처에서 뽑는다
+    data = rng.choice([
+        rng.randint(0, 999_999), rng.randint(99_000, 101_000), 999_999, 100_000, rng.randint(0, 2000),
+    ])
+    server = normalize(BigValue(data, high if data >= 1000 else rng.choice([0, high])))
+    factor = rng.choice([1, 1 + rel * rng.uniform(-1.5, 1.5), rng.uniform(0, 20), 10 ** rng.randint(-3, 3)])
+    target = float(_exact(server)) * factor
+    if target <= 0 or rng.random() < 0.03:
+        return server, {"data": rng.randint(0, 3000), "high": 0}
+    exp = max(0, math.floor(math.log10(target)) - 5)
+    return server, {"data": int(round(target / 10**exp)), "high": exp}
+
+
+def run(samples: int, seed: int) -> int:
+    saved = sync_logic.SYNC_TOLERANCE, sync_logic.SYNC_TOLERANCE_ABS
+    failures = []
+    try:
+        sync_logic.SYNC_TOLERANCE, sync_logic.SYNC_TOLERANCE_ABS = SETTINGS[0]
+        for server, client, expected, legacy_expected in BOUNDARY_CASES:
+            got = sync_logic._within_tolerance(server, client)
+            if got != expected:
+                failures.append(f"boundary {server} vs {client}: got {got}, expected {expected}")
+            legacy = sync_logic._legacy_within_tolerance(server, client)
+            if legacy != legacy_expected:
+                failures.append(f"boundary {server} vs {client}: legacy got {legacy}, expected {legacy_expected}")
+
+        rng = random.Random(seed)
+        for rel, abs_plain in SETTINGS:
+            sync_logic.SYNC_TOLERANCE, sync_logic.SYNC_TOLERANCE_ABS = rel, abs_plain
+            accepted = rejected = rescued = 0
+            for _ in range(samples):
+                server, client = _random_pair(rng, rel)
+                got = sync_logic._within_tolerance(server, client)
+                if got != reference(server, client, rel, abs_plain):
+                    failures.append(f"rel={rel} abs={abs_plain}: {server} vs {client}: got {got}")
+                legacy = sync_logic._legacy_within_tolerance(server, client)
+                if legacy and not got:
+                    failures.append(f"rel={rel} abs={abs_plain}: {server} vs {client}: legacy accepted, now rejected")
+                accepted += got
+                rejected += not got
+                rescued += got and not legacy
+            print(
+                f"rel={rel:<6g} abs={abs_plain:<4g} accepted {accepted:>7}  rejected {rejected:>7}  "
+                f"accepted only by the new rule {rescued:>6}"
+            )
+    finally:
+        sync_logic.SYNC_TOLERANCE, sync_logic.SYNC_TOLERANCE_ABS = saved
+
+    if failures:
+        print(f"\n{len(failures)} tolerance check failures:", file=sys.stderr)
+        for line in failures[:20]:
+            print(f"  - {line}", file=sys.stderr)
+        return 1
+    print("\ntolerance matches the exact rule")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m backend.tolerance_check")
+    parser.add_argument("--samples", type=int, default=50_000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    return run(args.samples, args.seed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -27,6 +27,8 @@ export function useGameSync() {
   const intervalRef = useRef(null);
   const isSyncingRef = useRef(false);
   const syncErrorRef = useRef(null);
+  // 서버의 sync_seq(high-water mark) 다음 번호부터 action 에 seq 를 붙인다
+  const nextSeqRef = useRef(null);
 
   const getClientState = useCallback(() => {
     const user = useStore.getState().currentUser;
@@ -61,13 +63,24 @@ export function useGameSync() {
           ...(getAuthToken() ? { Authorization: `Bearer ${getAuthToken()}` } : {}),
         },
         credentials: 'include',
-        body: JSON.stringify({ actions: pendingActions, clientState }),
+        body: JSON.stringify({
+          actions: pendingActions,
+          clientState,
+          // 같은 배치를 재전송하면 같은 키가 나오므로 서버는 저장된 결과를 그대로 돌려준다
+          idempotencyKey: pendingActions.length
+            ? `${pendingActions[0].id}:${pendingActions[pendingActions.length - 1].seq}`
+            : undefined,
+        }),
       });
 
       const data = await res.json();
       if (!res.ok) throw new Error(data.detail || 'sync failed');
 
-      useStore.getState().syncUserState(data.user, { persist: true });
+      const syncedUser = data.user || data;
+      useStore.getState().syncUserState(syncedUser, { persist: true });
+      if (typeof syncedUser.sync_seq === 'number' && (nextSeqRef.current ?? 0) <= syncedUser.sync_seq) {
+        nextSeqRef.current = syncedUser.sync_seq + 1;
+      }
       lastClientStateRef.current = clientState;
       setPendingActions([]);
     } catch (err) {
@@ -79,7 +92,12 @@ export function useGameSync() {
   }, [getClientState, pendingActions]);
 
   const enqueueAction = useCallback((action) => {
-    setPendingActions((prev) => [...prev, { ...action, ts: Date.now() }]);
+    if (nextSeqRef.current == null) {
+      nextSeqRef.current = (useStore.getState().currentUser?.sync_seq || 0) + 1;
+    }
+    const seq = nextSeqRef.current++;
+    const id = globalThis.crypto?.randomUUID?.() || `${Date.now()}-${seq}`;
+    setPendingActions((prev) => [...prev, { ...action, id, seq, ts: Date.now() }]);
     clearTimeout(debounceTimerRef.current);
     debounceTimerRef.current = setTimeout(() => {
       triggerSync('debounce');